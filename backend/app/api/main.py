@@ -1,17 +1,51 @@
 """
 メンズファッション提案サービス - FastAPI メインアプリケーション
 """
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
 from app.api.routes import templates, products
-from app.api.routes import brand_style_matching, email, checkout
+from app.api.routes import brand_style_matching, email, checkout, outfits
+from app.api.utils.catalog_store import catalog_store
+from app.api.utils import query_cache, utage_client
+from app.api.utils.circuit_breaker import STATE_CLOSED
+from app.api.utils.outbox import outbox_worker
+from app.api.utils.purchase_store import purchase_writer
+from app.api.utils.utage_field_updates import utage_field_updater
+
+# カタログが読み込み直されたら検索結果のキャッシュを破棄する
+catalog_store.add_listener(query_cache.clear_all)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """アプリケーションの起動・終了処理"""
+    # カタログの初回読み込みとファイル監視を開始
+    await catalog_store.start()
+    # Utage APIへの接続プールを作成（アプリケーションの終了まで接続を使い回す）
+    await utage_client.open_http_client()
+    # アウトボックス（メール登録などの外部API送信）のワーカーを開始
+    await outbox_worker.start()
+    # Utageのカスタムフィールド更新をまとめて送信するタスクを開始
+    await utage_field_updater.start()
+    # 購入情報の書き込み（グループコミット）タスクを開始
+    await purchase_writer.start()
+    yield
+    await purchase_writer.stop()
+    # 溜まっている更新を送信してから停止する（失敗したものはアウトボックスに残る）
+    await utage_field_updater.stop()
+    await outbox_worker.stop()
+    await utage_client.close_http_client()
+    await catalog_store.stop()
+
 
 app = FastAPI(
     title="メンズファッション提案サービス API",
     description="700人実績のナンパ師が監修するモテる服を、最安値で購入できるサービス",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS設定
@@ -33,6 +67,7 @@ app.include_router(products.router)
 app.include_router(brand_style_matching.router)
 app.include_router(email.router)
 app.include_router(checkout.router)
+app.include_router(outfits.router)
 
 # 静的ファイルの配信（PDFファイルなど）
 static_dir = Path(__file__).parent.parent.parent / "static"
@@ -53,3 +88,32 @@ async def root():
 async def health():
     """ヘルスチェック"""
     return {"status": "healthy"}
+
+
+@app.get("/health/cache")
+async def health_cache():
+    """検索結果キャッシュの統計情報"""
+    return {"status": "healthy", "caches": query_cache.cache_stats()}
+
+
+@app.get("/health/outbox")
+async def health_outbox():
+    """アウトボックス（外部API送信待ち）の統計情報"""
+    return {"status": "healthy", "outbox": await outbox_worker.stats()}
+
+
+@app.get("/health/utage")
+async def health_utage():
+    """Utage API連携の状態（サーキットブレーカー・応答時間・カスタムフィールド更新）"""
+    return {
+        "status": "healthy" if utage_client.utage_breaker.state == STATE_CLOSED else "degraded",
+        "circuit_breaker": utage_client.utage_breaker.stats(),
+        "latency": utage_client.utage_latency.stats(),
+        "custom_fields": utage_field_updater.stats(),
+    }
+
+
+@app.get("/health/purchases")
+async def health_purchases():
+    """購入情報の書き込み（グループコミット）の統計情報"""
+    return {"status": "healthy", "purchases": purchase_writer.stats()}
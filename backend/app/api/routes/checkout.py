@@ -1,14 +1,19 @@
 """
 チェックアウト・アップセル関連のAPI
 """
+import logging
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
 from pathlib import Path
 from typing import Optional
+from app.api.utils.purchase_store import purchase_writer
+from app.api.utils.utage_field_updates import utage_field_updater
 
 router = APIRouter(prefix="/api/checkout", tags=["checkout"])
 
+logger = logging.getLogger(__name__)
+
 
 class UpsellPurchaseRequest(BaseModel):
     offer_id: str
@@ -45,19 +50,26 @@ async def purchase_upsell(request: UpsellPurchaseRequest):
     if request.offer_id not in valid_offer_ids:
         raise HTTPException(status_code=400, detail="Invalid offer_id")
     
-    # 購入情報を保存（実際の実装では、データベースに保存）
-    purchase_data = {
-        'offer_id': request.offer_id,
-        'type': request.type,
-        'email': request.email,
-        'name': request.name,
-        'status': 'completed',
-    }
+    # 購入情報を保存（同時に届いた購入とまとめてコミットされ、コミット後に返る）
+    try:
+        purchase = await purchase_writer.append(
+            offer_id=request.offer_id,
+            purchase_type=request.type,
+            email=request.email,
+            name=request.name,
+            status='completed',
+        )
+    except Exception as e:
+        logger.error(f"購入情報の保存に失敗しました: {str(e)}")
+        raise HTTPException(status_code=500, detail="購入情報の保存に失敗しました")
     
-    # TODO: Utage（SendRight）への登録
-    # if request.email:
-    #     # Utage APIを呼び出して登録
-    #     pass
+    # Utage（SendRight）の会員情報に購入を反映
+    # （同じメールアドレスへの更新は短時間まとめてから1回で送信される）
+    if request.email:
+        utage_field_updater.update(request.email, {
+            "customer_type": "customer",
+            "last_purchased_offer": request.offer_id,
+        })
     
     # TODO: メール送信
     # - 購入確認メール
@@ -67,6 +79,7 @@ async def purchase_upsell(request: UpsellPurchaseRequest):
     return {
         'success': True,
         'message': '購入が完了しました',
+        'purchase_id': purchase['purchase_id'],
         'offer_id': request.offer_id,
         'download_url': f'/api/checkout/downloads/{request.offer_id}' if request.type == 'course' else None,
     }
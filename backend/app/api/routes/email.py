@@ -5,11 +5,35 @@ from fastapi import APIRouter, HTTPException, Query
 from pydantic import BaseModel, EmailStr
 from typing import Optional
 import os
+import logging
 from datetime import datetime
-from app.api.utils.utage_client import UtageClient
+from app.api.utils.outbox import PermanentFailure, RetryLater, outbox_worker
+from app.api.utils.utage_client import get_utage_client
 
 router = APIRouter(prefix="/api/email", tags=["email"])
 
+logger = logging.getLogger(__name__)
+
+# アウトボックスに書き込むUtage登録の種類
+UTAGE_REGISTER_EMAIL = "utage.register_email"
+
+
+async def _send_registration(payload: dict) -> None:
+    """アウトボックスに書き込まれた登録内容をUtageに送信（一時的な失敗の場合は再試行される）"""
+    utage_result = await get_utage_client().register_email(**payload)
+    if utage_result.get("retry_after") is not None:
+        # Utage APIの回路が開いている間は、試行回数を消費せずに再開後に送る
+        raise RetryLater(max(1.0, utage_result["retry_after"]), utage_result.get("message", ""))
+    if not utage_result.get("success"):
+        message = utage_result.get("message") or "Utageへの登録に失敗しました"
+        if not utage_result.get("retryable", True):
+            # 設定の不足や4xxは再試行しても成功しないため、すぐに送信失敗として残す
+            raise PermanentFailure(message)
+        raise RuntimeError(message)
+
+
+outbox_worker.register_handler(UTAGE_REGISTER_EMAIL, _send_registration)
+
 
 class EmailRegisterRequest(BaseModel):
     """メール登録リクエスト"""
@@ -35,21 +59,23 @@ async def register_email(request: EmailRegisterRequest):
     - **source**: 登録元（デフォルト: "top_page"）
     """
     try:
-        # Utageへの自動登録
-        utage_client = UtageClient()
-        utage_result = await utage_client.register_email(
-            email=request.email,
-            name=request.name,
-            source=request.source,
-            scenario_id=os.getenv("UTAGE_SCENARIO_ID_PROSPECT")
-        )
-        
-        # Utageへの登録が失敗しても、ダウンロードリンクは提供する
-        if not utage_result.get("success"):
-            # ログに記録するが、エラーは返さない（ダウンロードリンクは提供する）
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.warning(f"Utageへの登録に失敗しましたが、ダウンロードリンクは提供します: {utage_result.get('message')}")
+        # Utageへの自動登録はアウトボックスに書き込み、バックグラウンドで送信する
+        # （レスポンスはUtage APIの応答を待たずに返す）
+        # Utageが設定されていない場合は送信しても失敗するだけなので、個人情報を書き込まずにスキップする
+        utage_client = get_utage_client()
+        if not utage_client.api_key or not utage_client.scenario_id_prospect:
+            logger.warning("Utageが設定されていないため（UTAGE_API_KEY / UTAGE_SCENARIO_ID_PROSPECT）、Utageへの登録をスキップします")
+        else:
+            try:
+                await outbox_worker.enqueue(UTAGE_REGISTER_EMAIL, {
+                    "email": request.email,
+                    "name": request.name,
+                    "source": request.source,
+                    "scenario_id": utage_client.scenario_id_prospect,
+                })
+            except Exception as e:
+                # 書き込みに失敗しても、ダウンロードリンクは提供する
+                logger.error(f"Utage登録のアウトボックスへの書き込みに失敗しましたが、ダウンロードリンクは提供します: {str(e)}")
         
         # ダウンロードリンクの生成
         base_url = os.getenv("BASE_URL", "http://localhost:8000")
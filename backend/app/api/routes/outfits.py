@@ -0,0 +1,109 @@
+"""
+コーディネート提案関連のAPI
+"""
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query
+from typing import List, Optional
+from app.api.utils.catalog_columns import bitmap_to_mask
+from app.api.utils.catalog_store import get_catalog
+from app.api.utils.json_fragments import FragmentJSONResponse, dumps, encode_members
+from app.api.utils.outfit_solver import solve_outfits
+from app.api.utils.query_cache import QueryCache
+from app.api.utils.template_resolver import item_type_bitmap
+
+router = APIRouter(prefix="/api/outfits", tags=["outfits"])
+
+# コーディネート一式のスロット（テンプレート未指定時）
+DEFAULT_OUTFIT_SLOTS = ("トップス", "パンツ", "靴")
+
+_outfit_cache = QueryCache("outfits.solve")
+
+
+@router.get("/")
+async def solve_outfit(
+    budget: int = Query(..., ge=1, description="予算（合計価格の上限）"),
+    scene: Optional[str] = Query(None, description="シーン（デート、仕事、カジュアルなど）"),
+    style: Optional[str] = Query(None, description="スタイル（カジュアル、ビジネス、ストリートなど）"),
+    season: Optional[str] = Query(None, description="季節（春、夏、秋、冬）"),
+    template_id: Optional[str] = Query(None, description="テンプレートID（指定時はテンプレートの必須アイテムをスロットにする）"),
+    limit: int = Query(5, ge=1, le=20, description="返すコーディネートの件数")
+):
+    """
+    予算内のコーディネート一式を提案
+
+    スロット（デフォルトはトップス・パンツ・靴）ごとに1点ずつ選び、合計価格が予算以内で
+    モテる度スコアの合計が高い組み合わせを上位から返す。
+
+    - **budget**: 予算（合計価格の上限）
+    - **scene**: シーン
+    - **style**: スタイル
+    - **season**: 季節
+    - **template_id**: テンプレートID（シーン・スタイル・季節が未指定の場合はテンプレートの値を使う）
+    - **limit**: 返すコーディネートの件数
+    """
+    catalog = get_catalog()
+
+    cache_key = QueryCache.make_key(
+        catalog.version,
+        budget=budget, scene=scene, style=style, season=season, template_id=template_id, limit=limit,
+    )
+    cached = _outfit_cache.get(cache_key)
+    if cached is not None:
+        return FragmentJSONResponse(cached)
+
+    slot_names: List[str] = list(DEFAULT_OUTFIT_SLOTS)
+    if template_id:
+        template = next((t for t in catalog.templates if t.get("template_id") == template_id), None)
+        if not template:
+            raise HTTPException(status_code=404, detail="Template not found")
+        slot_names = [item.get("item_type", "") for item in template.get("items", []) if item.get("required")]
+        scene = scene or template.get("scene")
+        style = style or template.get("style")
+        season = season or template.get("season")
+
+    columns = catalog.columns
+
+    # 在庫（情報がない商品は在庫ありとして扱う）・予算・シーン・スタイル・季節で候補を絞り込む
+    mask = columns.flag_truthy_or_missing("in_stock")
+    mask = columns.price_between(mask, max_price=budget)
+    attribute_filters = {}
+    if scene:
+        attribute_filters["scene"] = scene
+    if style:
+        attribute_filters["style"] = style
+    if season:
+        attribute_filters["season"] = season
+    candidates = catalog.attributes.match(attribute_filters)
+
+    slots = [
+        bitmap_to_mask(item_type_bitmap(catalog.attributes, catalog.ngrams, name) & candidates, columns.size) & mask
+        for name in slot_names
+    ]
+    outfits = solve_outfits(
+        [np.flatnonzero(slot) for slot in slots],
+        columns.price,
+        columns.moteru_score,
+        budget,
+        limit,
+    )
+
+    # レスポンス用のデータ（エンコード済みの商品サマリーにスロット名を差し込む）
+    response_outfits = []
+    for outfit in outfits:
+        response_outfits.append({
+            "total_price": round(outfit.total_price),
+            "total_moteru_score": round(outfit.total_score, 2),
+            "items": [
+                catalog.summaries.fragment(position, encode_members(slot=name))
+                for name, position in zip(slot_names, outfit.positions)
+            ],
+        })
+
+    body = dumps({
+        "count": len(response_outfits),
+        "budget": budget,
+        "slots": slot_names,
+        "outfits": response_outfits,
+    })
+    _outfit_cache.put(cache_key, body)
+    return FragmentJSONResponse(body)
@@ -1,24 +1,41 @@
 """
 商品検索・推薦関連のAPI
 """
-import json
-from pathlib import Path
-from fastapi import APIRouter, HTTPException, Query
-from typing import List, Optional
+import random
+import numpy as np
+from dataclasses import asdict, dataclass, replace
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from typing import Dict, Iterator, List, Optional
 from enum import Enum
+from pydantic import BaseModel
+from app.api.utils.catalog_store import CatalogSnapshot, get_catalog
+from app.api.utils.http_cache import CacheValidators, make_etag, not_modified_response
+from app.api.utils.json_fragments import FragmentJSONResponse, dumps, encode_members, fragment
+from app.api.utils.negative_cache import NegativeCache
+from app.api.utils.query_cache import QueryCache
+from app.api.utils.catalog_columns import bitmap_to_mask, mask_to_bitmap
+from app.api.utils.catalog_ngram import KEYWORD_FIELDS, PURPOSE_FIELDS, normalize_text
+from app.api.utils.catalog_order import InvalidCursor
+from app.api.utils.ranking import TopK, iter_mask_chunks
 
 router = APIRouter(prefix="/api/products", tags=["products"])
 
-# 商品ファイルのパス
-BASE_DIR = Path(__file__).parent.parent.parent.parent.parent
-PRODUCTS_FILE = BASE_DIR / "data" / "products" / "products.json"
+# 検索・推薦結果のキャッシュ
+_search_cache = QueryCache("products.search")
+_recommend_cache = QueryCache("products.recommend")
+_facets_cache = QueryCache("products.facets")
 
-# デバッグ用: パスを確認
-if not PRODUCTS_FILE.exists():
-    # 代替パスを試す
-    alt_path = Path(__file__).parent.parent.parent.parent / "data" / "products" / "products.json"
-    if alt_path.exists():
-        PRODUCTS_FILE = alt_path
+# ファセット名 → (絞り込み条件の項目, 転置インデックスのフィールド)
+FACET_FIELDS = {
+    "category": ("category", "category"),
+    "brand": ("brand", "brand"),
+    "color": ("color", "colors"),
+    "size": ("size", "sizes"),
+    "scene": ("scene", "scene"),
+    "style": ("style", "style"),
+    "season": ("season", "season"),
+}
 
 
 class SortOrder(str, Enum):
@@ -29,20 +46,32 @@ class SortOrder(str, Enum):
     CREATED_AT_DESC = "created_at_desc"
 
 
-def load_products():
-    """商品データを読み込む"""
-    try:
-        with open(PRODUCTS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return data.get("products", [])
-    except FileNotFoundError:
-        return []
-    except json.JSONDecodeError:
-        return []
+@dataclass(frozen=True)
+class SearchFilters:
+    """商品検索の絞り込み条件（検索APIとエクスポートAPIで共通）"""
+    category: Optional[str] = None
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+    color: Optional[str] = None
+    size: Optional[str] = None
+    brand: Optional[str] = None
+    returnable: Optional[bool] = None
+    in_stock: Optional[bool] = None
+    min_moteru_score: Optional[float] = None
+    scene: Optional[str] = None
+    style: Optional[str] = None
+    season: Optional[str] = None
+    keyword: Optional[str] = None
 
+    def cache_params(self) -> dict:
+        """キャッシュキー用の条件（キーワードは検索時と同じ正規化をする）"""
+        params = asdict(self)
+        if self.keyword:
+            params["keyword"] = normalize_text(self.keyword)
+        return params
 
-@router.get("/search")
-async def search_products(
+
+def search_filters(
     category: Optional[str] = Query(None, description="カテゴリ（パンツ、トップス、靴など）"),
     min_price: Optional[int] = Query(None, description="最小価格"),
     max_price: Optional[int] = Query(None, description="最大価格"),
@@ -55,10 +84,75 @@ async def search_products(
     scene: Optional[str] = Query(None, description="シーン（デート、仕事、カジュアルなど）"),
     style: Optional[str] = Query(None, description="スタイル（カジュアル、ビジネス、ストリートなど）"),
     season: Optional[str] = Query(None, description="季節（春、夏、秋、冬）"),
-    keyword: Optional[str] = Query(None, description="キーワード検索"),
+    keyword: Optional[str] = Query(None, description="キーワード検索")
+) -> SearchFilters:
+    """クエリパラメータから商品検索の絞り込み条件を作る"""
+    return SearchFilters(
+        category=category,
+        min_price=min_price,
+        max_price=max_price,
+        color=color,
+        size=size,
+        brand=brand,
+        returnable=returnable,
+        in_stock=in_stock,
+        min_moteru_score=min_moteru_score,
+        scene=scene,
+        style=style,
+        season=season,
+        keyword=keyword,
+    )
+
+
+def _search_mask(catalog: CatalogSnapshot, filters: SearchFilters) -> np.ndarray:
+    """絞り込み条件に一致する商品のマスク"""
+    columns = catalog.columns
+    
+    # 数値・真偽値・カテゴリの条件は列指向のマスク演算で絞り込む
+    mask = columns.all()
+    if filters.category:
+        mask &= columns.equals("category", filters.category)
+    if filters.returnable is not None:
+        mask &= columns.flag_is("returnable", filters.returnable)
+    if filters.in_stock is not None:
+        mask &= columns.flag_is("in_stock", filters.in_stock)
+    mask = columns.price_between(mask, filters.min_price, filters.max_price)
+    mask = columns.score_at_least(mask, "moteru_score", filters.min_moteru_score)
+    
+    # 複数値の属性条件は転置インデックスのビットマップの論理積で絞り込む
+    attribute_filters = {}
+    if filters.color:
+        attribute_filters["colors"] = filters.color
+    if filters.size:
+        attribute_filters["sizes"] = filters.size
+    if filters.scene:
+        attribute_filters["scene"] = filters.scene
+    if filters.style:
+        attribute_filters["style"] = filters.style
+    if filters.season:
+        attribute_filters["season"] = filters.season
+    
+    candidates = None
+    if filters.brand:
+        # ブランドは部分一致のため、該当するブランド値のビットマップを合成する
+        candidates = catalog.attributes.lookup_substring("brand", filters.brand)
+    if filters.keyword:
+        # キーワードはN-gramインデックスで部分一致検索する
+        keyword_matches = catalog.ngrams.search(filters.keyword, KEYWORD_FIELDS)
+        candidates = keyword_matches if candidates is None else candidates & keyword_matches
+    if attribute_filters or candidates is not None:
+        candidates = catalog.attributes.match(attribute_filters, candidates)
+        mask &= bitmap_to_mask(candidates, columns.size)
+    return mask
+
+
+@router.get("/search")
+async def search_products(
+    filters: SearchFilters = Depends(search_filters),
     sort: Optional[SortOrder] = Query(SortOrder.MOTERU_SCORE_DESC, description="ソート順"),
     page: int = Query(1, ge=1, description="ページ番号"),
-    limit: int = Query(20, ge=1, le=100, description="1ページあたりの件数")
+    limit: int = Query(20, ge=1, le=100, description="1ページあたりの件数"),
+    cursor: Optional[str] = Query(None, description="次ページのカーソル（前回レスポンスのnext_cursor）")
 ):
     """
     商品検索API
@@ -79,131 +173,149 @@ async def search_products(
     - **sort**: ソート順（price_asc, price_desc, moteru_score_desc, created_at_desc）
     - **page**: ページ番号
     - **limit**: 1ページあたりの件数
+    - **cursor**: 次ページのカーソル（指定時はpageより優先。深いページでも高速に取得できる）
     """
-    products = load_products()
+    catalog = get_catalog()
     
-    # フィルタリング
-    filtered_products = []
-    
-    for product in products:
-        # カテゴリでフィルタリング
-        if category and product.get("category") != category:
-            continue
-        
-        # 価格でフィルタリング
-        price = product.get("price", 0)
-        if min_price is not None and price < min_price:
-            continue
-        if max_price is not None and price > max_price:
-            continue
-        
-        # カラーでフィルタリング
-        if color and color not in product.get("colors", []):
-            continue
-        
-        # サイズでフィルタリング
-        if size and size not in product.get("sizes", []):
-            continue
-        
-        # ブランドでフィルタリング
-        if brand and brand not in product.get("brand", ""):
-            continue
-        
-        # 返品可否でフィルタリング
-        if returnable is not None and product.get("returnable") != returnable:
-            continue
-        
-        # 在庫状況でフィルタリング
-        if in_stock is not None and product.get("in_stock") != in_stock:
-            continue
-        
-        # モテる度でフィルタリング
-        moteru_score = product.get("evaluation", {}).get("moteru_score", 0)
-        if min_moteru_score is not None and moteru_score < min_moteru_score:
-            continue
-        
-        # シーンでフィルタリング
-        if scene:
-            attributes = product.get("attributes", {})
-            scenes = attributes.get("scene", [])
-            if scene not in scenes:
-                continue
-        
-        # スタイルでフィルタリング
-        if style:
-            attributes = product.get("attributes", {})
-            styles = attributes.get("style", [])
-            if style not in styles:
-                continue
-        
-        # 季節でフィルタリング
-        if season:
-            attributes = product.get("attributes", {})
-            seasons = attributes.get("season", [])
-            if season not in seasons:
-                continue
-        
-        # キーワードでフィルタリング
-        if keyword:
-            keyword_lower = keyword.lower()
-            name = product.get("name", "").lower()
-            description = product.get("description", "").lower()
-            brand_name = product.get("brand", "").lower()
-            
-            if (keyword_lower not in name and 
-                keyword_lower not in description and 
-                keyword_lower not in brand_name):
-                continue
-        
-        filtered_products.append(product)
-    
-    # ソート
-    if sort == SortOrder.PRICE_ASC:
-        filtered_products.sort(key=lambda p: p.get("price", 0))
-    elif sort == SortOrder.PRICE_DESC:
-        filtered_products.sort(key=lambda p: p.get("price", 0), reverse=True)
-    elif sort == SortOrder.MOTERU_SCORE_DESC:
-        filtered_products.sort(
-            key=lambda p: p.get("evaluation", {}).get("moteru_score", 0), 
-            reverse=True
-        )
-    elif sort == SortOrder.CREATED_AT_DESC:
-        filtered_products.sort(
-            key=lambda p: p.get("created_at", ""), 
-            reverse=True
-        )
+    # 同じ検索条件の結果はキャッシュから返す
+    cache_key = QueryCache.make_key(
+        catalog.products_version,
+        **filters.cache_params(),
+        sort=sort or SortOrder.MOTERU_SCORE_DESC, page=page, limit=limit, cursor=cursor or None,
+    )
+    cached = _search_cache.get(cache_key)
+    if cached is not None:
+        return FragmentJSONResponse(cached)
+    
+    mask = _search_mask(catalog, filters)
+    total_count = int(np.count_nonzero(mask))
+    
+    # ソート済みの並びをたどって、ページ分だけ取り出す
+    sort_order = (sort or SortOrder.MOTERU_SCORE_DESC).value
+    order = catalog.orders[sort_order]
+    start_rank, skip = 0, (page - 1) * limit
+    if cursor:
+        try:
+            start_rank = catalog.orders.decode_cursor(sort_order, catalog.products_version, cursor)
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        skip = 0
+    positions, last_rank = order.page(mask, total_count, start_rank, skip, limit)
     
     # ページネーション
-    total_count = len(filtered_products)
     total_pages = (total_count + limit - 1) // limit
-    start = (page - 1) * limit
-    end = start + limit
-    paginated_products = filtered_products[start:end]
+    next_cursor = None
+    if last_rank is not None and len(positions) == limit:
+        next_cursor = catalog.orders.encode_cursor(sort_order, catalog.products_version, last_rank)
     
-    # レスポンス用のデータを整形
-    response_products = []
-    for product in paginated_products:
-        response_products.append({
-            "product_id": product.get("product_id"),
-            "name": product.get("name"),
-            "category": product.get("category"),
-            "brand": product.get("brand"),
-            "price": product.get("price"),
-            "image_url": product.get("image_url"),
-            "moteru_score": product.get("evaluation", {}).get("moteru_score"),
-            "returnable": product.get("returnable"),
-            "in_stock": product.get("in_stock"),
-            "url": product.get("url"),
-            "affiliate_url": product.get("affiliate_url")
-        })
+    # レスポンス用のデータ（エンコード済みの商品サマリーを連結する）
+    response_products = [catalog.summaries.fragment(position) for position in positions]
     
-    return {
+    body = dumps({
         "count": total_count,
         "page": page,
         "limit": limit,
         "total_pages": total_pages,
+        "next_cursor": next_cursor,
         "products": response_products
-    }
+    })
+    _search_cache.put(cache_key, body)
+    return FragmentJSONResponse(body)
+
+
+def _export_lines(catalog: CatalogSnapshot, mask: np.ndarray, sort_order: str, full: bool) -> Iterator[bytes]:
+    """エクスポートするNDJSONの行を、並び順に区間ごとにまとめて生成する"""
+    products = catalog.products
+    for positions in catalog.orders[sort_order].iter_chunks(mask):
+        if full:
+            lines = [fragment(products[position]) for position in positions.tolist()]
+        else:
+            lines = [catalog.summaries.fragment(position) for position in positions.tolist()]
+        yield b"\n".join(lines) + b"\n"
+
+
+@router.get("/export")
+async def export_products(
+    filters: SearchFilters = Depends(search_filters),
+    sort: Optional[SortOrder] = Query(SortOrder.MOTERU_SCORE_DESC, description="ソート順"),
+    full: bool = Query(False, description="商品データをすべての項目で出力する（falseの場合は検索結果と同じ項目）")
+):
+    """
+    商品エクスポートAPI（NDJSON）
+    
+    検索APIと同じ絞り込み条件に一致する商品を、ページ分割せずに1行1商品のNDJSONで返す。
+    レスポンスは区間ごとに逐次送信するため、カタログ全体でも一定のメモリで出力できる。
+    
+    - 絞り込み条件: 検索APIと同じ（category, min_price, max_price, color, size, brand, returnable,
+      in_stock, min_moteru_score, scene, style, season, keyword）
+    - **sort**: ソート順（price_asc, price_desc, moteru_score_desc, created_at_desc）
+    - **full**: 商品データをすべての項目で出力する
+    """
+    # エクスポート中にカタログが読み込み直されても、開始時のスナップショットで出力し続ける
+    catalog = get_catalog()
+    mask = _search_mask(catalog, filters)
+    sort_order = (sort or SortOrder.MOTERU_SCORE_DESC).value
+    
+    return StreamingResponse(
+        _export_lines(catalog, mask, sort_order, full),
+        media_type="application/x-ndjson",
+        headers={
+            "X-Total-Count": str(int(np.count_nonzero(mask))),
+            "X-Catalog-Version": catalog.products_version,
+        },
+    )
+
+
+def _facet_counts(catalog: CatalogSnapshot, filters: SearchFilters) -> Dict[str, List[dict]]:
+    """
+    ファセットごとの属性値の件数
+
+    各ファセットは自身の条件だけを外した絞り込み結果に対して数える（選択中の値以外の件数も表示できるように）。
+    件数は絞り込み結果のビットマップと属性値ごとのビットマップの論理積を数えるだけで、商品は走査しない。
+    """
+    base_bitmap = None
+    facets = {}
+    for name, (param, field) in FACET_FIELDS.items():
+        if getattr(filters, param):
+            bitmap = mask_to_bitmap(_search_mask(catalog, replace(filters, **{param: None})))
+        else:
+            # 自身の条件が未指定のファセットは、同じ絞り込み結果を共有する
+            if base_bitmap is None:
+                base_bitmap = mask_to_bitmap(_search_mask(catalog, filters))
+            bitmap = base_bitmap
+        counts = catalog.attributes.counts(field, bitmap)
+        facets[name] = [
+            {"value": value, "count": count}
+            for value, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+            if value != ""
+        ]
+    return facets
+
+
+@router.get("/facets")
+async def get_facets(filters: SearchFilters = Depends(search_filters)):
+    """
+    ファセット件数API（絞り込みサイドバー用）
+    
+    検索APIと同じ絞り込み条件に対して、カテゴリ・ブランド・カラー・サイズ・シーン・スタイル・季節の
+    値ごとの件数を返す。各ファセットの件数は、そのファセット自身の条件を外して数える。
+    
+    - 絞り込み条件: 検索APIと同じ（category, min_price, max_price, color, size, brand, returnable,
+      in_stock, min_moteru_score, scene, style, season, keyword）
+    """
+    catalog = get_catalog()
+    
+    cache_key = QueryCache.make_key(catalog.products_version, **filters.cache_params())
+    cached = _facets_cache.get(cache_key)
+    if cached is not None:
+        return FragmentJSONResponse(cached)
+    
+    body = dumps({
+        "count": int(np.count_nonzero(_search_mask(catalog, filters))),
+        "facets": _facet_counts(catalog, filters),
+    })
+    _facets_cache.put(cache_key, body)
+    return FragmentJSONResponse(body)
 
 
 @router.get("/recommend")
@@ -242,209 +354,149 @@ async def recommend_products(
     - **fit**: フィット感（スリム、レギュラー、オーバーサイズ、ルーズ）
     - **limit**: 推薦商品数（デフォルト: 10、最大: 20）
     """
-    products = load_products()
-    
-    # フィルタリング
-    candidate_products = []
-    
-    for product in products:
-        # 在庫チェック（在庫なしは除外）
-        if not product.get("in_stock", True):
-            continue
-        
-        # 価格でフィルタリング
-        price = product.get("price", 0)
-        if max_price is not None and price > max_price:
-            continue
-        
-        # モテる度でフィルタリング
-        moteru_score = product.get("evaluation", {}).get("moteru_score", 0)
-        if moteru_score < min_moteru_score:
-            continue
-        
-        # カテゴリでフィルタリング
-        if category and product.get("category") != category:
-            continue
-        
-        # シーンでフィルタリング
-        if scene:
-            attributes = product.get("attributes", {})
-            scenes = attributes.get("scene", [])
-            if scene not in scenes:
-                continue
-        
-        # スタイルでフィルタリング
-        if style:
-            attributes = product.get("attributes", {})
-            styles = attributes.get("style", [])
-            if style not in styles:
-                continue
-        
-        # 季節でフィルタリング
-        if season:
-            attributes = product.get("attributes", {})
-            seasons = attributes.get("season", [])
-            if season not in seasons:
-                continue
-        
-        # 用途（purpose）でフィルタリング（キーワードマッチング）
-        if purpose:
-            purpose_lower = purpose.lower()
-            name = product.get("name", "").lower()
-            description = product.get("description", "").lower()
-            brand = product.get("brand", "").lower()
-            attributes = product.get("attributes", {})
-            scenes = [s.lower() for s in attributes.get("scene", [])]
-            styles = [s.lower() for s in attributes.get("style", [])]
-            
-            # 用途キーワードが商品情報に含まれているかチェック
-            keyword_match = (
-                purpose_lower in name or
-                purpose_lower in description or
-                purpose_lower in brand or
-                any(purpose_lower in s for s in scenes) or
-                any(purpose_lower in s for s in styles)
-            )
-            
-            if not keyword_match:
-                continue
-        
-        # 体型・サイズでフィルタリング（オプション）
-        body_match_score = 1.0  # デフォルトは完全一致
-        
-        # サイズでフィルタリング
-        if size:
-            product_sizes = product.get("sizes", [])
-            if product_sizes and size not in product_sizes:
-                continue  # サイズが一致しない場合は除外
-        
-        # フィット感でフィルタリング
-        if fit:
-            attributes = product.get("attributes", {})
-            product_fit = attributes.get("fit", "")
-            if product_fit and fit.lower() not in product_fit.lower():
-                # 完全一致しない場合でも、類似性を考慮
-                if fit == "スリム" and "レギュラー" in product_fit:
-                    body_match_score *= 0.8  # 少し減点
-                elif fit == "オーバーサイズ" and "ルーズ" in product_fit:
-                    body_match_score *= 0.8  # 少し減点
-                elif fit.lower() not in product_fit.lower():
-                    continue  # 全く一致しない場合は除外
-        
-        candidate_products.append({
-            "product": product,
-            "body_match_score": body_match_score
-        })
-    
-    # 体型に基づく推薦スコアを計算
-    def calculate_body_type_score(product: dict, body_type: Optional[str], height: Optional[int], weight: Optional[int]) -> float:
-        """体型に基づくスコアを計算（0.0-1.0）"""
-        if not body_type and not height and not weight:
-            return 1.0  # 体型情報がない場合は完全一致
-        
-        score = 1.0
-        attributes = product.get("attributes", {})
-        product_fit = attributes.get("fit", "")
-        evaluation = product.get("evaluation", {})
-        
-        # 体型別の推奨フィット感
-        body_type_fit_preferences = {
-            "細身": ["スリム", "レギュラー"],
-            "標準": ["レギュラー", "スリム"],
-            "がっちり": ["レギュラー", "ルーズ", "オーバーサイズ"],
-            "小柄": ["スリム", "レギュラー"]
-        }
-        
-        if body_type and body_type in body_type_fit_preferences:
-            preferred_fits = body_type_fit_preferences[body_type]
-            if product_fit:
-                if any(fit.lower() in product_fit.lower() for fit in preferred_fits):
-                    score = 1.0  # 推奨フィット感と一致
-                else:
-                    score = 0.7  # 推奨フィット感と一致しない（少し減点）
-        
-        # 身長・体重に基づく調整（簡易版）
-        if height and weight:
-            bmi = weight / ((height / 100) ** 2) if height > 0 else 0
-            if bmi < 18.5:  # やせ型
-                if "スリム" in product_fit or "レギュラー" in product_fit:
-                    score *= 1.0
-                else:
-                    score *= 0.8
-            elif bmi > 25:  # 肥満型
-                if "ルーズ" in product_fit or "オーバーサイズ" in product_fit:
-                    score *= 1.0
-                else:
-                    score *= 0.8
-        
-        return score
-    
-    # モテる度でソート（降順）
-    candidate_products.sort(
-        key=lambda item: item["product"].get("evaluation", {}).get("moteru_score", 0),
-        reverse=True
+    catalog = get_catalog()
+    products = catalog.products
+    
+    # 同じ条件の推薦結果はキャッシュから返す
+    cache_key = QueryCache.make_key(
+        catalog.products_version,
+        purpose=purpose, max_price=max_price, category=category, scene=scene, style=style,
+        season=season, min_moteru_score=min_moteru_score, body_type=body_type, height=height,
+        weight=weight, size=size, fit=fit, limit=limit,
     )
-    
-    # 価格も考慮した推薦スコアを計算（モテる度 × 価格効率 × 体型マッチ）
-    scored_products = []
-    for item in candidate_products:
-        product = item["product"]
-        body_match_score = item["body_match_score"]
-        moteru_score = product.get("evaluation", {}).get("moteru_score", 0)
-        price = product.get("price", 0)
-        
-        # 体型スコアを計算
-        body_type_score = calculate_body_type_score(product, body_type, height, weight)
-        combined_body_score = body_match_score * body_type_score
+    cached = _recommend_cache.get(cache_key)
+    if cached is not None:
+        return FragmentJSONResponse(cached)
+    
+    columns = catalog.columns
+    
+    # 在庫・価格・モテる度・カテゴリは列指向のマスク演算で絞り込む
+    # 在庫情報がない商品は在庫ありとして扱う
+    mask = columns.flag_truthy_or_missing("in_stock")
+    mask = columns.price_between(mask, max_price=max_price)
+    mask = columns.score_at_least(mask, "moteru_score", min_moteru_score)
+    if category:
+        mask &= columns.equals("category", category)
+    
+    # シーン・スタイル・季節は転置インデックスで絞り込む
+    attribute_filters = {}
+    if scene:
+        attribute_filters["scene"] = scene
+    if style:
+        attribute_filters["style"] = style
+    if season:
+        attribute_filters["season"] = season
+    candidates = None
+    if purpose:
+        # 用途はN-gramインデックスで商品情報・シーン・スタイルを部分一致検索する
+        candidates = catalog.ngrams.search(purpose, PURPOSE_FIELDS)
+    if attribute_filters or candidates is not None:
+        candidates = catalog.attributes.match(attribute_filters, candidates)
+        mask &= bitmap_to_mask(candidates, columns.size)
+    
+    # サイズでフィルタリング（サイズ情報がない商品は除外しない）
+    if size:
+        mask &= columns.sizes_empty | bitmap_to_mask(catalog.attributes.lookup("sizes", size), columns.size)
+    
+    # フィット感・体型のスコアは、商品のフィット感の値ごとに一度だけ計算して配列に展開する
+    fit_values = columns.vocabularies["fit"]
+    fit_match_by_code = np.array([_fit_match_score(value, fit) for value in fit_values], dtype=np.float64)
+    body_type_by_code = np.array([_body_type_score(value, body_type, height, weight) for value in fit_values], dtype=np.float64)
+    
+    # フィット感が全く一致しない商品は除外
+    mask &= fit_match_by_code[columns.codes["fit"]] > 0
+    
+    # 絞り込み結果を区間ごとに評価し、推薦スコアの上位limit件だけを保持する
+    # （同点はモテる度の高い順、さらに同点はカタログ順）
+    top = TopK(limit)
+    for chunk in iter_mask_chunks(mask):
+        # 推薦スコアを配列演算でまとめて計算（モテる度 × 価格効率 × 体型マッチ）
+        fit_codes = columns.codes["fit"][chunk]
+        moteru_scores = columns.moteru_score[chunk]
+        prices = columns.price[chunk]
+        combined_body_scores = fit_match_by_code[fit_codes] * body_type_by_code[fit_codes]
         
-        # 推薦スコア = モテる度 × (価格効率の重み付け) × (体型マッチの重み付け)
         # 価格効率: 価格が低いほど高い（最大価格が指定されている場合はその範囲内で評価）
         if max_price:
-            price_efficiency = 1.0 - (price / max_price) * 0.3  # 価格が高いほど少し減点（最大30%減点）
+            price_efficiency = 1.0 - (prices / max_price) * 0.3  # 価格が高いほど少し減点（最大30%減点）
         else:
-            price_efficiency = 1.0 / (1.0 + price / 50000)  # 価格が高いほど減点
+            price_efficiency = 1.0 / (1.0 + prices / 50000)  # 価格が高いほど減点
         
         # スコア計算: モテる度70%、価格効率15%、体型マッチ15%
-        recommendation_score = moteru_score * (0.7 + price_efficiency * 0.15 + combined_body_score * 0.15)
-        
-        scored_products.append({
-            "product": product,
-            "recommendation_score": recommendation_score,
-            "body_match_score": combined_body_score
-        })
+        recommendation_scores = moteru_scores * (0.7 + price_efficiency * 0.15 + combined_body_scores * 0.15)
+        top.push(chunk, recommendation_scores, tiebreak=moteru_scores)
     
-    # 推薦スコアでソート（降順）
-    scored_products.sort(key=lambda x: x["recommendation_score"], reverse=True)
-    
-    # 指定された件数まで取得
-    recommended_products = scored_products[:limit]
-    
-    # レスポンス用のデータを整形
+    # レスポンス用のデータ（エンコード済みの商品サマリーに推薦スコアと推薦理由を差し込む）
     response_products = []
-    for item in recommended_products:
-        product = item["product"]
-        response_products.append({
-            "product_id": product.get("product_id"),
-            "name": product.get("name"),
-            "category": product.get("category"),
-            "brand": product.get("brand"),
-            "price": product.get("price"),
-            "image_url": product.get("image_url"),
-            "moteru_score": product.get("evaluation", {}).get("moteru_score"),
-            "recommendation_score": round(item["recommendation_score"], 2),
-            "recommendation_reason": _generate_recommendation_reason(product, purpose, scene, style, body_type, fit),
-            "returnable": product.get("returnable"),
-            "in_stock": product.get("in_stock"),
-            "url": product.get("url"),
-            "affiliate_url": product.get("affiliate_url")
-        })
+    for position, score in zip(top.ids.tolist(), top.scores.tolist()):
+        extra = encode_members(
+            recommendation_score=round(score, 2),
+            recommendation_reason=_generate_recommendation_reason(products[position], purpose, scene, style, body_type, fit),
+        )
+        response_products.append(catalog.summaries.fragment(position, extra))
     
-    return {
+    body = dumps({
         "count": len(response_products),
         "purpose": purpose,
         "max_price": max_price,
         "products": response_products
-    }
+    })
+    _recommend_cache.put(cache_key, body)
+    return FragmentJSONResponse(body)
+
+
+# 体型別の推奨フィット感
+BODY_TYPE_FIT_PREFERENCES = {
+    "細身": ["スリム", "レギュラー"],
+    "標準": ["レギュラー", "スリム"],
+    "がっちり": ["レギュラー", "ルーズ", "オーバーサイズ"],
+    "小柄": ["スリム", "レギュラー"]
+}
+
+
+def _fit_match_score(product_fit: str, fit: Optional[str]) -> float:
+    """希望のフィット感との一致度を計算（0.0は除外）"""
+    if not fit or not product_fit or fit.lower() in product_fit.lower():
+        return 1.0  # デフォルトは完全一致
+    
+    # 完全一致しない場合でも、類似性を考慮
+    if fit == "スリム" and "レギュラー" in product_fit:
+        return 0.8  # 少し減点
+    if fit == "オーバーサイズ" and "ルーズ" in product_fit:
+        return 0.8  # 少し減点
+    return 0.0  # 全く一致しない場合は除外
+
+
+def _body_type_score(product_fit: str, body_type: Optional[str], height: Optional[int], weight: Optional[int]) -> float:
+    """体型に基づくスコアを計算（0.0-1.0）"""
+    if not body_type and not height and not weight:
+        return 1.0  # 体型情報がない場合は完全一致
+    
+    score = 1.0
+    
+    if body_type and body_type in BODY_TYPE_FIT_PREFERENCES:
+        preferred_fits = BODY_TYPE_FIT_PREFERENCES[body_type]
+        if product_fit:
+            if any(fit.lower() in product_fit.lower() for fit in preferred_fits):
+                score = 1.0  # 推奨フィット感と一致
+            else:
+                score = 0.7  # 推奨フィット感と一致しない（少し減点）
+    
+    # 身長・体重に基づく調整（簡易版）
+    if height and weight:
+        bmi = weight / ((height / 100) ** 2) if height > 0 else 0
+        if bmi < 18.5:  # やせ型
+            if "スリム" in product_fit or "レギュラー" in product_fit:
+                score *= 1.0
+            else:
+                score *= 0.8
+        elif bmi > 25:  # 肥満型
+            if "ルーズ" in product_fit or "オーバーサイズ" in product_fit:
+                score *= 1.0
+            else:
+                score *= 0.8
+    
+    return score
 
 
 def _generate_recommendation_reason(product: dict, purpose: Optional[str], scene: Optional[str], style: Optional[str], body_type: Optional[str] = None, fit: Optional[str] = None) -> str:
@@ -495,26 +547,157 @@ def _generate_recommendation_reason(product: dict, purpose: Optional[str], scene
     return "・".join(reasons)
 
 
+# 存在しない商品IDのネガティブキャッシュ（ボットによる存在しないIDの探索対策）
+_missing_products = NegativeCache(maxsize=10000, ttl=300.0)
+
+# 404レスポンスの本文（HTTPExceptionと同じ内容）
+_PRODUCT_NOT_FOUND_BODY = b'{"detail":"Product not found"}'
+
+
+def _product_not_found_response() -> Response:
+    """ネガティブキャッシュに該当した場合の404レスポンス"""
+    return Response(content=_PRODUCT_NOT_FOUND_BODY, status_code=404, media_type="application/json")
+
+
+# 一括取得で指定できる商品IDの上限
+BATCH_MAX_IDS = 200
+
+
+class BatchFields(str, Enum):
+    """一括取得で返す項目"""
+    SUMMARY = "summary"
+    FULL = "full"
+
+
+class BatchLookupRequest(BaseModel):
+    ids: List[str]
+    fields: BatchFields = BatchFields.FULL
+
+
+def _batch_lookup(product_ids: List[str], fields: BatchFields) -> FragmentJSONResponse:
+    """商品IDの一覧を指定順に解決する（重複したIDは最初の1件のみ）"""
+    if len(product_ids) > BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"一度に指定できる商品IDは{BATCH_MAX_IDS}件までです")
+    
+    catalog = get_catalog()
+    products = []
+    missing = []
+    for product_id in dict.fromkeys(product_ids):
+        position = catalog.product_positions.get(product_id)
+        if position is None:
+            missing.append(product_id)
+        elif fields == BatchFields.SUMMARY:
+            products.append(catalog.summaries.fragment(position))
+        else:
+            products.append(fragment(catalog.products[position]))
+    
+    return FragmentJSONResponse(dumps({
+        "count": len(products),
+        "products": products,
+        "missing": missing,
+    }))
+
+
+@router.get("/batch")
+async def get_products_batch(
+    ids: str = Query(..., description="商品IDのカンマ区切り（例: PROD_001,PROD_002）"),
+    fields: BatchFields = Query(BatchFields.FULL, description="返す項目（summary: 一覧と同じ項目, full: すべての項目）")
+):
+    """
+    商品の一括取得（カート・お気に入り・最近見た商品の表示用）
+    
+    - **ids**: 商品IDのカンマ区切り（最大200件）
+    - **fields**: 返す項目（summary, full）
+    
+    商品は指定した順に返し、見つからなかったIDは missing に入れる。
+    """
+    product_ids = [product_id.strip() for product_id in ids.split(",") if product_id.strip()]
+    return _batch_lookup(product_ids, fields)
+
+
+@router.post("/batch")
+async def post_products_batch(request: BatchLookupRequest):
+    """
+    商品の一括取得（IDが多くURLに収まらない場合用）
+    
+    - **ids**: 商品IDのリスト（最大200件）
+    - **fields**: 返す項目（summary, full）
+    """
+    return _batch_lookup(request.ids, request.fields)
+
+
 @router.get("/{product_id}")
-async def get_product(product_id: str):
+async def get_product(product_id: str, request: Request, response: Response):
     """
     特定の商品を取得
     
     - **product_id**: 商品ID（例: PROD_001）
+    
+    ETag / Last-Modified を返し、条件付きリクエストが一致すれば 304 を返す。
     """
-    products = load_products()
+    catalog = get_catalog()
     
-    product = next(
-        (p for p in products if p.get("product_id") == product_id),
-        None
-    )
+    # 存在しないIDへの繰り返しの問い合わせは、ネガティブキャッシュで即座に404を返す
+    if _missing_products.contains(catalog.products_version, product_id):
+        return _product_not_found_response()
+    
+    product = catalog.get_product(product_id)
     
     if not product:
+        _missing_products.add(catalog.products_version, product_id)
         raise HTTPException(status_code=404, detail="Product not found")
     
+    # 商品データが更新されていなければ、本文を返さずに 304 を返す
+    # （存在しないIDに 304 を返さないよう、存在を確認してから判定する）
+    validators = CacheValidators(
+        etag=make_etag("product", catalog.products_version, product_id),
+        last_modified=catalog.products_mtime,
+    )
+    not_modified = not_modified_response(request, validators)
+    if not_modified is not None:
+        return not_modified
+    
+    validators.apply(response)
     return product
 
 
+def _related_product_view(product: dict) -> dict:
+    """
+    関連商品のレスポンス用のコピーを作る（共有スナップショットは書き換えない）
+    
+    在庫数・レビューは商品データになければ仮の値を補う（実際のデータでは商品データから取得）。
+    仮の値は商品IDから決まる乱数で生成するため、同じ商品には毎回同じ値を返す。
+    """
+    view = dict(product)
+    rng = random.Random(f"{view.get('product_id')}")
+    if "stock_quantity" not in view:
+        view["stock_quantity"] = rng.randint(1, 50)  # 1-50の在庫数
+    if "reviews" not in view:
+        review_count = rng.randint(5, 50)
+        avg_rating = round(rng.uniform(3.5, 5.0), 1)
+        view["reviews"] = {
+            "count": review_count,
+            "average_rating": avg_rating,
+            "rating_distribution": {
+                "5": rng.randint(review_count // 2, review_count),
+                "4": rng.randint(0, review_count // 4),
+                "3": rng.randint(0, review_count // 10),
+                "2": rng.randint(0, review_count // 20),
+                "1": rng.randint(0, review_count // 20)
+            }
+        }
+    return view
+
+
+def _frequently_bought_together(source_id: str, product_id: str) -> dict:
+    """一緒に購入された商品の情報（商品の組み合わせから決まる仮の値）"""
+    rng = random.Random(f"{source_id}:{product_id}")
+    return {
+        "percentage": rng.randint(60, 90),  # 60-90%の人が一緒に購入
+        "count": rng.randint(100, 500)  # 100-500人が一緒に購入
+    }
+
+
 @router.get("/{product_id}/related")
 async def get_related_products(
     product_id: str,
@@ -532,109 +715,32 @@ async def get_related_products(
     3. 補完商品（小物など）
     4. モテる度が高い商品
     """
-    products = load_products()
+    catalog = get_catalog()
+    products = catalog.products
+    
+    if _missing_products.contains(catalog.products_version, product_id):
+        return _product_not_found_response()
     
     # 現在の商品を取得
-    current_product = next(
-        (p for p in products if p.get("product_id") == product_id),
-        None
-    )
+    current_product = catalog.get_product(product_id)
     
     if not current_product:
+        _missing_products.add(catalog.products_version, product_id)
         raise HTTPException(status_code=404, detail="Product not found")
     
-    # 関連商品を推薦
-    related_products = []
-    
-    # 1. 同じカテゴリの商品（現在の商品を除く）
-    same_category = [
-        p for p in products
-        if p.get("product_id") != product_id
-        and p.get("category") == current_product.get("category")
-    ]
-    
-    # 2. 同じシーンの商品（現在の商品を除く）
-    current_scenes = current_product.get("attributes", {}).get("scene", [])
-    same_scene = [
-        p for p in products
-        if p.get("product_id") != product_id
-        and any(scene in p.get("attributes", {}).get("scene", []) for scene in current_scenes)
-    ]
-    
-    # 3. 補完商品（小物など）- カテゴリが異なる商品
-    complementary = [
-        p for p in products
-        if p.get("product_id") != product_id
-        and p.get("category") != current_product.get("category")
-        and p.get("category") in ["時計", "ベルト", "バッグ", "小物"]
-    ]
-    
-    # 4. モテる度が高い商品（現在の商品を除く）
-    high_moteru = [
-        p for p in products
-        if p.get("product_id") != product_id
-        and p.get("moteru_score", 0) >= 4.0
-    ]
-    
+    # 関連商品を推薦（カタログ読み込み時に計算済みの近傍テーブルから取り出す）
     # 優先順位: 同じカテゴリ > 同じシーン > 補完商品 > モテる度が高い商品
-    all_related = []
-    
-    # 同じカテゴリの商品を追加（最大2件）
-    for p in same_category[:2]:
-        if p not in all_related:
-            all_related.append(p)
-    
-    # 同じシーンの商品を追加（最大2件）
-    for p in same_scene[:2]:
-        if p not in all_related and len(all_related) < limit:
-            all_related.append(p)
-    
-    # 補完商品を追加（最大2件）
-    for p in complementary[:2]:
-        if p not in all_related and len(all_related) < limit:
-            all_related.append(p)
-    
-    # モテる度が高い商品を追加（残りを埋める）
-    for p in high_moteru:
-        if p not in all_related and len(all_related) < limit:
-            all_related.append(p)
-    
-    # モテる度でソート
-    all_related.sort(key=lambda x: x.get("moteru_score", 0), reverse=True)
-    
-    # 最大limit件まで
-    related_products = all_related[:limit]
-    
-    # 在庫情報を追加（ランダムに生成、実際のデータでは商品データから取得）
-    import random
-    for p in related_products:
-        if "stock_quantity" not in p:
-            p["stock_quantity"] = random.randint(1, 50)  # 1-50のランダムな在庫数
-        if "reviews" not in p:
-            # レビュー情報を追加（ランダムに生成）
-            review_count = random.randint(5, 50)
-            avg_rating = round(random.uniform(3.5, 5.0), 1)
-            p["reviews"] = {
-                "count": review_count,
-                "average_rating": avg_rating,
-                "rating_distribution": {
-                    "5": random.randint(review_count // 2, review_count),
-                    "4": random.randint(0, review_count // 4),
-                    "3": random.randint(0, review_count // 10),
-                    "2": random.randint(0, review_count // 20),
-                    "1": random.randint(0, review_count // 20)
-                }
-            }
+    position = catalog.product_positions[product_id]
+    related_products = [
+        _related_product_view(products[p])
+        for p in catalog.related.related(position, limit)
+    ]
     
-    # 一緒に購入された商品の情報を追加（ランダムに生成）
+    # 上位2件を「よく一緒に購入される商品」として追加
     frequently_bought_together = []
     if len(related_products) >= 2:
-        # 上位2件を「よく一緒に購入される商品」として追加
         for p in related_products[:2]:
-            p["frequently_bought_together"] = {
-                "percentage": random.randint(60, 90),  # 60-90%の人が一緒に購入
-                "count": random.randint(100, 500)  # 100-500人が一緒に購入
-            }
+            p["frequently_bought_together"] = _frequently_bought_together(product_id, p.get("product_id"))
             frequently_bought_together.append({
                 "product_id": p.get("product_id"),
                 "name": p.get("name"),
@@ -1,43 +1,20 @@
 """
 コーディネートテンプレート関連のAPI
 """
-import json
-from pathlib import Path
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request, Response
 from typing import List, Optional
+from app.api.utils.catalog_store import get_catalog
+from app.api.utils.http_cache import CacheValidators, make_etag, not_modified_response
+from app.api.utils.json_fragments import FragmentJSONResponse, dumps, encode_members
+from app.api.utils.template_resolver import TEMPLATE_MAX_CANDIDATES
 
 router = APIRouter(prefix="/api/templates", tags=["templates"])
 
-# テンプレートファイルのパス
-# backend/app/api/routes/templates.py から見て、プロジェクトルートのdata/templates/templates.json
-# __file__ は backend/app/api/routes/templates.py
-# プロジェクトルートは backend の親ディレクトリ
-BASE_DIR = Path(__file__).parent.parent.parent.parent.parent
-TEMPLATES_FILE = BASE_DIR / "data" / "templates" / "templates.json"
-
-# デバッグ用: パスを確認
-import os
-if not TEMPLATES_FILE.exists():
-    # 代替パスを試す
-    alt_path = Path(__file__).parent.parent.parent.parent / "data" / "templates" / "templates.json"
-    if alt_path.exists():
-        TEMPLATES_FILE = alt_path
-
-
-def load_templates():
-    """テンプレートデータを読み込む"""
-    try:
-        with open(TEMPLATES_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return data.get("テンプレート", [])
-    except FileNotFoundError:
-        return []
-    except json.JSONDecodeError:
-        return []
-
 
 @router.get("/")
 async def get_templates(
+    request: Request,
+    response: Response,
     scene: Optional[str] = None,
     style: Optional[str] = None,
     season: Optional[str] = None
@@ -48,8 +25,21 @@ async def get_templates(
     - **scene**: シーン（デート、仕事、カジュアルなど）
     - **style**: スタイル（カジュアル、ビジネスなど）
     - **season**: 季節（春、夏、秋、冬）
+    
+    ETag / Last-Modified を返し、条件付きリクエストが一致すれば 304 を返す。
     """
-    templates = load_templates()
+    catalog = get_catalog()
+    
+    # テンプレートが更新されていなければ、本文を作らずに 304 を返す
+    validators = CacheValidators(
+        etag=make_etag("templates", catalog.templates_version, scene, style, season),
+        last_modified=catalog.templates_mtime,
+    )
+    not_modified = not_modified_response(request, validators)
+    if not_modified is not None:
+        return not_modified
+    
+    templates = catalog.templates
     
     # フィルタリング
     if scene:
@@ -59,6 +49,7 @@ async def get_templates(
     if season:
         templates = [t for t in templates if t.get("season") == season]
     
+    validators.apply(response)
     return {
         "count": len(templates),
         "templates": templates
@@ -66,13 +57,17 @@ async def get_templates(
 
 
 @router.get("/{template_id}")
-async def get_template(template_id: str):
+async def get_template(template_id: str, request: Request, response: Response):
     """
     特定のテンプレートを取得
     
     - **template_id**: テンプレートID（例: TEMPLATE_001）
+    
+    ETag / Last-Modified を返し、条件付きリクエストが一致すれば 304 を返す。
     """
-    templates = load_templates()
+    catalog = get_catalog()
+    
+    templates = catalog.templates
     
     template = next(
         (t for t in templates if t.get("template_id") == template_id),
@@ -82,4 +77,62 @@ async def get_template(template_id: str):
     if not template:
         raise HTTPException(status_code=404, detail="Template not found")
     
+    # 存在を確認してから条件付きリクエストを判定する（存在しないIDには 304 ではなく 404 を返す）
+    validators = CacheValidators(
+        etag=make_etag("template", catalog.templates_version, template_id),
+        last_modified=catalog.templates_mtime,
+    )
+    not_modified = not_modified_response(request, validators)
+    if not_modified is not None:
+        return not_modified
+    
+    validators.apply(response)
     return template
+
+
+@router.get("/{template_id}/products")
+async def get_template_products(
+    template_id: str,
+    request: Request,
+    limit: int = Query(10, ge=1, le=TEMPLATE_MAX_CANDIDATES, description="アイテムごとの候補数")
+):
+    """
+    テンプレートのアイテムごとの商品候補を取得
+    
+    - **template_id**: テンプレートID（例: TEMPLATE_001）
+    - **limit**: アイテムごとの候補数
+    
+    候補はアイテムの種類に一致する商品のうち、conditions を多く満たすもの（同数ならモテる度スコアの高いもの）から並ぶ。
+    候補はカタログの読み込み時に解決済みのため、リクエストごとの照合は行わない。
+    """
+    catalog = get_catalog()
+    
+    slots = catalog.template_products.slots(template_id)
+    if slots is None:
+        raise HTTPException(status_code=404, detail="Template not found")
+    
+    # 存在を確認してから条件付きリクエストを判定する（存在しないIDには 304 ではなく 404 を返す）
+    validators = CacheValidators(
+        etag=make_etag("template_products", catalog.version, template_id, limit),
+        last_modified=max(catalog.products_mtime, catalog.templates_mtime),
+    )
+    not_modified = not_modified_response(request, validators)
+    if not_modified is not None:
+        return not_modified
+    
+    items = []
+    for slot in slots:
+        products = [
+            catalog.summaries.fragment(position, encode_members(matched_conditions=matched))
+            for position, matched in zip(slot.positions[:limit].tolist(), slot.matched[:limit].tolist())
+        ]
+        items.append({
+            "item_type": slot.item_type,
+            "required": slot.required,
+            "conditions": list(slot.conditions),
+            "products": products,
+        })
+    
+    response = FragmentJSONResponse(dumps({"template_id": template_id, "items": items}))
+    validators.apply(response)
+    return response
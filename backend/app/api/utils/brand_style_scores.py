@@ -0,0 +1,225 @@
+"""
+ブランドスタイルのスコアリング
+
+ブランドスタイルの特徴定義と、商品 × スタイルのスコア行列。
+スコアはカタログのスナップショットごとに一度だけ計算し、
+再読み込み時は内容が変わっていない商品の行を前回の行列から引き継ぐ。
+"""
+import hashlib
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.api.utils.catalog_binary import CompiledReader, CompiledWriter
+
+
+# ブランドスタイルの特徴定義（5つの大枠カテゴリ）
+BRAND_STYLE_FEATURES = {
+    "oversize-luxury": {
+        "name": "オーバーサイズ×ラグジュアリー",
+        "description": "オーバーサイズ×ラグジュアリー融合スタイル",
+        "is_recommended": True,  # 迷ったらこれがおすすめ
+        "keywords": ["オーバーサイズ", "oversize", "デコンストラクション", "deconstruction", "ラグジュアリー", "luxury", "高級感", "premium", "ストリート", "street", "ロゴ", "logo", "グラフィック", "graphic"],
+        "design_features": ["oversize", "deconstruction", "luxury", "street", "premium", "logo", "graphic"],
+        "color_preferences": ["black", "white", "gray", "beige", "navy", "red"],
+        "silhouette": "oversize",
+        "luxury_atmosphere_min": 4.0,
+        "uniqueness_min": 4.0,
+        "street_luxury_fusion_min": 4.5,
+        "similar_brands": [],
+    },
+    "minimal-monochrome": {
+        "name": "ミニマル×モノクロ",
+        "description": "シンプルで洗練されたミニマル×モノクロスタイル",
+        "is_recommended": False,
+        "keywords": ["ミニマル", "minimal", "モノクロ", "monochrome", "シンプル", "simple", "洗練", "sophisticated", "クリーン", "clean"],
+        "design_features": ["minimal", "monochrome", "simple", "clean", "sophisticated"],
+        "color_preferences": ["black", "white", "gray", "beige", "navy"],
+        "silhouette": "regular",
+        "luxury_atmosphere_min": 3.5,
+        "uniqueness_min": 3.5,
+        "street_luxury_fusion_min": 3.5,
+        "similar_brands": [],
+    },
+    "street-graphic": {
+        "name": "ストリート×グラフィック",
+        "description": "ストリート×グラフィックが特徴的なスタイル",
+        "is_recommended": False,
+        "keywords": ["ストリート", "street", "グラフィック", "graphic", "ロゴ", "logo", "アローロゴ", "arrow", "ジッパー", "zipper", "インダストリアル", "industrial"],
+        "design_features": ["graphic", "logo", "street", "industrial", "arrow"],
+        "color_preferences": ["black", "white", "yellow", "orange", "red"],
+        "silhouette": "regular",
+        "luxury_atmosphere_min": 3.5,
+        "uniqueness_min": 4.0,
+        "street_luxury_fusion_min": 4.0,
+        "similar_brands": [],
+    },
+    "athleisure-street": {
+        "name": "アスレジャー×ストリート",
+        "description": "スポーツウェアの要素を取り入れたストリートスタイル",
+        "is_recommended": False,
+        "keywords": ["アスレジャー", "athleisure", "ストリート", "street", "ミニマル", "minimal", "モノクロ", "monochrome", "スポーツ", "sport"],
+        "design_features": ["athleisure", "street", "minimal", "monochrome", "sport"],
+        "color_preferences": ["beige", "gray", "black", "white", "brown"],
+        "silhouette": "oversize",
+        "luxury_atmosphere_min": 3.5,
+        "uniqueness_min": 3.5,
+        "street_luxury_fusion_min": 4.0,
+        "similar_brands": [],
+    },
+    "avant-garde": {
+        "name": "アヴァンギャルド×デコンストラクション",
+        "description": "前衛的で実験的なデコンストラクションスタイル",
+        "is_recommended": False,
+        "keywords": ["アヴァンギャルド", "avant-garde", "デコンストラクション", "deconstruction", "アシンメトリー", "asymmetry", "前衛", "experimental", "独創", "unique"],
+        "design_features": ["avant-garde", "deconstruction", "asymmetry", "experimental", "unique"],
+        "color_preferences": ["black", "white", "gray", "beige"],
+        "silhouette": "oversize",
+        "luxury_atmosphere_min": 4.0,
+        "uniqueness_min": 4.5,
+        "street_luxury_fusion_min": 4.0,
+        "similar_brands": [],
+    },
+}
+
+
+def calculate_brand_style_score(product: dict, brand_style: str) -> float:
+    """
+    商品が指定されたブランドスタイルにどれだけ近いかをスコアリング
+    
+    スコア計算:
+    - キーワードマッチング: 30%
+    - デザインフィーチャーマッチング: 25%
+    - 評価スコアマッチング: 25%
+    - 価格効率: 20%
+    """
+    if brand_style not in BRAND_STYLE_FEATURES:
+        return 0.0
+    
+    features = BRAND_STYLE_FEATURES[brand_style]
+    score = 0.0
+    
+    # 1. キーワードマッチング（30%）
+    keyword_score = 0.0
+    product_text = (
+        product.get("name", "").lower() + " " +
+        product.get("description", "").lower() + " " +
+        product.get("brand", "").lower()
+    )
+    
+    matched_keywords = sum(1 for keyword in features["keywords"] if keyword.lower() in product_text)
+    keyword_score = min(matched_keywords / len(features["keywords"]) * 3, 1.0)  # 最大1.0
+    score += keyword_score * 0.3
+    
+    # 2. デザインフィーチャーマッチング（25%）
+    design_score = 0.0
+    attributes = product.get("attributes", {})
+    design_features = attributes.get("design", [])
+    
+    if design_features:
+        matched_features = sum(1 for feature in features["design_features"] 
+                              if any(feature.lower() in df.lower() for df in design_features))
+        design_score = min(matched_features / len(features["design_features"]), 1.0)
+    
+    score += design_score * 0.25
+    
+    # 3. 評価スコアマッチング（25%）
+    evaluation = product.get("evaluation", {})
+    eval_score = 0.0
+    
+    luxury_atmosphere = evaluation.get("luxury_atmosphere", 0)
+    uniqueness = evaluation.get("uniqueness", 0)
+    street_luxury_fusion = evaluation.get("street_luxury_fusion", 0)
+    
+    # 各評価スコアが基準値を満たしているか
+    luxury_match = min(luxury_atmosphere / features["luxury_atmosphere_min"], 1.0) if features["luxury_atmosphere_min"] > 0 else 1.0
+    uniqueness_match = min(uniqueness / features["uniqueness_min"], 1.0) if features["uniqueness_min"] > 0 else 1.0
+    fusion_match = min(street_luxury_fusion / features["street_luxury_fusion_min"], 1.0) if features["street_luxury_fusion_min"] > 0 else 1.0
+    
+    eval_score = (luxury_match + uniqueness_match + fusion_match) / 3
+    score += eval_score * 0.25
+    
+    # 4. シルエットマッチング（追加ボーナス）
+    if features["silhouette"] == "oversize":
+        if evaluation.get("oversize_lower_body"):
+            score += 0.1  # ボーナス
+    
+    # 5. 価格効率（20%）
+    price = product.get("price", 0)
+    # 価格が低いほど高スコア（最大50,000円を基準に正規化）
+    price_efficiency = max(0, 1.0 - (price / 50000) * 0.5)  # 50,000円以上で0.5倍、それ以下で線形減少
+    score += price_efficiency * 0.2
+    
+    return min(score, 1.0)  # 最大1.0
+
+
+# スタイルの並び（スコア行列の列の順序）
+STYLE_KEYS: List[str] = list(BRAND_STYLE_FEATURES)
+
+
+def _score_inputs(product: dict) -> Tuple[Any, ...]:
+    """スコア計算に使う項目だけを取り出す"""
+    evaluation = product.get("evaluation", {})
+    return (
+        product.get("name", ""),
+        product.get("description", ""),
+        product.get("brand", ""),
+        tuple(product.get("attributes", {}).get("design", [])),
+        evaluation.get("luxury_atmosphere", 0),
+        evaluation.get("uniqueness", 0),
+        evaluation.get("street_luxury_fusion", 0),
+        bool(evaluation.get("oversize_lower_body")),
+        product.get("price", 0),
+    )
+
+
+def _fingerprint(product: dict) -> int:
+    """スコア計算に使う項目から求めた、商品の内容の指紋（64ビット）"""
+    digest = hashlib.blake2b(repr(_score_inputs(product)).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class StyleScoreMatrix:
+    """
+    商品 × ブランドスタイルのスコア行列
+
+    行ごとに内容の指紋（64ビット）を持ち、再読み込み時は指紋が一致する行のスコアを引き継ぐ。
+    コンパイル済みカタログにも指紋の配列だけが保存されるため、商品名などの文字列は保持しない。
+    """
+
+    def __init__(self, products: Sequence[dict], previous: Optional["StyleScoreMatrix"] = None):
+        self.scores = np.zeros((len(products), len(STYLE_KEYS)), dtype=np.float64)
+        self.fingerprints = np.fromiter((_fingerprint(product) for product in products), dtype=np.uint64, count=len(products))
+        self._columns = {style: column for column, style in enumerate(STYLE_KEYS)}
+
+        # 前回の行列の 指紋 → 行（同じ指紋が複数あれば先頭の行）
+        previous_rows: Dict[int, int] = {}
+        if previous is not None:
+            for row, fingerprint in enumerate(previous.fingerprints.tolist()):
+                previous_rows.setdefault(fingerprint, row)
+
+        for position, (product, fingerprint) in enumerate(zip(products, self.fingerprints.tolist())):
+            # 内容が変わっていない商品は、前回の行列の行をそのまま使う
+            row = previous_rows.get(fingerprint)
+            if row is not None:
+                self.scores[position] = previous.scores[row]
+            else:
+                self.scores[position] = [calculate_brand_style_score(product, style) for style in STYLE_KEYS]
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに配列として書き出す"""
+        writer.add_array(f"{name}.scores", self.scores)
+        writer.add_array(f"{name}.fingerprints", self.fingerprints)
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str, size: int) -> "StyleScoreMatrix":
+        """コンパイル済みカタログの配列を参照するスコア行列を作成"""
+        matrix = cls.__new__(cls)
+        matrix.scores = reader.array(f"{name}.scores", np.float64, (size, len(STYLE_KEYS)))
+        matrix.fingerprints = reader.array(f"{name}.fingerprints", np.uint64, (size,))
+        matrix._columns = {style: column for column, style in enumerate(STYLE_KEYS)}
+        return matrix
+
+    def column(self, brand_style: str) -> np.ndarray:
+        """指定したブランドスタイルのスコア列"""
+        return self.scores[:, self._columns[brand_style]]
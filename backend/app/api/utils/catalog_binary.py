@@ -0,0 +1,220 @@
+"""
+コンパイル済みカタログのバイナリ形式
+
+構築済みのスナップショット（商品データ・検索用インデックス・列データ）を、名前付きのNumPy配列と
+JSONの表（語彙・テンプレートなどの小さなデータ）に分けて1ファイルに保存し、起動時・再読み込み時は
+JSONの解析とインデックスの構築を行わずにそのまま読み込む。
+配列は読み込み時にメモリマップしたファイルをコピーせずに参照する。
+
+任意のオブジェクトを復元する形式（pickleなど）は使わない。読み込み時に行うのは、
+型を限定した配列の参照と目録・表のJSONの解析だけで、目録の内容はすべて検証する。
+
+ファイル構成:
+    固定長ヘッダー（MAGIC 8バイト | 形式のバージョン 4バイト | 配列の数 4バイト | 目録の長さ 8バイト、little endian）
+    | 目録（JSON、空白で整列） | 配列（64バイト境界に整列）...
+
+目録には元データの情報（metadata）、JSONの表（tables）、配列の型・形・位置（arrays）を記録する。
+配列の位置は目録の後ろ（データ部の先頭）からの相対位置。
+"""
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b"MTCAT002"
+# 配列・表の名前や持ち方を変えたときも上げる
+FORMAT_VERSION = 8
+
+# 配列の整列単位（NumPy配列をそのまま参照できるようにする）
+_ALIGNMENT = 64
+
+_PREFIX = struct.Struct("<8sIIQ")
+
+# 保存できる配列の型（目録に書かれた型もこの中のものだけを受け付ける）
+_DTYPES = frozenset(
+    np.dtype(dtype).str
+    for dtype in (np.bool_, np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint64, np.float64, "<U2")
+)
+
+
+class CompiledCatalogError(ValueError):
+    """コンパイル済みカタログが不正"""
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class CompiledWriter:
+    """コンパイル済みカタログに書き出す配列と表を集める"""
+
+    def __init__(self):
+        self.arrays: Dict[str, np.ndarray] = {}
+        self.tables: Dict[str, Any] = {}
+
+    def add_array(self, name: str, array: np.ndarray) -> None:
+        """配列を追加（型は保存できるものに限る）"""
+        array = np.ascontiguousarray(array)
+        if array.dtype.str not in _DTYPES:
+            raise ValueError(f"保存できない配列の型です: {name} ({array.dtype})")
+        if name in self.arrays:
+            raise ValueError(f"配列の名前が重複しています: {name}")
+        self.arrays[name] = array
+
+    def add_table(self, name: str, value: Any) -> None:
+        """JSONで表せる値を表として追加"""
+        if name in self.tables:
+            raise ValueError(f"表の名前が重複しています: {name}")
+        self.tables[name] = value
+
+    def write(self, path: Path, metadata: Dict[str, Any]) -> None:
+        """
+        ファイルに書き出す
+
+        書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える。
+
+        Args:
+            path: 出力先
+            metadata: 目録に記録する情報（元データのバージョンなど）
+        """
+        entries = {}
+        offset = 0
+        for name, array in self.arrays.items():
+            offset = _align(offset)
+            entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset += array.nbytes
+        manifest = {"metadata": metadata, "tables": self.tables, "arrays": entries}
+
+        # データ部の先頭も整列させるため、目録の後ろを空白で埋める
+        manifest_bytes = json.dumps(manifest, ensure_ascii=False).encode("utf-8")
+        manifest_bytes = manifest_bytes.ljust(_align(_PREFIX.size + len(manifest_bytes)) - _PREFIX.size)
+
+        temporary = path.with_name(path.name + ".tmp")
+        with open(temporary, "wb") as f:
+            f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(self.arrays), len(manifest_bytes)))
+            f.write(manifest_bytes)
+            written = 0
+            for name, array in self.arrays.items():
+                written += f.write(b"\0" * (entries[name]["offset"] - written))
+                written += f.write(array.tobytes())
+        os.replace(temporary, path)
+
+
+class CompiledReader:
+    """コンパイル済みカタログの配列と表（配列はメモリマップしたファイルを参照する読み取り専用の配列）"""
+
+    def __init__(self, metadata: Dict[str, Any], tables: Dict[str, Any], arrays: Dict[str, np.ndarray]):
+        self.metadata = metadata
+        self._tables = tables
+        self._arrays = arrays
+
+    def array(
+        self,
+        name: str,
+        dtype: Any = None,
+        shape: Optional[Tuple[Optional[int], ...]] = None,
+        limit: Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        配列を取得
+
+        Args:
+            name: 配列の名前
+            dtype: 期待する型（指定した場合は一致しなければエラー）
+            shape: 期待する形（Noneの次元は大きさを問わない）
+            limit: 要素の上限（指定した場合は、すべての要素が0以上limit未満でなければエラー）
+        """
+        try:
+            array = self._arrays[name]
+        except KeyError:
+            raise CompiledCatalogError(f"配列がありません: {name}")
+        if dtype is not None and array.dtype != np.dtype(dtype):
+            raise CompiledCatalogError(f"配列の型が一致しません: {name} ({array.dtype})")
+        if shape is not None and (
+            array.ndim != len(shape) or any(size is not None and size != actual for size, actual in zip(shape, array.shape))
+        ):
+            raise CompiledCatalogError(f"配列の形が一致しません: {name} {array.shape}")
+        if limit is not None and array.size and (array.min() < 0 or array.max() >= limit):
+            raise CompiledCatalogError(f"配列の値が範囲外です: {name}")
+        return array
+
+    def table(self, name: str) -> Any:
+        """JSONの表を取得"""
+        try:
+            return self._tables[name]
+        except KeyError:
+            raise CompiledCatalogError(f"表がありません: {name}")
+
+
+def _read_manifest(f) -> Tuple[Dict[str, Any], int, int]:
+    """固定長ヘッダーと目録を読み込む（目録, 配列の数, データ部の開始位置）"""
+    prefix = f.read(_PREFIX.size)
+    if len(prefix) < _PREFIX.size:
+        raise CompiledCatalogError("コンパイル済みカタログの形式が不正です")
+    magic, version, count, length = _PREFIX.unpack(prefix)
+    if magic != MAGIC:
+        raise CompiledCatalogError("コンパイル済みカタログの形式が不正です")
+    if version != FORMAT_VERSION:
+        raise CompiledCatalogError(f"未対応の形式です: format={version}")
+    try:
+        manifest = json.loads(f.read(length))
+    except ValueError:
+        raise CompiledCatalogError("コンパイル済みカタログの目録が不正です")
+    if not isinstance(manifest, dict) or not all(
+        isinstance(manifest.get(key), dict) for key in ("metadata", "tables", "arrays")
+    ):
+        raise CompiledCatalogError("コンパイル済みカタログの目録が不正です")
+    return manifest, count, _PREFIX.size + length
+
+
+def read_header(path: Path) -> Dict[str, Any]:
+    """目録に記録された元データの情報だけを読み込む（バージョン確認用）"""
+    with open(path, "rb") as f:
+        manifest, _, _ = _read_manifest(f)
+    return manifest["metadata"]
+
+
+def _view(mapped: mmap.mmap, data_offset: int, name: str, entry: Any) -> np.ndarray:
+    """目録の1項目を検証し、ファイル上の配列を参照する"""
+    try:
+        dtype, shape, offset = entry["dtype"], entry["shape"], entry["offset"]
+    except (TypeError, KeyError):
+        raise CompiledCatalogError(f"配列の情報が不正です: {name}")
+    if dtype not in _DTYPES:
+        raise CompiledCatalogError(f"未対応の配列の型です: {name} ({dtype})")
+    if (
+        not isinstance(shape, list)
+        or not all(type(size) is int and size >= 0 for size in shape)
+        or type(offset) is not int
+        or offset < 0
+        or offset % _ALIGNMENT
+    ):
+        raise CompiledCatalogError(f"配列の情報が不正です: {name}")
+    dtype = np.dtype(dtype)
+    count = 1
+    for size in shape:
+        count *= size
+    start = data_offset + offset
+    if start + count * dtype.itemsize > len(mapped):
+        raise CompiledCatalogError(f"配列がファイルの範囲外です: {name}")
+    return np.frombuffer(mapped, dtype=dtype, count=count, offset=start).reshape(shape)
+
+
+def read_compiled(path: Path) -> CompiledReader:
+    """
+    コンパイル済みカタログを読み込む
+
+    配列はメモリマップしたファイルを直接参照する読み取り専用の配列になる。
+    """
+    with open(path, "rb") as f:
+        manifest, count, data_offset = _read_manifest(f)
+        if count != len(manifest["arrays"]):
+            raise CompiledCatalogError("コンパイル済みカタログの配列の数が一致しません")
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = {name: _view(mapped, data_offset, name, entry) for name, entry in manifest["arrays"].items()}
+    return CompiledReader(manifest["metadata"], manifest["tables"], arrays)
+
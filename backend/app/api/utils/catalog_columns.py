@@ -0,0 +1,186 @@
+"""
+カタログの列指向（カラムナ）表現
+
+価格・評価スコア・真偽値フラグ・カテゴリ値をNumPy配列として保持し、
+数値条件の絞り込みを商品ごとの dict.get ではなくブール配列（マスク）の演算で行う。
+配列のi番目の要素は、スナップショット内のi番目の商品に対応する。
+"""
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from app.api.utils.catalog_binary import CompiledReader, CompiledWriter
+from app.api.utils.catalog_index import MISSING
+
+# 評価スコアの列（evaluation 内の数値項目）
+SCORE_FIELDS = (
+    "moteru_score",
+    "uniqueness",
+    "silhouette",
+    "street_luxury_fusion",
+    "reaction_score",
+    "confidence_score",
+    "luxury_atmosphere",
+)
+
+# 真偽値フラグの列と、値の取り出し方
+FLAG_FIELDS = {
+    "in_stock": lambda p: p,
+    "returnable": lambda p: p,
+    "oversize_lower_body": lambda p: p.get("evaluation", {}),
+    "quality_focus": lambda p: p.get("evaluation", {}),
+}
+
+# カテゴリ値として符号化する列と、値の取り出し方（欠損は -1 に符号化）
+CATEGORICAL_FIELDS = {
+    "category": lambda p: p.get("category", MISSING),
+    "brand": lambda p: p.get("brand", MISSING),
+    "fit": lambda p: p.get("attributes", {}).get("fit", ""),
+}
+
+# 真偽値フラグの符号
+FLAG_TRUE = 1
+FLAG_FALSE = 0
+FLAG_MISSING = -1
+FLAG_OTHER_TRUTHY = 2
+FLAG_OTHER_FALSY = -2
+
+
+def _flag_code(container: dict, field: str) -> int:
+    """真偽値フラグを符号化（True/False以外の値や欠損も区別する）"""
+    if field not in container:
+        return FLAG_MISSING
+    value = container[field]
+    if value == True:  # noqa: E712  1 も True と同じ扱い（元の比較と同じ意味）
+        return FLAG_TRUE
+    if value == False:  # noqa: E712
+        return FLAG_FALSE
+    return FLAG_OTHER_TRUTHY if value else FLAG_OTHER_FALSY
+
+
+def _number(value: Any) -> float:
+    """数値列の値（数値でないものは0として扱う）"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return 0.0
+
+
+def mask_to_bitmap(mask: np.ndarray) -> int:
+    """ブール配列をビットマップ（int）に変換"""
+    return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(), "little")
+
+
+def bitmap_to_mask(bitmap: int, size: int) -> np.ndarray:
+    """ビットマップ（int）をブール配列に変換"""
+    data = bitmap.to_bytes((size + 7) // 8, "little")
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=size, bitorder="little")
+    return bits.astype(bool)
+
+
+class CatalogColumns:
+    """カタログの列指向ビュー"""
+
+    def __init__(self, products: Sequence[dict]):
+        self.size = len(products)
+        self.price = np.array([_number(p.get("price", 0)) for p in products], dtype=np.float64)
+        self.original_price = np.array([_number(p.get("original_price", 0)) for p in products], dtype=np.float64)
+
+        evaluations = [p.get("evaluation", {}) for p in products]
+        self.scores: Dict[str, np.ndarray] = {
+            field: np.array([_number(e.get(field, 0)) for e in evaluations], dtype=np.float64)
+            for field in SCORE_FIELDS
+        }
+
+        self.flags: Dict[str, np.ndarray] = {
+            field: np.array([_flag_code(extract(p), field) for p in products], dtype=np.int8)
+            for field, extract in FLAG_FIELDS.items()
+        }
+
+        # サイズ情報を持たない商品（推薦APIではサイズ条件の対象外）
+        self.sizes_empty = np.array([not p.get("sizes", []) for p in products], dtype=bool)
+
+        self.vocabularies: Dict[str, List[Any]] = {}
+        self._codes_by_value: Dict[str, Dict[Any, int]] = {}
+        self.codes: Dict[str, np.ndarray] = {}
+        for field, extract in CATEGORICAL_FIELDS.items():
+            codes_by_value: Dict[Any, int] = {}
+            codes = np.empty(self.size, dtype=np.int32)
+            for position, product in enumerate(products):
+                value = extract(product)
+                if value is MISSING:
+                    codes[position] = -1
+                    continue
+                codes[position] = codes_by_value.setdefault(value, len(codes_by_value))
+            self.vocabularies[field] = list(codes_by_value)
+            self._codes_by_value[field] = codes_by_value
+            self.codes[field] = codes
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに配列（語彙は表）として書き出す"""
+        writer.add_table(name, {"vocabularies": self.vocabularies})
+        writer.add_array(f"{name}.price", self.price)
+        writer.add_array(f"{name}.original_price", self.original_price)
+        for field in SCORE_FIELDS:
+            writer.add_array(f"{name}.scores.{field}", self.scores[field])
+        for field in FLAG_FIELDS:
+            writer.add_array(f"{name}.flags.{field}", self.flags[field])
+        writer.add_array(f"{name}.sizes_empty", self.sizes_empty)
+        for field in CATEGORICAL_FIELDS:
+            writer.add_array(f"{name}.codes.{field}", self.codes[field])
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str, size: int) -> "CatalogColumns":
+        """コンパイル済みカタログの配列を参照する列データを作成"""
+        table = reader.table(name)
+        columns = cls.__new__(cls)
+        columns.size = size
+        columns.price = reader.array(f"{name}.price", np.float64, (size,))
+        columns.original_price = reader.array(f"{name}.original_price", np.float64, (size,))
+        columns.scores = {field: reader.array(f"{name}.scores.{field}", np.float64, (size,)) for field in SCORE_FIELDS}
+        columns.flags = {field: reader.array(f"{name}.flags.{field}", np.int8, (size,)) for field in FLAG_FIELDS}
+        columns.sizes_empty = reader.array(f"{name}.sizes_empty", np.bool_, (size,))
+        columns.vocabularies = {field: list(table["vocabularies"][field]) for field in CATEGORICAL_FIELDS}
+        columns._codes_by_value = {
+            field: {value: code for code, value in enumerate(vocabulary)}
+            for field, vocabulary in columns.vocabularies.items()
+        }
+        columns.codes = {field: reader.array(f"{name}.codes.{field}", np.int32, (size,)) for field in CATEGORICAL_FIELDS}
+        return columns
+
+    @property
+    def moteru_score(self) -> np.ndarray:
+        return self.scores["moteru_score"]
+
+    def all(self) -> np.ndarray:
+        """全商品を対象とするマスク"""
+        return np.ones(self.size, dtype=bool)
+
+    def equals(self, field: str, value: Any) -> np.ndarray:
+        """カテゴリ値が value と一致する商品のマスク"""
+        code = self._codes_by_value[field].get(value)
+        if code is None:
+            return np.zeros(self.size, dtype=bool)
+        return self.codes[field] == code
+
+    def flag_is(self, field: str, value: bool) -> np.ndarray:
+        """フラグが value と一致する商品のマスク（欠損は一致しない）"""
+        return self.flags[field] == (FLAG_TRUE if value else FLAG_FALSE)
+
+    def flag_truthy_or_missing(self, field: str) -> np.ndarray:
+        """フラグが真、または欠損している商品のマスク"""
+        codes = self.flags[field]
+        return (codes == FLAG_TRUE) | (codes == FLAG_OTHER_TRUTHY) | (codes == FLAG_MISSING)
+
+    def price_between(self, mask: np.ndarray, min_price: Optional[float] = None, max_price: Optional[float] = None) -> np.ndarray:
+        """価格条件でマスクを絞り込む"""
+        if min_price is not None:
+            mask &= self.price >= min_price
+        if max_price is not None:
+            mask &= self.price <= max_price
+        return mask
+
+    def score_at_least(self, mask: np.ndarray, field: str, minimum: Optional[float]) -> np.ndarray:
+        """評価スコアの下限でマスクを絞り込む"""
+        if minimum is not None:
+            mask &= self.scores[field] >= minimum
+        return mask
@@ -0,0 +1,81 @@
+"""
+カタログのコンパイル
+
+products.json / templates.json を読み込んでスナップショット（検索用インデックス・列データを含む）を構築し、
+コンパイル済みカタログ（catalog_binary の形式）として書き出す。
+商品データは1件ずつJSONにエンコードしたレコード列として保存し、読み込み後は参照されたときに
+デコードする（catalog_records）。インデックス・列データは名前付きの配列として保存し、
+読み込み後はメモリマップしたファイルを参照する。
+
+使い方（backend/ で実行）:
+    python -m app.api.utils.catalog_compiler
+    python -m app.api.utils.catalog_compiler --products path/to/products.json --output path/to/catalog.bin
+"""
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict
+
+from app.api.utils.catalog_binary import CompiledWriter
+from app.api.utils.catalog_store import COMPILED_FILE, PRODUCTS_FILE, TEMPLATES_FILE, _read_json, build_snapshot, dump_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+def compile_catalog(products_file: Path, templates_file: Path, output: Path) -> Dict[str, Any]:
+    """
+    カタログをコンパイルして書き出す
+
+    Returns:
+        書き出したカタログの情報（目録に記録した内容）
+    """
+    products, products_version = _read_json(products_file, "products")
+    templates, templates_version = _read_json(templates_file, "テンプレート")
+    if products is None or templates is None:
+        raise ValueError("カタログのJSONが不正です")
+
+    snapshot = build_snapshot(
+        products,
+        templates,
+        products_version=products_version,
+        templates_version=templates_version,
+    )
+    metadata = {
+        "products_version": products_version,
+        "templates_version": templates_version,
+        "products": len(snapshot.products),
+        "templates": len(snapshot.templates),
+        "compiled_at": time.time(),
+    }
+    writer = CompiledWriter()
+    dump_snapshot(snapshot, writer)
+    writer.write(output, metadata)
+    return metadata
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="商品・テンプレートカタログをコンパイルする")
+    parser.add_argument("--products", type=Path, default=PRODUCTS_FILE, help="products.json のパス")
+    parser.add_argument("--templates", type=Path, default=TEMPLATES_FILE, help="templates.json のパス")
+    parser.add_argument("--output", type=Path, default=COMPILED_FILE, help="出力先のパス")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    started = time.perf_counter()
+    try:
+        metadata = compile_catalog(args.products, args.templates, args.output)
+    except (OSError, ValueError) as e:
+        logger.error(f"カタログのコンパイルに失敗しました: {str(e)}")
+        return 1
+    logger.info(
+        f"カタログをコンパイルしました: {args.output} "
+        f"products={metadata['products']} templates={metadata['templates']} "
+        f"({time.perf_counter() - started:.2f}秒)"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
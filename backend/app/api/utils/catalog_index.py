@@ -0,0 +1,269 @@
+"""
+商品属性の転置インデックス
+
+属性値ごとに該当商品の位置を保持し、検索条件をビットマップ（Pythonのint）の論理積として評価する。
+ビットマップのi番目のビットは、スナップショット内のi番目の商品に対応する。
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.api.utils.catalog_binary import CompiledCatalogError, CompiledReader, CompiledWriter
+
+# 作成済みのビットマップをキャッシュする件数（環境変数で上書き可能）
+BITMAP_CACHE_SIZE = int(os.getenv("CATALOG_BITMAP_CACHE_SIZE", "256"))
+
+
+class _Missing:
+    """属性値が存在しないことを表す番兵（pickleしても同じオブジェクトに戻る）"""
+
+    def __repr__(self) -> str:
+        return "MISSING"
+
+    def __reduce__(self) -> str:
+        return "MISSING"
+
+
+# 属性値が存在しない商品を表すキー
+MISSING = _Missing()
+
+# 各バイト値に含まれるビット位置の早見表
+_BYTE_BITS = tuple(
+    tuple(bit for bit in range(8) if byte & (1 << bit))
+    for byte in range(256)
+)
+
+
+def _attributes(product: dict) -> dict:
+    return product.get("attributes", {})
+
+
+# インデックス対象のフィールドと値の取り出し方
+# リストを返すフィールドは、要素ごとにインデックスする
+INDEXED_FIELDS: Dict[str, Callable[[dict], Any]] = {
+    "category": lambda p: p.get("category", MISSING),
+    "brand": lambda p: p.get("brand", ""),
+    "returnable": lambda p: p.get("returnable", MISSING),
+    "in_stock": lambda p: p.get("in_stock", MISSING),
+    "colors": lambda p: p.get("colors", []),
+    "sizes": lambda p: p.get("sizes", []),
+    "scene": lambda p: _attributes(p).get("scene", []),
+    "style": lambda p: _attributes(p).get("style", []),
+    "season": lambda p: _attributes(p).get("season", []),
+    "subcategory": lambda p: p.get("subcategory", MISSING),
+    "materials": lambda p: p.get("materials", []),
+    "fit": lambda p: _attributes(p).get("fit", MISSING),
+    "design": lambda p: _attributes(p).get("design", []),
+    "cleanliness": lambda p: _attributes(p).get("cleanliness", MISSING),
+    "trendiness": lambda p: _attributes(p).get("trendiness", MISSING),
+}
+
+MULTI_VALUED_FIELDS = {"colors", "sizes", "scene", "style", "season", "materials", "design"}
+
+
+def bitmap_from_positions(positions: Iterable[int]) -> int:
+    """商品位置のリストからビットマップを作成"""
+    positions = list(positions)
+    if not positions:
+        return 0
+    data = bytearray((max(positions) >> 3) + 1)
+    for position in positions:
+        data[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(data, "little")
+
+
+def iter_positions(bitmap: int) -> Iterator[int]:
+    """ビットマップに含まれる商品位置を昇順に列挙"""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    for byte_index, byte in enumerate(data):
+        if byte:
+            base = byte_index << 3
+            for bit in _BYTE_BITS[byte]:
+                yield base + bit
+
+
+# int.bit_count は Python 3.10 以降
+_HAS_BIT_COUNT = hasattr(int, "bit_count")
+
+
+def popcount(bitmap: int) -> int:
+    """ビットマップに含まれる商品数を数える"""
+    if _HAS_BIT_COUNT:
+        return bitmap.bit_count()
+    return bin(bitmap).count("1")
+
+
+def _bitmap_from_array(positions: np.ndarray) -> int:
+    """商品位置の配列からビットマップを作成"""
+    if not len(positions):
+        return 0
+    mask = np.zeros(int(positions.max()) + 1, dtype=bool)
+    mask[positions] = True
+    return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(), "little")
+
+
+class AttributeIndex:
+    """
+    属性値 → 商品位置ビットマップの転置インデックス
+
+    ポスティングリスト（属性値ごとの商品位置の昇順の配列）はフィールドごとに1本の配列に連結し、
+    属性値の番号と開始位置の配列で引く（コンパイル済みカタログではメモリマップしたまま参照する）。
+    ビットマップは参照されたときに作り、直近のものだけをキャッシュする。
+    属性値の一覧と 属性値 → 番号 の dict はフィールドごとの語彙の大きさだけ保持する。
+    """
+
+    def __init__(self, products: Sequence[dict], cache_size: int = BITMAP_CACHE_SIZE):
+        self.size = len(products)
+        self.all = (1 << self.size) - 1
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, int], int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._values: Dict[str, List[Any]] = {}
+        self._numbers: Dict[str, Dict[Any, int]] = {}
+        self._starts: Dict[str, np.ndarray] = {}
+        self._positions: Dict[str, np.ndarray] = {}
+
+        positions: Dict[str, Dict[Any, List[int]]] = {field: {} for field in INDEXED_FIELDS}
+        for position, product in enumerate(products):
+            for field, extract in INDEXED_FIELDS.items():
+                value = extract(product)
+                values = value if field in MULTI_VALUED_FIELDS else (value,)
+                postings = positions[field]
+                for item in values:
+                    postings.setdefault(item, []).append(position)
+
+        for field, postings in positions.items():
+            starts = np.zeros(len(postings) + 1, dtype=np.int64)
+            np.cumsum([len(items) for items in postings.values()], out=starts[1:])
+            self._set_field(
+                field,
+                list(postings),
+                starts,
+                np.fromiter((position for items in postings.values() for position in items), dtype=np.int32, count=int(starts[-1])),
+            )
+
+    def _set_field(self, field: str, values: List[Any], starts: np.ndarray, positions: np.ndarray) -> None:
+        self._values[field] = values
+        self._numbers[field] = {value: number for number, value in enumerate(values)}
+        self._starts[field] = starts
+        self._positions[field] = positions
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに書き出す（属性値は表、商品位置は属性値ごとに連結した配列）"""
+        fields = {}
+        for field, values in self._values.items():
+            fields[field] = {
+                # 欠損の番兵はJSONで表せないため、表では位置だけを記録する
+                "values": [None if value is MISSING else value for value in values],
+                "missing": next((number for number, value in enumerate(values) if value is MISSING), -1),
+            }
+            writer.add_array(f"{name}.{field}.starts", self._starts[field])
+            writer.add_array(f"{name}.{field}.positions", self._positions[field])
+        writer.add_table(name, fields)
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str, size: int) -> "AttributeIndex":
+        """コンパイル済みカタログの配列を参照するインデックスを作成"""
+        table = reader.table(name)
+        index = cls([])
+        index.size = size
+        index.all = (1 << size) - 1
+        for field in INDEXED_FIELDS:
+            values, missing = table[field]["values"], table[field]["missing"]
+            starts = reader.array(f"{name}.{field}.starts", np.int64, (len(values) + 1,))
+            positions = reader.array(f"{name}.{field}.positions", np.int32, (int(starts[-1]),), limit=size)
+            if np.any(starts[1:] < starts[:-1]):
+                raise CompiledCatalogError(f"ポスティングリストの開始位置が不正です: {name}.{field}")
+            values = [MISSING if number == missing else value for number, value in enumerate(values)]
+            index._set_field(field, values, starts, positions)
+        return index
+
+    def _posting(self, field: str, number: int) -> np.ndarray:
+        """番号の属性値に一致する商品位置（昇順）"""
+        starts = self._starts[field]
+        return self._positions[field][starts[number]:starts[number + 1]]
+
+    def _bitmap(self, field: str, number: int) -> int:
+        """番号の属性値に一致する商品のビットマップ（直近のものはキャッシュから返す）"""
+        key = (field, number)
+        with self._lock:
+            bitmap = self._cache.get(key)
+            if bitmap is not None:
+                self._cache.move_to_end(key)
+                return bitmap
+
+        bitmap = _bitmap_from_array(self._posting(field, number))
+        with self._lock:
+            self._cache[key] = bitmap
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return bitmap
+
+    def _mask(self, bitmap: int) -> np.ndarray:
+        """ビットマップをブール配列に変換"""
+        data = bitmap.to_bytes((self.size + 7) // 8, "little")
+        return np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=self.size, bitorder="little").astype(bool)
+
+    def values(self, field: str) -> List[Any]:
+        """フィールドに登録されている属性値の一覧（欠損は除く）"""
+        return [value for value in self._values[field] if value is not MISSING]
+
+    def lookup(self, field: str, value: Any) -> int:
+        """属性値に一致する商品のビットマップ"""
+        number = self._numbers[field].get(value)
+        if number is None:
+            return 0
+        return self._bitmap(field, number)
+
+    def counts(self, field: str, candidates: Optional[int] = None) -> Dict[Any, int]:
+        """
+        属性値ごとの商品数（ファセット用）
+
+        Args:
+            field: フィールド名
+            candidates: 数える対象のビットマップ（省略時は全商品）
+
+        Returns:
+            属性値 → 商品数（欠損と0件の値は除く）
+        """
+        starts = self._starts[field]
+        if candidates is None:
+            totals = np.diff(starts)
+        else:
+            # 対象に含まれるかをポスティングリスト全体で一度に調べ、属性値ごとの区間で合計する
+            hits = np.zeros(len(self._positions[field]) + 1, dtype=np.int64)
+            np.cumsum(self._mask(candidates)[self._positions[field]], out=hits[1:])
+            totals = hits[starts[1:]] - hits[starts[:-1]]
+        return {
+            value: count
+            for value, count in zip(self._values[field], totals.tolist())
+            if count and value is not MISSING
+        }
+
+    def lookup_substring(self, field: str, text: str) -> int:
+        """属性値に部分文字列として text を含む商品のビットマップ"""
+        mask = np.zeros(self.size, dtype=bool)
+        for number, value in enumerate(self._values[field]):
+            if isinstance(value, str) and text in value:
+                mask[self._posting(field, number)] = True
+        return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(), "little")
+
+    def match(self, filters: Dict[str, Any], candidates: Optional[int] = None) -> int:
+        """
+        すべての条件に一致する商品のビットマップ
+
+        Args:
+            filters: フィールド名 → 一致させる属性値
+            candidates: 絞り込み対象のビットマップ（省略時は全商品）
+        """
+        bitmap = self.all if candidates is None else candidates
+        # ビット長の短い（対象の少ない）ビットマップから論理積を取り、中間結果を小さく保つ
+        postings = sorted((self.lookup(field, value) for field, value in filters.items()), key=int.bit_length)
+        for posting in postings:
+            bitmap &= posting
+            if not bitmap:
+                break
+        return bitmap
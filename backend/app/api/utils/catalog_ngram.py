@@ -0,0 +1,179 @@
+"""
+キーワード検索用の文字N-gramインデックス
+
+商品名・説明・ブランド・シーン・スタイルの正規化済みテキストを
+文字bigram（1文字の検索用にunigramも）単位で転置インデックス化する。
+部分文字列検索は、検索語のN-gramのポスティングリストの積集合で候補を絞り、
+候補だけを実際のテキストで照合する（分かち書きのない日本語にも対応）。
+"""
+import unicodedata
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+
+from app.api.utils.catalog_binary import CompiledReader, CompiledWriter
+from app.api.utils.catalog_index import bitmap_from_positions
+
+
+def _attributes(product: dict) -> dict:
+    return product.get("attributes", {})
+
+
+# インデックス対象のフィールド（1商品につき複数のテキストを持てる）
+TEXT_FIELDS: Dict[str, Callable[[dict], List[str]]] = {
+    "name": lambda p: [p.get("name") or ""],
+    "description": lambda p: [p.get("description") or ""],
+    "brand": lambda p: [p.get("brand") or ""],
+    "scene": lambda p: _attributes(p).get("scene", []),
+    "style": lambda p: _attributes(p).get("style", []),
+}
+
+# キーワード検索・用途検索の対象フィールド
+KEYWORD_FIELDS = ("name", "description", "brand")
+PURPOSE_FIELDS = ("name", "description", "brand", "scene", "style")
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角の揺れを吸収し、小文字に揃える"""
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def _grams(text: str) -> set:
+    """テキストに含まれるunigramとbigram"""
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+def _query_grams(query: str) -> set:
+    """検索語の照合に使うN-gram（2文字以上ならbigramのみ）"""
+    if len(query) == 1:
+        return {query}
+    return {query[i:i + 2] for i in range(len(query) - 1)}
+
+
+_EMPTY = np.empty(0, dtype=np.int32)
+
+# 複数値のフィールド（シーン・スタイル）の値を連結するときの区切り（検索語に現れない制御文字）
+_VALUE_SEPARATOR = "\x1f"
+
+
+class NgramIndex:
+    """
+    フィールドごとの文字N-gram転置インデックス
+
+    ポスティングリストはフィールドごとに1本の配列に連結し、N-gramの整列済み配列と
+    開始位置の配列で引く。照合用の正規化済みテキストも、フィールドごとにUTF-8のバイト列を
+    連結した配列と開始位置の配列で持つ（コンパイル済みカタログではメモリマップしたまま参照できる）。
+    """
+
+    def __init__(self, products: Sequence[dict]):
+        self.size = len(products)
+        self._grams: Dict[str, np.ndarray] = {}
+        self._starts: Dict[str, np.ndarray] = {}
+        self._positions: Dict[str, np.ndarray] = {}
+        self._text_data: Dict[str, np.ndarray] = {}
+        self._text_offsets: Dict[str, np.ndarray] = {}
+
+        for field, extract in TEXT_FIELDS.items():
+            postings: Dict[str, List[int]] = {}
+            texts: List[bytes] = []
+            for position, product in enumerate(products):
+                values = [normalize_text(str(value)) for value in extract(product)]
+                texts.append(_VALUE_SEPARATOR.join(values).encode("utf-8"))
+                grams = set()
+                for value in values:
+                    grams |= _grams(value)
+                for gram in grams:
+                    postings.setdefault(gram, []).append(position)
+
+            text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+            np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+            self._text_data[field] = np.frombuffer(b"".join(texts), dtype=np.uint8)
+            self._text_offsets[field] = text_offsets
+
+            grams = sorted(postings)
+            starts = np.zeros(len(grams) + 1, dtype=np.int64)
+            np.cumsum([len(postings[gram]) for gram in grams], out=starts[1:])
+            self._grams[field] = np.array(grams, dtype="<U2")
+            self._starts[field] = starts
+            self._positions[field] = np.fromiter(
+                (position for gram in grams for position in postings[gram]), dtype=np.int32, count=int(starts[-1])
+            )
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに配列として書き出す"""
+        for field in TEXT_FIELDS:
+            writer.add_array(f"{name}.{field}.grams", self._grams[field])
+            writer.add_array(f"{name}.{field}.starts", self._starts[field])
+            writer.add_array(f"{name}.{field}.positions", self._positions[field])
+            writer.add_array(f"{name}.{field}.text_data", self._text_data[field])
+            writer.add_array(f"{name}.{field}.text_offsets", self._text_offsets[field])
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str, size: int) -> "NgramIndex":
+        """コンパイル済みカタログの配列を参照するインデックスを作成"""
+        index = cls.__new__(cls)
+        index.size = size
+        index._grams, index._starts, index._positions, index._text_data, index._text_offsets = {}, {}, {}, {}, {}
+        for field in TEXT_FIELDS:
+            grams = reader.array(f"{name}.{field}.grams", "<U2", (None,))
+            index._grams[field] = grams
+            index._starts[field] = reader.array(f"{name}.{field}.starts", np.int64, (len(grams) + 1,))
+            index._positions[field] = reader.array(f"{name}.{field}.positions", np.int32, (None,), limit=size)
+            index._text_data[field] = reader.array(f"{name}.{field}.text_data", np.uint8, (None,))
+            index._text_offsets[field] = reader.array(f"{name}.{field}.text_offsets", np.int64, (index.size + 1,))
+        return index
+
+    def _posting(self, field: str, gram: str) -> np.ndarray:
+        """N-gramを含む商品位置（昇順）"""
+        grams = self._grams[field]
+        index = int(np.searchsorted(grams, gram))
+        if index >= len(grams) or grams[index] != gram:
+            return _EMPTY
+        starts = self._starts[field]
+        return self._positions[field][starts[index]:starts[index + 1]]
+
+    def _field_candidates(self, field: str, query: str) -> List[int]:
+        """1つのフィールドで検索語を含む商品位置（昇順）"""
+        lists = sorted((self._posting(field, gram) for gram in _query_grams(query)), key=len)
+        if not lists or not len(lists[0]):
+            return []
+
+        # 最も短いポスティングリストを起点に、他のリストに含まれるものだけを残す
+        candidates = lists[0]
+        for posting in lists[1:]:
+            index = np.minimum(np.searchsorted(posting, candidates), len(posting) - 1)
+            candidates = candidates[posting[index] == candidates]
+            if not len(candidates):
+                return []
+
+        # 2文字以下の検索語はN-gramそのものなので、ポスティングリストの時点で確定する
+        if len(query) <= 2:
+            return candidates.tolist()
+
+        # N-gramの一致だけでは連続しているとは限らないため、実テキストで照合する
+        # （UTF-8のバイト列どうしの部分一致は、文字列どうしの部分一致と同じ結果になる）
+        pattern = query.encode("utf-8")
+        data, offsets = self._text_data[field], self._text_offsets[field]
+        return [
+            position for position in candidates.tolist()
+            if pattern in data[offsets[position]:offsets[position + 1]].tobytes()
+        ]
+
+    def search(self, query: str, fields: Sequence[str]) -> int:
+        """
+        いずれかのフィールドに検索語を部分文字列として含む商品のビットマップ
+
+        Args:
+            query: 検索語（正規化前）
+            fields: 検索対象のフィールド名
+        """
+        query = normalize_text(query)
+        if not query:
+            return (1 << self.size) - 1
+
+        bitmap = 0
+        for field in fields:
+            bitmap |= bitmap_from_positions(self._field_candidates(field, query))
+        return bitmap
@@ -0,0 +1,243 @@
+"""
+ソート順ごとの事前計算済み並び順とカーソルページネーション
+
+スナップショットの構築時にソート順ごとの商品位置の並び（順列）を計算しておき、
+検索時は絞り込み結果をその並びに沿ってたどるだけでページを切り出す。
+並びとソートキーは配列（文字列のキーは文字列表）で持ち、コンパイル済みカタログではメモリマップしたまま参照する。
+"""
+import base64
+import json
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from app.api.utils.catalog_binary import CompiledCatalogError, CompiledReader, CompiledWriter
+from app.api.utils.catalog_records import StringTable
+
+# ソート順 → (ソートキーの取り出し方, 降順かどうか)
+SORT_KEYS: Dict[str, Tuple[Callable[[dict], Any], bool]] = {
+    "price_asc": (lambda p: p.get("price", 0), False),
+    "price_desc": (lambda p: p.get("price", 0), True),
+    "moteru_score_desc": (lambda p: p.get("evaluation", {}).get("moteru_score", 0), True),
+    "created_at_desc": (lambda p: p.get("created_at", ""), True),
+}
+
+# 絞り込み結果がこの割合より少ない場合は、並びをたどらずに結果だけを並べ替える
+SPARSE_RATIO = 8
+
+# 並びをたどるときに一度に確認する件数
+WALK_CHUNK = 1024
+
+
+class InvalidCursor(ValueError):
+    """カーソルが不正"""
+
+
+# ソートキーの列（数値は float64 の配列、文字列は文字列表、それ以外はリストのまま）
+KeyColumn = Union[np.ndarray, StringTable, List[Any]]
+
+
+def _key_column(values: List[Any]) -> KeyColumn:
+    """並び順のソートキーを列にする（数値は float64 で正確に表せる場合だけ配列にする）"""
+    if all(type(value) in (int, float, bool) and float(value) == value for value in values):
+        return np.array(values, dtype=np.float64)
+    if all(type(value) is str for value in values):
+        return StringTable.from_strings(values)
+    return values
+
+
+class SortedOrder:
+    """1つのソート順の並び"""
+
+    def __init__(self, products: Sequence[dict], key: Callable[[dict], Any], descending: bool):
+        values = [key(product) for product in products]
+        # 同じキーの商品はカタログ順を保つ（安定ソート）
+        positions = sorted(range(len(products)), key=values.__getitem__, reverse=descending)
+        self.positions = np.array(positions, dtype=np.int64)
+        self.keys = _key_column([values[position] for position in positions])
+        self.ranks = np.empty(len(products), dtype=np.int64)
+        self.ranks[self.positions] = np.arange(len(products), dtype=np.int64)
+        self.descending = descending
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに書き出す（ソートキーは数値・文字列なら配列、それ以外は表）"""
+        if isinstance(self.keys, np.ndarray):
+            writer.add_table(name, {"descending": self.descending, "keys": "number"})
+            writer.add_array(f"{name}.keys", self.keys)
+        elif isinstance(self.keys, StringTable):
+            writer.add_table(name, {"descending": self.descending, "keys": "string"})
+            self.keys.to_compiled(writer, f"{name}.keys")
+        else:
+            writer.add_table(name, {"descending": self.descending, "keys": "json", "values": self.keys})
+        writer.add_array(f"{name}.positions", self.positions)
+        writer.add_array(f"{name}.ranks", self.ranks)
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str, size: int) -> "SortedOrder":
+        """コンパイル済みカタログの配列を参照する並びを作成"""
+        table = reader.table(name)
+        order = cls.__new__(cls)
+        order.positions = reader.array(f"{name}.positions", np.int64, (size,), limit=size)
+        order.ranks = reader.array(f"{name}.ranks", np.int64, (size,), limit=size)
+        kind = table["keys"]
+        if kind == "number":
+            order.keys = reader.array(f"{name}.keys", np.float64, (size,))
+        elif kind == "string":
+            order.keys = StringTable.from_compiled(reader, f"{name}.keys", size)
+        elif kind == "json" and len(table["values"]) == size:
+            order.keys = list(table["values"])
+        else:
+            raise CompiledCatalogError(f"ソートキーの表が不正です: {name}")
+        order.descending = bool(table["descending"])
+        return order
+
+    def key(self, rank: int) -> Any:
+        """順位 rank の商品のソートキー（数値の列では float）"""
+        value = self.keys[rank]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def seek(self, key: Any) -> int:
+        """キーが key と等しいか、それより後ろに並ぶ最初の順位を二分探索する"""
+        low, high = 0, len(self.keys)
+        while low < high:
+            middle = (low + high) // 2
+            before = self.key(middle) > key if self.descending else self.key(middle) < key
+            if before:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def page(self, mask: np.ndarray, count: int, start_rank: int, skip: int, limit: int) -> Tuple[List[int], Optional[int]]:
+        """
+        絞り込み結果から1ページ分の商品位置を並び順に取り出す
+
+        Args:
+            mask: 絞り込み結果のマスク
+            count: 絞り込み結果の件数
+            start_rank: たどり始める順位
+            skip: 読み飛ばす件数
+            limit: 取り出す件数
+
+        Returns:
+            (商品位置のリスト, 最後に取り出した商品の順位)
+        """
+        size = len(self.positions)
+        if not count or limit <= 0 or start_rank >= size:
+            return [], None
+
+        if count * SPARSE_RATIO < size:
+            # 結果が少ない場合は、結果だけを順位で並べ替える
+            ranks = np.sort(self.ranks[np.flatnonzero(mask)])
+            ranks = ranks[np.searchsorted(ranks, start_rank):][skip:skip + limit]
+        else:
+            # 並び順に区間ごとにたどり、ページが埋まった時点で打ち切る
+            found = []
+            needed = limit
+            rank = start_rank
+            while rank < size and needed > 0:
+                hits = np.flatnonzero(mask[self.positions[rank:rank + WALK_CHUNK]]) + rank
+                if skip:
+                    skipped = min(skip, len(hits))
+                    hits = hits[skipped:]
+                    skip -= skipped
+                hits = hits[:needed]
+                found.append(hits)
+                needed -= len(hits)
+                rank += WALK_CHUNK
+            ranks = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+        if not len(ranks):
+            return [], None
+        return self.positions[ranks].tolist(), int(ranks[-1])
+
+    def iter_chunks(self, mask: np.ndarray, chunk: int = WALK_CHUNK) -> Iterator[np.ndarray]:
+        """
+        絞り込み結果の商品位置を並び順に区間ごとに返す（全件のエクスポート用）
+
+        一度に保持するのは1区間分の商品位置だけで、結果全体のリストは作らない。
+        """
+        for rank in range(0, len(self.positions), chunk):
+            positions = self.positions[rank:rank + chunk]
+            hits = positions[mask[positions]]
+            if len(hits):
+                yield hits
+
+
+class SortedOrders:
+    """ソート順ごとの並びの集合"""
+
+    def __init__(self, products: Sequence[dict]):
+        self.products = products
+        self._orders = {
+            name: SortedOrder(products, key, descending)
+            for name, (key, descending) in SORT_KEYS.items()
+        }
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに書き出す"""
+        for order_name, order in self._orders.items():
+            order.to_compiled(writer, f"{name}.{order_name}")
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str, products: Sequence[dict]) -> "SortedOrders":
+        """コンパイル済みカタログの配列を参照する並びの集合を作成"""
+        orders = cls.__new__(cls)
+        orders.products = products
+        orders._orders = {
+            order_name: SortedOrder.from_compiled(reader, f"{name}.{order_name}", len(products))
+            for order_name in SORT_KEYS
+        }
+        return orders
+
+    def __getitem__(self, name: str) -> SortedOrder:
+        return self._orders[name]
+
+    def encode_cursor(self, name: str, version: str, rank: int) -> str:
+        """最後に返した商品の位置から次ページのカーソルを作成"""
+        order = self._orders[name]
+        position = int(order.positions[rank])
+        payload = {
+            "s": name,
+            "v": version,
+            "r": rank,
+            # 数値の列は float で持つため、キーは商品から取り出し直す（元の型のまま返す）
+            "k": SORT_KEYS[name][0](self.products[position]),
+            "id": self.products[position].get("product_id"),
+        }
+        raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+    def decode_cursor(self, name: str, version: str, cursor: str) -> int:
+        """
+        カーソルから次にたどり始める順位を求める
+
+        カタログが再読み込みされていた場合は、ソートキーと商品IDで位置を探し直す（キーセット方式）。
+        """
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            payload = json.loads(raw)
+            cursor_sort, cursor_version = payload["s"], payload["v"]
+            rank, key, product_id = int(payload["r"]), payload["k"], payload["id"]
+        except (ValueError, KeyError, TypeError):
+            raise InvalidCursor("カーソルが不正です")
+
+        if cursor_sort != name:
+            raise InvalidCursor("カーソルのソート順が一致しません")
+
+        order = self._orders[name]
+        if cursor_version == version:
+            return max(rank + 1, 0)
+
+        try:
+            start = order.seek(key)
+        except TypeError:
+            raise InvalidCursor("カーソルが不正です")
+        # 同じキーの商品の中から、前回最後に返した商品を探す
+        rank = start
+        while rank < len(order.positions) and order.key(rank) == key:
+            if self.products[int(order.positions[rank])].get("product_id") == product_id:
+                return rank + 1
+            rank += 1
+        # 見つからない場合は、同じキーの先頭からたどり直す（取りこぼしを防ぐ）
+        return start
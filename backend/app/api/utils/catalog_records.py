@@ -0,0 +1,227 @@
+"""
+商品レコードの遅延デコード
+
+商品データを1件ずつJSONにエンコードして連結したバイト列（data）と、
+各レコードの開始位置（offsets）として保持する。
+コンパイル済みカタログではどちらもメモリマップしたファイルを直接参照し、
+レコードは参照されたときに初めてdictへデコードする（直近のものはキャッシュする）。
+同じ持ち方の文字列表（StringTable）と、それを使った商品IDの索引（ProductPositions）も置く。
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+import numpy as np
+
+from app.api.utils.catalog_binary import CompiledCatalogError, CompiledReader, CompiledWriter
+
+# デコード済みレコードをキャッシュする件数（環境変数で上書き可能）
+RECORD_CACHE_SIZE = int(os.getenv("CATALOG_RECORD_CACHE_SIZE", "4096"))
+
+
+def _encode_record(product: dict) -> bytes:
+    return json.dumps(product, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class ProductRecords(Sequence):
+    """
+    遅延デコードされる商品レコードの列（tuple of dict と同じように添字で参照できる）
+
+    返すdictはキャッシュとして共有されるため、スナップショットの商品と同様に読み取り専用として扱うこと。
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray, cache_size: int = RECORD_CACHE_SIZE):
+        self.data = data
+        self.offsets = offsets
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[int, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_products(cls, products: Sequence[dict]) -> "ProductRecords":
+        """商品データのリストからレコード列を作成"""
+        encoded = [_encode_record(product) for product in products]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(record) for record in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(data, offsets)
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに配列として書き出す"""
+        writer.add_array(f"{name}.data", self.data)
+        writer.add_array(f"{name}.offsets", self.offsets)
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str) -> "ProductRecords":
+        """コンパイル済みカタログの配列を参照するレコード列を作成"""
+        data = reader.array(f"{name}.data", np.uint8, (None,))
+        offsets = reader.array(f"{name}.offsets", np.int64, (None,))
+        if not len(offsets) or offsets[0] != 0 or offsets[-1] != len(data) or np.any(offsets[1:] < offsets[:-1]):
+            raise CompiledCatalogError(f"レコードの開始位置が不正です: {name}")
+        return cls(data, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _position(self, index: int) -> int:
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("商品の位置が範囲外です")
+        return index
+
+    def raw(self, index: int) -> bytes:
+        """エンコード済みのレコード（JSON）"""
+        position = self._position(index)
+        return self.data[self.offsets[position]:self.offsets[position + 1]].tobytes()
+
+    def __getitem__(self, index: int) -> dict:
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        position = self._position(index)
+        with self._lock:
+            record = self._cache.get(position)
+            if record is not None:
+                self._cache.move_to_end(position)
+                return record
+
+        record = json.loads(self.raw(position))
+        with self._lock:
+            self._cache[position] = record
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return record
+
+    def __iter__(self) -> Iterator[dict]:
+        # 全件を順にたどる場合はキャッシュを使わない
+        for position in range(len(self)):
+            yield json.loads(self.raw(position))
+
+
+class StringTable(Sequence):
+    """
+    文字列の列（UTF-8のバイト列を連結した配列と各文字列の開始位置）
+
+    コンパイル済みカタログではどちらもメモリマップしたファイルを直接参照し、
+    文字列は参照されたときにデコードする。
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings: Sequence[str]) -> "StringTable":
+        """文字列のリストから文字列表を作成"""
+        encoded = [string.encode("utf-8", "surrogatepass") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに配列として書き出す"""
+        writer.add_array(f"{name}.data", self.data)
+        writer.add_array(f"{name}.offsets", self.offsets)
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str, size: Optional[int] = None) -> "StringTable":
+        """コンパイル済みカタログの配列を参照する文字列表を作成"""
+        data = reader.array(f"{name}.data", np.uint8, (None,))
+        offsets = reader.array(f"{name}.offsets", np.int64, (None if size is None else size + 1,))
+        if not len(offsets) or offsets[0] != 0 or offsets[-1] != len(data) or np.any(offsets[1:] < offsets[:-1]):
+            raise CompiledCatalogError(f"文字列の開始位置が不正です: {name}")
+        return cls(data, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def raw(self, index: int) -> bytes:
+        """エンコード済みの文字列（UTF-8）"""
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+    def __getitem__(self, index: int) -> str:
+        if not 0 <= index < len(self):
+            raise IndexError("文字列の位置が範囲外です")
+        return self.raw(index).decode("utf-8", "surrogatepass")
+
+
+class ProductPositions:
+    """
+    商品ID → 商品の位置（IDが重複している場合は先頭の商品）
+
+    文字列のIDはUTF-8のバイト列の順に並べた文字列表と位置の配列で持ち、二分探索で引く
+    （コンパイル済みカタログではメモリマップしたまま参照する）。
+    文字列でないID（IDがない商品など）だけは dict で持つ。
+    """
+
+    def __init__(self, ids: StringTable, positions: np.ndarray, others: Dict[Any, int]):
+        self._ids = ids
+        self._positions = positions
+        self._others = others
+
+    @classmethod
+    def from_products(cls, products: Sequence[dict]) -> "ProductPositions":
+        """商品データのリストから作成"""
+        first: Dict[bytes, int] = {}
+        others: Dict[Any, int] = {}
+        for position, product in enumerate(products):
+            product_id = product.get("product_id")
+            if isinstance(product_id, str):
+                first.setdefault(product_id.encode("utf-8", "surrogatepass"), position)
+            else:
+                others.setdefault(product_id, position)
+        keys = sorted(first)
+        ids = StringTable.from_strings([key.decode("utf-8", "surrogatepass") for key in keys])
+        return cls(ids, np.array([first[key] for key in keys], dtype=np.int64), others)
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに書き出す（文字列でないIDは表）"""
+        self._ids.to_compiled(writer, f"{name}.ids")
+        writer.add_array(f"{name}.positions", self._positions)
+        writer.add_table(name, [[product_id, position] for product_id, position in self._others.items()])
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str, size: int) -> "ProductPositions":
+        """コンパイル済みカタログの配列を参照する索引を作成"""
+        ids = StringTable.from_compiled(reader, f"{name}.ids")
+        positions = reader.array(f"{name}.positions", np.int64, (len(ids),), limit=size)
+        others = {}
+        for product_id, position in reader.table(name):
+            if isinstance(product_id, (str, list, dict)) or not 0 <= position < size:
+                raise CompiledCatalogError(f"商品IDの表が不正です: {name}")
+            others[product_id] = position
+        return cls(ids, positions, others)
+
+    def get(self, product_id: Any, default: Optional[int] = None) -> Optional[int]:
+        """商品IDの位置（存在しない場合は default）"""
+        if not isinstance(product_id, str):
+            try:
+                return self._others.get(product_id, default)
+            except TypeError:
+                return default
+        key = product_id.encode("utf-8", "surrogatepass")
+        low, high = 0, len(self._ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self._ids.raw(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self._ids) and self._ids.raw(low) == key:
+            return int(self._positions[low])
+        return default
+
+    def __getitem__(self, product_id: Any) -> int:
+        position = self.get(product_id)
+        if position is None:
+            raise KeyError(product_id)
+        return position
+
+    def __contains__(self, product_id: Any) -> bool:
+        return self.get(product_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._others)
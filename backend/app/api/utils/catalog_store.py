@@ -0,0 +1,381 @@
+"""
+商品・テンプレートカタログの共有ストア
+
+products.json / templates.json を一度だけ読み込み、バージョン付きの
+不変スナップショットとして全ルーターに共有する。
+ファイルの更新時刻（mtime）を監視し、変更があればバックグラウンドで
+読み込み直してスナップショットをアトミックに差し替える。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+from app.api.utils.brand_style_scores import StyleScoreMatrix
+from app.api.utils.catalog_binary import CompiledReader, CompiledWriter, read_compiled
+from app.api.utils.related_products import RelatedProductsTable
+from app.api.utils.catalog_columns import CatalogColumns
+from app.api.utils.catalog_index import AttributeIndex
+from app.api.utils.catalog_ngram import NgramIndex
+from app.api.utils.catalog_order import SortedOrders
+from app.api.utils.catalog_records import ProductPositions, ProductRecords
+from app.api.utils.product_summaries import ProductSummaries
+from app.api.utils.template_resolver import TemplateProducts
+
+logger = logging.getLogger(__name__)
+
+# データファイルのパス
+# backend/app/api/utils/catalog_store.py から見て、プロジェクトルートのdata/
+BASE_DIR = Path(__file__).parent.parent.parent.parent.parent
+PRODUCTS_FILE = BASE_DIR / "data" / "products" / "products.json"
+TEMPLATES_FILE = BASE_DIR / "data" / "templates" / "templates.json"
+
+if not PRODUCTS_FILE.exists():
+    # 代替パスを試す
+    alt_path = Path(__file__).parent.parent.parent.parent / "data" / "products" / "products.json"
+    if alt_path.exists():
+        PRODUCTS_FILE = alt_path
+
+if not TEMPLATES_FILE.exists():
+    # 代替パスを試す
+    alt_path = Path(__file__).parent.parent.parent.parent / "data" / "templates" / "templates.json"
+    if alt_path.exists():
+        TEMPLATES_FILE = alt_path
+
+# コンパイル済みカタログ（catalog_compiler で作成。元データと一致する場合はJSONの代わりに読み込む）
+COMPILED_FILE = Path(os.getenv("CATALOG_COMPILED_FILE", str(PRODUCTS_FILE.parent.parent / "catalog.bin")))
+
+# ファイル変更の監視間隔（秒）
+RELOAD_INTERVAL = float(os.getenv("CATALOG_RELOAD_INTERVAL", "2.0"))
+
+# ファイルの状態（存在しない場合はNone）
+FileStamp = Optional[Tuple[int, int]]
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    """
+    カタログの不変スナップショット
+
+    スナップショットは全リクエストで共有されるため、
+    products / templates の各レコードは読み取り専用として扱うこと。
+    products はJSONから構築した場合は dict のタプル、コンパイル済みカタログから読み込んだ場合は
+    参照時にデコードするレコード列（ProductRecords）になる。
+    """
+    version: str
+    products_version: str
+    templates_version: str
+    products: Sequence[dict]
+    templates: Tuple[dict, ...]
+    products_mtime: float
+    templates_mtime: float
+    loaded_at: float
+    attributes: AttributeIndex
+    orders: SortedOrders
+    ngrams: NgramIndex
+    columns: CatalogColumns
+    style_scores: StyleScoreMatrix
+    product_positions: ProductPositions
+    related: RelatedProductsTable
+    summaries: ProductSummaries
+    template_products: TemplateProducts
+
+    def get_product(self, product_id: str) -> Optional[dict]:
+        """商品IDから商品を取得（整列済みの商品IDの二分探索）"""
+        position = self.product_positions.get(product_id)
+        if position is None:
+            return None
+        return self.products[position]
+
+
+def _file_stamp(path: Path) -> FileStamp:
+    """ファイルの更新時刻とサイズを取得"""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _digest(raw: bytes) -> str:
+    """ファイル内容のダイジェスト（スナップショットのバージョン）"""
+    return hashlib.sha1(raw).hexdigest()[:12]
+
+
+def _file_digest(path: Path) -> str:
+    """ファイルのダイジェスト（ファイルが存在しない場合は空の内容として扱う）"""
+    # ファイル全体をメモリに読み込まないよう、区切って計算する
+    digest = hashlib.sha1()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        pass
+    return digest.hexdigest()[:12]
+
+
+def _read_json(path: Path, key: str) -> Tuple[Optional[List[dict]], str]:
+    """
+    JSONファイルを読み込み、指定キーのリストとダイジェストを返す
+
+    ファイルが存在しない場合は空リスト、JSONが不正な場合はNoneを返す。
+    """
+    try:
+        raw = path.read_bytes()
+    except FileNotFoundError:
+        return [], _digest(b"")
+
+    digest = _digest(raw)
+    try:
+        data = json.loads(raw)
+    except json.JSONDecodeError:
+        return None, digest
+    return data.get(key, []), digest
+
+
+def _stamp_mtime(stamp: FileStamp) -> float:
+    """FileStampから更新時刻（秒）を取得"""
+    return stamp[0] / 1e9 if stamp else 0.0
+
+
+def build_snapshot(
+    products: List[dict],
+    templates: List[dict],
+    products_version: str,
+    templates_version: str,
+    products_mtime: float = 0.0,
+    templates_mtime: float = 0.0,
+    previous: Optional[CatalogSnapshot] = None,
+) -> CatalogSnapshot:
+    """
+    読み込んだデータからスナップショットと検索用インデックスを構築
+
+    previous を渡すと、内容が変わっていない商品の計算結果を引き継ぐ。
+    """
+    products = tuple(products)
+
+    templates = tuple(templates)
+    attributes = AttributeIndex(products)
+    ngrams = NgramIndex(products)
+    columns = CatalogColumns(products)
+
+    return CatalogSnapshot(
+        version=f"{products_version}-{templates_version}",
+        products_version=products_version,
+        templates_version=templates_version,
+        products=products,
+        templates=templates,
+        products_mtime=products_mtime,
+        templates_mtime=templates_mtime,
+        loaded_at=time.time(),
+        attributes=attributes,
+        orders=SortedOrders(products),
+        ngrams=ngrams,
+        columns=columns,
+        style_scores=StyleScoreMatrix(products, previous.style_scores if previous else None),
+        # 商品ID → 位置（IDが重複している場合は先頭の商品を優先）
+        product_positions=ProductPositions.from_products(products),
+        related=RelatedProductsTable(products),
+        summaries=ProductSummaries(products),
+        template_products=TemplateProducts(templates, attributes, ngrams, columns),
+    )
+
+
+def dump_snapshot(snapshot: CatalogSnapshot, writer: CompiledWriter) -> None:
+    """スナップショットをコンパイル済みカタログの配列と表として書き出す"""
+    # 商品データはdictのまま保存せず、読み込み時に1件ずつデコードするレコード列にする
+    products = snapshot.products
+    if not isinstance(products, ProductRecords):
+        products = ProductRecords.from_products(products)
+    products.to_compiled(writer, "products")
+    writer.add_table("templates", list(snapshot.templates))
+    snapshot.product_positions.to_compiled(writer, "product_positions")
+    snapshot.attributes.to_compiled(writer, "attributes")
+    snapshot.orders.to_compiled(writer, "orders")
+    snapshot.ngrams.to_compiled(writer, "ngrams")
+    snapshot.columns.to_compiled(writer, "columns")
+    snapshot.style_scores.to_compiled(writer, "style_scores")
+    snapshot.related.to_compiled(writer, "related")
+    snapshot.template_products.to_compiled(writer, "template_products")
+
+
+def load_snapshot(reader: CompiledReader, products_mtime: float = 0.0, templates_mtime: float = 0.0) -> CatalogSnapshot:
+    """コンパイル済みカタログの配列と表からスナップショットを作成（インデックスの構築は行わない）"""
+    products_version = reader.metadata["products_version"]
+    templates_version = reader.metadata["templates_version"]
+    products = ProductRecords.from_compiled(reader, "products")
+    size = len(products)
+    return CatalogSnapshot(
+        version=f"{products_version}-{templates_version}",
+        products_version=products_version,
+        templates_version=templates_version,
+        products=products,
+        templates=tuple(reader.table("templates")),
+        products_mtime=products_mtime,
+        templates_mtime=templates_mtime,
+        loaded_at=time.time(),
+        attributes=AttributeIndex.from_compiled(reader, "attributes", size),
+        orders=SortedOrders.from_compiled(reader, "orders", products),
+        ngrams=NgramIndex.from_compiled(reader, "ngrams", size),
+        columns=CatalogColumns.from_compiled(reader, "columns", size),
+        style_scores=StyleScoreMatrix.from_compiled(reader, "style_scores", size),
+        product_positions=ProductPositions.from_compiled(reader, "product_positions", size),
+        related=RelatedProductsTable.from_compiled(reader, "related", size),
+        summaries=ProductSummaries(products),
+        template_products=TemplateProducts.from_compiled(reader, "template_products", size),
+    )
+
+
+class CatalogStore:
+    """カタログの読み込み・キャッシュ・ホットリロードを管理する"""
+
+    def __init__(
+        self,
+        products_file: Path,
+        templates_file: Path,
+        reload_interval: float = RELOAD_INTERVAL,
+        compiled_file: Optional[Path] = None,
+    ):
+        self.products_file = products_file
+        self.templates_file = templates_file
+        self.compiled_file = compiled_file
+        self.reload_interval = reload_interval
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._stamps: Tuple[FileStamp, FileStamp, FileStamp] = (None, None, None)
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[CatalogSnapshot], Any]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def snapshot(self) -> CatalogSnapshot:
+        """現在のスナップショットを取得（未読み込みの場合は読み込む）"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.reload_if_changed()
+            snapshot = self._snapshot
+        return snapshot
+
+    def add_listener(self, callback: Callable[[CatalogSnapshot], Any]) -> None:
+        """スナップショット差し替え時に呼ばれるコールバックを登録"""
+        self._listeners.append(callback)
+
+    def reload_if_changed(self) -> bool:
+        """
+        ファイルが変更されていれば読み込み直す
+
+        Returns:
+            スナップショットを差し替えた場合はTrue
+        """
+        with self._lock:
+            stamps = (
+                _file_stamp(self.products_file),
+                _file_stamp(self.templates_file),
+                _file_stamp(self.compiled_file) if self.compiled_file else None,
+            )
+            if self._snapshot is not None and stamps == self._stamps:
+                return False
+
+            previous = self._snapshot
+            snapshot = self._load_compiled(stamps)
+            if snapshot is None:
+                products, products_version = _read_json(self.products_file, "products")
+                templates, templates_version = _read_json(self.templates_file, "テンプレート")
+
+                if products is None or templates is None:
+                    if previous is not None:
+                        # 書き込み途中などでJSONが不正な場合は、直前のスナップショットを使い続ける
+                        logger.warning("カタログのJSONが不正なため、再読み込みをスキップします")
+                        return False
+                    products = products if products is not None else []
+                    templates = templates if templates is not None else []
+
+                snapshot = build_snapshot(
+                    products,
+                    templates,
+                    products_version=products_version,
+                    templates_version=templates_version,
+                    products_mtime=_stamp_mtime(stamps[0]),
+                    templates_mtime=_stamp_mtime(stamps[1]),
+                    previous=previous,
+                )
+            self._snapshot = snapshot
+            self._stamps = stamps
+
+        logger.info(
+            f"カタログを読み込みました: version={snapshot.version} "
+            f"products={len(snapshot.products)} templates={len(snapshot.templates)}"
+        )
+        for callback in self._listeners:
+            try:
+                callback(snapshot)
+            except Exception as e:
+                logger.error(f"カタログ更新リスナーでエラーが発生しました: {str(e)}")
+        return True
+
+    def _load_compiled(self, stamps: Tuple[FileStamp, FileStamp, FileStamp]) -> Optional[CatalogSnapshot]:
+        """
+        コンパイル済みカタログを読み込む（使えない場合はNone）
+
+        元データのJSONの内容のダイジェストが、コンパイル時に記録したものと一致するときだけ使う。
+        JSONが存在しない場合は一致を確認できないため使わない。
+        """
+        products_stamp, templates_stamp, compiled_stamp = stamps
+        if compiled_stamp is None:
+            return None
+        if products_stamp is None or templates_stamp is None:
+            logger.warning(f"元データのJSONがないため、コンパイル済みカタログを使いません: {self.compiled_file}")
+            return None
+
+        # 形式の不正はどこで見つかっても（配列の型・表の欠落など）JSONからの読み込みに切り替える
+        try:
+            reader = read_compiled(self.compiled_file)
+            versions = (reader.metadata.get("products_version"), reader.metadata.get("templates_version"))
+            if versions != (_file_digest(self.products_file), _file_digest(self.templates_file)):
+                logger.info("コンパイル済みカタログが元データと一致しないため、JSONから読み込みます")
+                return None
+            return load_snapshot(
+                reader,
+                products_mtime=_stamp_mtime(products_stamp),
+                templates_mtime=_stamp_mtime(templates_stamp),
+            )
+        except Exception as e:
+            logger.warning(f"コンパイル済みカタログを読み込めないため、JSONから読み込みます: {str(e)}")
+            return None
+
+    async def start(self) -> None:
+        """初回読み込みを行い、ファイル監視タスクを開始"""
+        await asyncio.to_thread(self.reload_if_changed)
+        if self._task is None and self.reload_interval > 0:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        """ファイル監視タスクを停止"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self) -> None:
+        """ファイルの変更を定期的に確認し、変更があれば別スレッドで読み込む"""
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await asyncio.to_thread(self.reload_if_changed)
+            except Exception as e:
+                logger.error(f"カタログの再読み込みでエラーが発生しました: {str(e)}")
+
+
+catalog_store = CatalogStore(PRODUCTS_FILE, TEMPLATES_FILE, compiled_file=COMPILED_FILE)
+
+
+def get_catalog() -> CatalogSnapshot:
+    """現在のカタログスナップショットを取得"""
+    return catalog_store.snapshot()
@@ -0,0 +1,188 @@
+"""
+外部API呼び出しのサーキットブレーカーと適応タイムアウト
+
+- CircuitBreaker: 失敗（または応答時間の予算超過）が連続したら回路を開き、一定時間は呼び出さずに
+  すぐ失敗させる。時間が経ったら試しに1件だけ通し（半開）、成功すれば閉じる
+- LatencyTracker: 直近の応答時間を保持し、パーセンタイルからタイムアウトを決める
+"""
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+import numpy as np
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """回路が開いているため呼び出さなかった"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} の回路が開いています（{retry_after:.1f}秒後に再開）")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """連続した失敗で呼び出しを止めるサーキットブレーカー"""
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        open_seconds: float = 30.0,
+        latency_budget: Optional[float] = None,
+    ):
+        """
+        Args:
+            name: 名前（ログ・統計情報用）
+            failure_threshold: 回路を開く連続失敗回数
+            open_seconds: 回路を開いておく時間（秒）
+            latency_budget: 応答時間の予算（秒）。超えた呼び出しは成功しても失敗として数える
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.latency_budget = latency_budget
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.rejected = 0
+        self.times_opened = 0
+
+    def retry_after(self) -> float:
+        """呼び出しを再開するまでの秒数（閉じている場合は0）"""
+        if self.state != STATE_OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        """呼び出してよいか（よい場合は呼び出し後に record_success / record_failure を呼ぶこと）"""
+        if self.state == STATE_OPEN and self.retry_after() <= 0:
+            self.state = STATE_HALF_OPEN
+        if self.state == STATE_HALF_OPEN:
+            # 半開状態では試しの1件だけを通す
+            if self._trial_in_flight:
+                self.rejected += 1
+                return False
+            self._trial_in_flight = True
+        elif self.state == STATE_OPEN:
+            self.rejected += 1
+            return False
+        self.calls += 1
+        return True
+
+    def check(self) -> None:
+        """呼び出してよいか確認し、だめなら CircuitOpenError を送出する"""
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_after())
+
+    def record_success(self, latency: float) -> None:
+        """呼び出しの成功を記録（応答時間が予算を超えた場合は失敗として数える）"""
+        if self.latency_budget is not None and latency > self.latency_budget:
+            self.slow_calls += 1
+            self._on_failure()
+            return
+        self.successes += 1
+        self.consecutive_failures = 0
+        self._trial_in_flight = False
+        self.state = STATE_CLOSED
+
+    def record_failure(self) -> None:
+        """呼び出しの失敗を記録"""
+        self.failures += 1
+        self._on_failure()
+
+    def release(self) -> None:
+        """結果を記録せずに呼び出しを終える（キャンセルされた場合など。半開状態では次の試しを通せるようにする）"""
+        self._trial_in_flight = False
+
+    def _on_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == STATE_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self) -> None:
+        self.state = STATE_OPEN
+        self._opened_at = time.monotonic()
+        self._trial_in_flight = False
+        self.times_opened += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """状態と統計情報"""
+        return {
+            "state": self.state,
+            "retry_after": round(self.retry_after(), 2),
+            "consecutive_failures": self.consecutive_failures,
+            "calls": self.calls,
+            "successes": self.successes,
+            "failures": self.failures,
+            "slow_calls": self.slow_calls,
+            "rejected": self.rejected,
+            "times_opened": self.times_opened,
+        }
+
+
+class LatencyTracker:
+    """直近の応答時間からタイムアウトを決める"""
+
+    def __init__(
+        self,
+        window: int = 200,
+        percentile: float = 99.0,
+        multiplier: float = 2.0,
+        min_timeout: float = 1.0,
+        max_timeout: float = 10.0,
+        min_samples: int = 20,
+    ):
+        """
+        Args:
+            window: 保持する応答時間の件数
+            percentile: タイムアウトの基準にするパーセンタイル
+            multiplier: パーセンタイルに掛ける倍率
+            min_timeout: タイムアウトの下限（秒。max_timeout を超える場合は max_timeout）
+            max_timeout: タイムアウトの上限（秒。記録が少ないうちはこの値を使う）
+            min_samples: パーセンタイルを使い始める記録の件数
+        """
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def observe(self, latency: float) -> None:
+        """応答時間を記録"""
+        self._samples.append(latency)
+
+    def quantile(self, percentile: float) -> Optional[float]:
+        """直近の応答時間のパーセンタイル（記録がなければNone）"""
+        if not self._samples:
+            return None
+        return float(np.percentile(np.fromiter(self._samples, dtype=np.float64), percentile))
+
+    def timeout(self) -> float:
+        """現在のタイムアウト（秒）"""
+        if len(self._samples) < self.min_samples:
+            return self.max_timeout
+        timeout = self.quantile(self.percentile) * self.multiplier
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def stats(self) -> Dict[str, Any]:
+        """応答時間の統計情報"""
+        def rounded(value: Optional[float]) -> Optional[float]:
+            return None if value is None else round(value, 4)
+
+        return {
+            "samples": len(self._samples),
+            "p50": rounded(self.quantile(50)),
+            "p95": rounded(self.quantile(95)),
+            "p99": rounded(self.quantile(99)),
+            "timeout": round(self.timeout(), 3),
+        }
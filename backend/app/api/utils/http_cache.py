@@ -0,0 +1,90 @@
+"""
+HTTPの条件付きリクエスト（ETag / Last-Modified）
+
+カタログ・テンプレートのバージョンとリクエストパラメータからETagを作り、
+If-None-Match / If-Modified-Since が一致すればハンドラの処理を行わずに 304 を返す。
+"""
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, Optional
+
+from fastapi import Request, Response
+
+# ブラウザ・CDNにキャッシュを許可する秒数（環境変数で上書き可能）
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "60"))
+
+
+def make_etag(*parts: Any) -> str:
+    """バージョンやパラメータから強いETagを作る"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return '"' + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20] + '"'
+
+
+@dataclass(frozen=True)
+class CacheValidators:
+    """レスポンスの検証子（ETag と最終更新時刻）"""
+    etag: str
+    last_modified: float = 0.0
+    max_age: int = HTTP_CACHE_MAX_AGE
+
+    def headers(self) -> dict:
+        """レスポンスに付けるキャッシュ関連のヘッダー"""
+        headers = {
+            "ETag": self.etag,
+            "Cache-Control": f"public, max-age={self.max_age}",
+        }
+        if self.last_modified > 0:
+            headers["Last-Modified"] = formatdate(self.last_modified, usegmt=True)
+        return headers
+
+    def apply(self, response: Response) -> None:
+        """レスポンスにキャッシュ関連のヘッダーを付ける"""
+        response.headers.update(self.headers())
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match にETagが含まれるか（GETでは弱い比較を行う）"""
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _not_modified_since(if_modified_since: str, last_modified: float) -> bool:
+    """If-Modified-Since 以降に更新されていないか"""
+    if last_modified <= 0:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since is None:
+        return False
+    # HTTPの日付は秒単位のため、更新時刻も秒に切り捨てて比較する
+    return int(last_modified) <= since.timestamp()
+
+
+def not_modified_response(request: Request, validators: CacheValidators) -> Optional[Response]:
+    """
+    条件付きリクエストが一致すれば 304 レスポンスを返す（一致しなければNone）
+
+    If-None-Match がある場合はそちらを優先し、If-Modified-Since は無視する。
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        matched = _etag_matches(if_none_match, validators.etag)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        matched = if_modified_since is not None and _not_modified_since(if_modified_since, validators.last_modified)
+
+    if not matched:
+        return None
+    return Response(status_code=304, headers=validators.headers())
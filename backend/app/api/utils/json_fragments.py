@@ -0,0 +1,50 @@
+"""
+エンコード済みJSON断片の連結によるレスポンス生成
+
+事前にJSONへエンコードした断片（JSONFragment）をそのまま埋め込み、
+一覧レスポンスを断片の連結だけで組み立てる。
+出力はStarletteの JSONResponse と同じ形式（ensure_ascii=False、区切りは "," と ":"）。
+"""
+import json
+from typing import Any
+
+from fastapi import Response
+
+
+class JSONFragment(bytes):
+    """エンコード済みのJSON値"""
+
+
+def _encode(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_members(**members: Any) -> bytes:
+    """オブジェクトのメンバー部分（"key":value,...）をエンコード（引数の順を保つ）"""
+    return _encode(members)[1:-1]
+
+
+def fragment(value: Any) -> JSONFragment:
+    """値をエンコードしてJSON断片にする"""
+    return JSONFragment(_encode(value))
+
+
+def dumps(value: Any) -> bytes:
+    """JSON断片を含む値をエンコード（断片は再エンコードせずにそのまま埋め込む）"""
+    if isinstance(value, JSONFragment):
+        return value
+    if isinstance(value, dict):
+        return b"{" + b",".join(_encode(str(key)) + b":" + dumps(item) for key, item in value.items()) + b"}"
+    if isinstance(value, (list, tuple)):
+        return b"[" + b",".join(dumps(item) for item in value) + b"]"
+    return _encode(value)
+
+
+class FragmentJSONResponse(Response):
+    """JSON断片を連結して本文を作るレスポンス（bytesはエンコード済みの本文として扱う）"""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
@@ -0,0 +1,51 @@
+"""
+存在しないキーのネガティブキャッシュ
+
+ボットなどが存在しないIDを繰り返し問い合わせる場合に、
+カタログのバージョンごとに「存在しない」という結果を覚えておく。
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+
+class NegativeCache:
+    """件数上限と有効期限つきの「存在しないキー」の集合"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._version = None
+        self._entries: "OrderedDict[Hashable, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, version: str, key: Hashable) -> bool:
+        """キーが存在しないと記録されているか"""
+        with self._lock:
+            if version != self._version:
+                # カタログが更新されたら記録を破棄する
+                self._version = version
+                self._entries.clear()
+            expires_at = self._entries.get(key)
+            if expires_at is None or expires_at < time.monotonic():
+                if expires_at is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, version: str, key: Hashable) -> None:
+        """キーが存在しないことを記録"""
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._entries.clear()
+            self._entries[key] = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
@@ -0,0 +1,341 @@
+"""
+外部APIへの送信を非同期に行うためのアウトボックス
+
+リクエストの処理中は送信内容をローカルのSQLiteに書き込むだけにして、すぐにレスポンスを返す。
+バックグラウンドのワーカーが書き込まれた送信内容を取り出し、種類ごとのハンドラーで送信する。
+失敗した場合は指数バックオフで再試行し、上限回数を超えたものは dead（送信失敗）として残す。
+再試行しても成功しない失敗（PermanentFailure）は、再試行せずにすぐ dead として残す。
+dead にしたものは送信内容（メールアドレスなどの個人情報）を消して種類とエラーだけを残し、
+保存期間（OUTBOX_DEAD_RETENTION）を過ぎたら削除する。
+
+取り出した送信内容には一定時間のリース（next_attempt_at）を設定するため、
+送信中にプロセスが停止した場合も、リースの期限が過ぎれば再び送信される（少なくとも1回の送信）。
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# アウトボックスのファイル（backend/var/ 以下。環境変数で上書き可能）
+OUTBOX_FILE = Path(os.getenv("OUTBOX_FILE", str(Path(__file__).parent.parent.parent.parent / "var" / "outbox.sqlite3")))
+
+# 再試行・ワーカーの設定（環境変数で上書き可能）
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))
+# dead（送信失敗）を残しておく秒数（デフォルト: 7日）
+OUTBOX_DEAD_RETENTION = float(os.getenv("OUTBOX_DEAD_RETENTION", str(7 * 24 * 3600)))
+
+STATUS_PENDING = "pending"
+STATUS_DEAD = "dead"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+"""
+
+# 送信内容の種類 → 送信処理（失敗した場合は例外を送出する）
+Handler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class RetryLater(Exception):
+    """
+    送信先が一時的に受け付けない（サーキットブレーカーが開いているなど）
+
+    ハンドラーが送出すると、試行回数を増やさずに delay 秒後に再送する。
+    """
+
+    def __init__(self, delay: float, message: str = ""):
+        super().__init__(message or f"{delay:.1f}秒後に再送します")
+        self.delay = delay
+
+
+class PermanentFailure(Exception):
+    """
+    再試行しても成功しない失敗（設定の不足や、リクエスト内容を拒否する4xxなど）
+
+    ハンドラーが送出すると、再試行せずにすぐ dead（送信失敗）として残す。
+    """
+
+
+@dataclass(frozen=True)
+class OutboxEntry:
+    """アウトボックスの送信内容1件"""
+    id: int
+    kind: str
+    payload: Dict[str, Any]
+    attempts: int
+
+
+def backoff_delay(attempts: int, base: float = OUTBOX_BACKOFF_BASE, maximum: float = OUTBOX_BACKOFF_MAX) -> float:
+    """attempts 回目の失敗後、次の再試行までの待ち時間（指数バックオフ。再試行が重ならないよう半分までずらす）"""
+    delay = min(maximum, base * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class Outbox:
+    """SQLiteに保存するアウトボックス"""
+
+    def __init__(self, path: Path = OUTBOX_FILE):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def enqueue(self, kind: str, payload: Dict[str, Any]) -> int:
+        """送信内容を書き込む（コミット後に返る）"""
+        now = time.time()
+        with self._lock:
+            cursor = self._connect().execute(
+                "INSERT INTO outbox (kind, payload, next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False), now, now, now),
+            )
+            return cursor.lastrowid
+
+    def claim_due(self, limit: int = OUTBOX_BATCH_SIZE, lease: float = OUTBOX_LEASE) -> List[OutboxEntry]:
+        """
+        送信時刻になったものを取り出す
+
+        取り出したものは試行回数を増やし、リースの期限まで他のワーカーから取り出されないようにする。
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = connection.execute(
+                    "SELECT id, kind, payload, attempts FROM outbox "
+                    "WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?",
+                    (STATUS_PENDING, now, limit),
+                ).fetchall()
+                connection.executemany(
+                    "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, updated_at = ? WHERE id = ?",
+                    [(now + lease, now, row[0]) for row in rows],
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+        entries = []
+        for entry_id, kind, payload, attempts in rows:
+            try:
+                decoded = json.loads(payload)
+            except ValueError:
+                self.mark_dead(entry_id, "送信内容のJSONが不正です")
+                continue
+            entries.append(OutboxEntry(id=entry_id, kind=kind, payload=decoded, attempts=attempts + 1))
+        return entries
+
+    def mark_done(self, entry_id: int) -> None:
+        """送信済みのものを削除"""
+        with self._lock:
+            self._connect().execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def mark_retry(self, entry_id: int, delay: float, error: str, count_attempt: bool = True) -> None:
+        """
+        送信に失敗したものを、delay 秒後に再試行する
+
+        count_attempt がFalseの場合は、今回の試行を試行回数に数えない。
+        """
+        now = time.time()
+        with self._lock:
+            self._connect().execute(
+                "UPDATE outbox SET next_attempt_at = ?, last_error = ?, updated_at = ?, "
+                "attempts = attempts - ? WHERE id = ?",
+                (now + delay, error, now, 0 if count_attempt else 1, entry_id),
+            )
+
+    def mark_dead(self, entry_id: int, error: str) -> None:
+        """再試行しないもの（送信失敗）として残す（送信内容は個人情報を含むため消す）"""
+        now = time.time()
+        with self._lock:
+            self._connect().execute(
+                "UPDATE outbox SET status = ?, payload = '{}', last_error = ?, updated_at = ? WHERE id = ?",
+                (STATUS_DEAD, error, now, entry_id),
+            )
+
+    def purge_dead(self, retention: float = OUTBOX_DEAD_RETENTION) -> int:
+        """保存期間を過ぎた dead（送信失敗）を削除し、削除した件数を返す"""
+        with self._lock:
+            cursor = self._connect().execute(
+                "DELETE FROM outbox WHERE status = ? AND updated_at < ?",
+                (STATUS_DEAD, time.time() - retention),
+            )
+            return cursor.rowcount
+
+    def stats(self) -> Dict[str, int]:
+        """状態ごとの件数"""
+        with self._lock:
+            rows = self._connect().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        counts = {STATUS_PENDING: 0, STATUS_DEAD: 0}
+        counts.update(rows)
+        return counts
+
+
+class OutboxWorker:
+    """アウトボックスの送信内容を取り出して送信するバックグラウンドタスク"""
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        poll_interval: float = OUTBOX_POLL_INTERVAL,
+    ):
+        self.outbox = outbox
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._handlers: Dict[str, Handler] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.delivered = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        self.deferred = 0
+        self.purged = 0
+        self._purged_at = 0.0
+
+    def register_handler(self, kind: str, handler: Handler) -> None:
+        """送信内容の種類ごとの送信処理を登録"""
+        self._handlers[kind] = handler
+
+    async def enqueue(self, kind: str, payload: Dict[str, Any]) -> int:
+        """送信内容を書き込み、ワーカーを起こす"""
+        entry_id = await asyncio.to_thread(self.outbox.enqueue, kind, payload)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return entry_id
+
+    async def start(self) -> None:
+        """ワーカーを開始"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """ワーカーを停止（送信中のものは、次回の起動時にリースの期限が過ぎてから再送される）"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.outbox.close)
+
+    async def _run(self) -> None:
+        while True:
+            await self._purge_dead()
+            try:
+                entries = await asyncio.to_thread(self.outbox.claim_due)
+                if entries:
+                    await asyncio.gather(*(self._deliver(entry) for entry in entries))
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"アウトボックスの処理でエラーが発生しました: {str(e)}")
+
+            # 新しい送信内容が書き込まれるか、次の確認時刻まで待つ
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _purge_dead(self) -> None:
+        """保存期間を過ぎた dead を削除（1時間に1回まで）"""
+        now = time.monotonic()
+        if self._purged_at and now - self._purged_at < 3600:
+            return
+        self._purged_at = now
+        try:
+            self.purged += await asyncio.to_thread(self.outbox.purge_dead)
+        except Exception as e:
+            logger.error(f"アウトボックスの dead の削除でエラーが発生しました: {str(e)}")
+
+    async def _deliver(self, entry: OutboxEntry) -> None:
+        """1件を送信し、結果をアウトボックスに記録する"""
+        handler = self._handlers.get(entry.kind)
+        permanent = handler is None
+        if handler is None:
+            error = f"送信処理が登録されていません: {entry.kind}"
+        else:
+            try:
+                await handler(entry.payload)
+            except RetryLater as e:
+                await asyncio.to_thread(self.outbox.mark_retry, entry.id, e.delay, str(e), False)
+                self.deferred += 1
+                return
+            except PermanentFailure as e:
+                error = str(e) or type(e).__name__
+                permanent = True
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            else:
+                await asyncio.to_thread(self.outbox.mark_done, entry.id)
+                self.delivered += 1
+                return
+
+        self.failed += 1
+        if permanent or entry.attempts >= self.max_attempts:
+            logger.error(f"アウトボックスの送信を中止しました: id={entry.id} kind={entry.kind} attempts={entry.attempts} error={error}")
+            await asyncio.to_thread(self.outbox.mark_dead, entry.id, error)
+            self.dead_lettered += 1
+            return
+
+        delay = backoff_delay(entry.attempts)
+        logger.warning(f"アウトボックスの送信に失敗しました（{delay:.1f}秒後に再試行）: id={entry.id} kind={entry.kind} error={error}")
+        await asyncio.to_thread(self.outbox.mark_retry, entry.id, delay, error)
+
+    async def stats(self) -> Dict[str, Any]:
+        """統計情報"""
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "entries": await asyncio.to_thread(self.outbox.stats),
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "dead_lettered": self.dead_lettered,
+            "deferred": self.deferred,
+            "purged": self.purged,
+        }
+
+
+outbox_worker = OutboxWorker(Outbox())
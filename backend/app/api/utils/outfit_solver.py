@@ -0,0 +1,139 @@
+"""
+予算内のコーディネート（スロットごとに1点ずつの組み合わせ）の探索
+
+スロット（トップス・パンツ・靴など）ごとの候補から1点ずつ選び、合計価格が予算以内で
+モテる度スコアの合計が高い組み合わせを上位N件求める。
+
+- 候補の削減: 同じスロットに「価格が同じか安く、スコアが同じか高い」商品がN件以上ある商品は
+  上位N件の組み合わせに入り得ないため、探索の前に除く
+- 分枝限定法: スコアの高い候補から順に深さ優先で組み合わせ、残りのスロットの最高スコアを
+  足しても上位N件に届かない枝と、残りのスロットの最安値を足すと予算を超える枝を打ち切る
+"""
+import heapq
+import os
+from dataclasses import dataclass
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+# 探索する組み合わせ（節点）数の上限。超えた場合はそれまでに見つかった組み合わせを返す（環境変数で上書き可能）
+OUTFIT_MAX_NODES = int(os.getenv("OUTFIT_MAX_NODES", "200000"))
+
+
+@dataclass(frozen=True)
+class Outfit:
+    """コーディネート1件（スロットの順に商品の位置を持つ）"""
+    positions: Tuple[int, ...]
+    total_price: float
+    total_score: float
+
+
+def _frontier(candidates: np.ndarray, prices: np.ndarray, scores: np.ndarray, keep: int) -> List[Tuple[int, float, float]]:
+    """
+    スロットの候補から、上位の組み合わせに入り得る商品だけを残す
+
+    Returns:
+        (位置, 価格, スコア) のリスト（スコアの降順、同点は価格の昇順）
+    """
+    # 価格の昇順（同じ価格ならスコアの降順）にたどり、それまでの上位keep件のスコアと比べる
+    order = candidates[np.lexsort((candidates, -scores[candidates], prices[candidates]))]
+    best: List[float] = []
+    kept = []
+    for position in order.tolist():
+        score = float(scores[position])
+        if len(best) < keep:
+            heapq.heappush(best, score)
+        elif score > best[0]:
+            heapq.heapreplace(best, score)
+        else:
+            continue
+        kept.append((position, float(prices[position]), score))
+    kept.sort(key=lambda item: (-item[2], item[1], item[0]))
+    return kept
+
+
+class _Search:
+    """分枝限定法による上位N件の探索"""
+
+    def __init__(self, slots: List[List[Tuple[int, float, float]]], budget: float, top_n: int, max_nodes: int):
+        self.slots = slots
+        self.budget = budget
+        self.top_n = top_n
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        # 上位N件（スコア, -合計価格, 位置）の最小ヒープ
+        self.best: List[Tuple[float, float, Tuple[int, ...]]] = []
+
+        # k番目以降のスロットの最安値の合計・最高スコアの合計
+        self.min_price_after = [0.0] * (len(slots) + 1)
+        self.max_score_after = [0.0] * (len(slots) + 1)
+        for k in range(len(slots) - 1, -1, -1):
+            self.min_price_after[k] = self.min_price_after[k + 1] + min(price for _, price, _ in slots[k])
+            self.max_score_after[k] = self.max_score_after[k + 1] + slots[k][0][2]
+
+    def run(self) -> List[Outfit]:
+        if self.min_price_after[0] <= self.budget:
+            self._visit(0, 0.0, 0.0, ())
+        ranked = sorted(self.best, key=lambda item: (-item[0], -item[1], item[2]))
+        return [
+            Outfit(positions=positions, total_price=-negative_price, total_score=score)
+            for score, negative_price, positions in ranked
+        ]
+
+    def _visit(self, k: int, spent: float, score: float, chosen: Tuple[int, ...]) -> bool:
+        """k番目のスロットから先を探索する（節点数の上限に達したらFalse）"""
+        if k == len(self.slots):
+            entry = (score, -spent, chosen)
+            if len(self.best) < self.top_n:
+                heapq.heappush(self.best, entry)
+            elif entry > self.best[0]:
+                heapq.heapreplace(self.best, entry)
+            return True
+
+        remaining = self.budget - spent - self.min_price_after[k + 1]
+        for position, price, item_score in self.slots[k]:
+            # 候補はスコアの降順のため、上限に届かなくなったら以降の候補も届かない
+            if len(self.best) == self.top_n and score + item_score + self.max_score_after[k + 1] < self.best[0][0]:
+                break
+            if price > remaining or position in chosen:
+                continue
+            self.nodes += 1
+            if self.nodes > self.max_nodes:
+                return False
+            if not self._visit(k + 1, spent + price, score + item_score, chosen + (position,)):
+                return False
+        return True
+
+
+def solve_outfits(
+    slots: Sequence[np.ndarray],
+    prices: np.ndarray,
+    scores: np.ndarray,
+    budget: float,
+    top_n: int,
+    max_nodes: int = OUTFIT_MAX_NODES,
+) -> List[Outfit]:
+    """
+    予算内でスコアの合計が高いコーディネートを上位N件求める
+
+    同じ商品を複数のスロットで使う組み合わせは除く。
+
+    Args:
+        slots: スロットごとの候補（商品の位置の配列）
+        prices: 商品の価格（位置で引く）
+        scores: 商品のスコア（位置で引く）
+        budget: 合計価格の上限
+        top_n: 求める件数
+        max_nodes: 探索する節点数の上限
+
+    Returns:
+        コーディネートのリスト（スコアの合計の降順、同点は合計価格の昇順）
+    """
+    if not slots or top_n <= 0:
+        return []
+    # 別のスロットと同じ商品を選べない場合に備えて、スロット数分だけ多めに残す
+    keep = top_n + len(slots) - 1
+    frontiers = [_frontier(np.asarray(candidates), prices, scores, keep) for candidates in slots]
+    if any(not frontier for frontier in frontiers):
+        return []
+    return _Search(frontiers, budget, top_n, max_nodes).run()
@@ -0,0 +1,64 @@
+"""
+商品サマリー（一覧レスポンス用の射影）のJSON断片
+
+検索・推薦・ブランドスタイルマッチングの一覧で返す11項目のサマリーを、
+カタログのバージョンごとに商品1件につき一度だけJSONへエンコードして保持する。
+推薦スコアなどクエリごとに変わる項目は、moteru_score と returnable の間に差し込む。
+"""
+from typing import List, Optional, Sequence, Tuple
+
+from app.api.utils.json_fragments import JSONFragment, encode_members
+
+# サマリーの項目（レスポンスでの並び順）
+SUMMARY_HEAD_FIELDS = ("product_id", "name", "category", "brand", "price", "image_url")
+SUMMARY_TAIL_FIELDS = ("returnable", "in_stock", "url", "affiliate_url")
+SUMMARY_FIELDS = SUMMARY_HEAD_FIELDS + ("moteru_score",) + SUMMARY_TAIL_FIELDS
+
+
+def product_summary(product: dict) -> dict:
+    """商品のサマリー（dict版）"""
+    summary = {field: product.get(field) for field in SUMMARY_HEAD_FIELDS}
+    summary["moteru_score"] = product.get("evaluation", {}).get("moteru_score")
+    summary.update((field, product.get(field)) for field in SUMMARY_TAIL_FIELDS)
+    return summary
+
+
+def _encode_parts(product: dict) -> Tuple[bytes, bytes]:
+    """サマリーを差し込み位置の前後に分けてエンコード"""
+    summary = product_summary(product)
+    head = encode_members(**{field: summary[field] for field in SUMMARY_HEAD_FIELDS + ("moteru_score",)})
+    tail = encode_members(**{field: summary[field] for field in SUMMARY_TAIL_FIELDS})
+    return head, tail
+
+
+class ProductSummaries:
+    """
+    商品サマリーのJSON断片
+
+    エンコードは初めて参照されたときに行い、スナップショットが有効な間は結果を使い回す。
+    """
+
+    def __init__(self, products: Sequence[dict]):
+        self._products = products
+        self._parts: List[Optional[Tuple[bytes, bytes]]] = [None] * len(products)
+
+    def _get_parts(self, position: int) -> Tuple[bytes, bytes]:
+        parts = self._parts[position]
+        if parts is None:
+            # 同時に参照されても結果は同じため、ロックせずに書き込む
+            parts = _encode_parts(self._products[position])
+            self._parts[position] = parts
+        return parts
+
+    def fragment(self, position: int, extra: bytes = b"") -> JSONFragment:
+        """
+        商品サマリーのJSON断片
+
+        Args:
+            position: 商品の位置
+            extra: moteru_score の後に差し込むエンコード済みのメンバー（encode_members の結果）
+        """
+        head, tail = self._get_parts(position)
+        if extra:
+            return JSONFragment(b"{" + head + b"," + extra + b"," + tail + b"}")
+        return JSONFragment(b"{" + head + b"," + tail + b"}")
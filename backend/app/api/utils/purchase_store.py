@@ -0,0 +1,226 @@
+"""
+購入情報の保存（追記のみ）
+
+購入情報はSQLite（WALモード）に追記する。書き込みは1つのバックグラウンドタスクに集め、
+同時に届いた購入をまとめて1回のトランザクション（グループコミット）で保存するため、
+セール時など購入が集中しても、購入1件ごとにfsyncすることはない。
+呼び出し側はコミットが完了するまで待ってからレスポンスを返す（返した購入は失われない）。
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 購入情報のファイル（backend/var/ 以下。環境変数で上書き可能）
+PURCHASES_FILE = Path(os.getenv("PURCHASES_FILE", str(Path(__file__).parent.parent.parent.parent / "var" / "purchases.sqlite3")))
+
+# グループコミットの設定: 1回にまとめる最大件数と、後続の購入を待つ時間（秒。0なら待たない）
+PURCHASE_COMMIT_MAX_BATCH = int(os.getenv("PURCHASE_COMMIT_MAX_BATCH", "256"))
+PURCHASE_COMMIT_DELAY = float(os.getenv("PURCHASE_COMMIT_DELAY", "0"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS purchases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    purchase_id TEXT NOT NULL UNIQUE,
+    offer_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    email TEXT,
+    name TEXT,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS purchases_email ON purchases (email, id);
+CREATE INDEX IF NOT EXISTS purchases_offer ON purchases (offer_id, id);
+"""
+
+_COLUMNS = ("purchase_id", "offer_id", "type", "email", "name", "status", "created_at")
+
+
+class PurchaseStore:
+    """SQLiteに保存する購入情報"""
+
+    def __init__(self, path: Path = PURCHASES_FILE):
+        self.path = path
+        # 書き込み用と読み込み用で接続を分ける（WALモードではコミット中も読み込める）
+        self._writer: Optional[sqlite3.Connection] = None
+        self._reader: Optional[sqlite3.Connection] = None
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=FULL")
+        connection.executescript(_SCHEMA)
+        return connection
+
+    def close(self) -> None:
+        with self._write_lock, self._read_lock:
+            for connection in (self._writer, self._reader):
+                if connection is not None:
+                    connection.close()
+            self._writer = None
+            self._reader = None
+
+    def append_many(self, purchases: List[Dict[str, Any]]) -> None:
+        """購入情報をまとめて1回のトランザクションで追記する"""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            connection = self._writer
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(
+                    f"INSERT INTO purchases ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' for _ in _COLUMNS)})",
+                    [tuple(purchase[column] for column in _COLUMNS) for purchase in purchases],
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def find(self, email: Optional[str] = None, offer_id: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """メールアドレス・オファーIDで購入情報を検索（新しい順）"""
+        conditions = []
+        params: List[Any] = []
+        if email is not None:
+            conditions.append("email = ?")
+            params.append(email)
+        if offer_id is not None:
+            conditions.append("offer_id = ?")
+            params.append(offer_id)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        with self._read_lock:
+            if self._reader is None:
+                self._reader = self._connect()
+            rows = self._reader.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM purchases {where}ORDER BY id DESC LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+        return [dict(zip(_COLUMNS, row)) for row in rows]
+
+
+class PurchaseWriter:
+    """購入情報の書き込みを1つのタスクに集めてグループコミットする"""
+
+    def __init__(
+        self,
+        store: PurchaseStore,
+        max_batch: int = PURCHASE_COMMIT_MAX_BATCH,
+        delay: float = PURCHASE_COMMIT_DELAY,
+    ):
+        self.store = store
+        self.max_batch = max_batch
+        self.delay = delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.commits = 0
+        self.purchases = 0
+        self.largest_batch = 0
+
+    async def start(self) -> None:
+        """書き込みタスクを開始"""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """書き込みタスクを停止（受け付け済みの購入は保存してから止める）"""
+        if self._task is not None:
+            await self._queue.join()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._queue = None
+        await asyncio.to_thread(self.store.close)
+
+    async def append(
+        self,
+        offer_id: str,
+        purchase_type: str,
+        email: Optional[str],
+        name: Optional[str],
+        status: str,
+    ) -> Dict[str, Any]:
+        """
+        購入情報を保存する（コミットが完了してから返る）
+
+        Returns:
+            保存した購入情報（purchase_id と created_at を含む）
+        """
+        purchase = {
+            "purchase_id": uuid.uuid4().hex,
+            "offer_id": offer_id,
+            "type": purchase_type,
+            "email": email,
+            "name": name,
+            "status": status,
+            "created_at": time.time(),
+        }
+        if self._task is None:
+            # 書き込みタスクが動いていない場合（起動処理を通さない利用など）はその場で保存する
+            await asyncio.to_thread(self.store.append_many, [purchase])
+            return purchase
+
+        committed = asyncio.get_running_loop().create_future()
+        await self._queue.put((purchase, committed))
+        await committed
+        return purchase
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self.delay > 0:
+                # 後続の購入を少しだけ待って、同じコミットにまとめる
+                await asyncio.sleep(self.delay)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._commit(batch)
+
+    async def _commit(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        """まとめた購入を1回のトランザクションで保存し、待っている呼び出し側に結果を返す"""
+        try:
+            await asyncio.to_thread(self.store.append_many, [purchase for purchase, _ in batch])
+        except Exception as e:
+            logger.error(f"購入情報の保存に失敗しました（{len(batch)}件）: {str(e)}")
+            for _, committed in batch:
+                if not committed.done():
+                    committed.set_exception(e)
+        else:
+            self.commits += 1
+            self.purchases += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            for _, committed in batch:
+                if not committed.done():
+                    committed.set_result(None)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    async def find(self, email: Optional[str] = None, offer_id: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """メールアドレス・オファーIDで購入情報を検索（新しい順）"""
+        return await asyncio.to_thread(self.store.find, email, offer_id, limit)
+
+    def stats(self) -> Dict[str, Any]:
+        """統計情報"""
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "commits": self.commits,
+            "purchases": self.purchases,
+            "largest_batch": self.largest_batch,
+        }
+
+
+purchase_writer = PurchaseWriter(PurchaseStore())
@@ -0,0 +1,138 @@
+"""
+検索・推薦結果のキャッシュ
+
+よく使われる検索条件（デフォルトのソート・1ページ目・人気のカテゴリやシーンなど）の
+結果を、正規化した検索条件とカタログのバージョンをキーに保持する。
+件数・メモリ量の上限を超えたものは古い順（LRU）に、有効期限を過ぎたものは参照時に破棄する。
+カタログが読み込み直されたときは clear_all() で全キャッシュを破棄する。
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+# キャッシュの設定（環境変数で上書き可能）
+QUERY_CACHE_MAXSIZE = int(os.getenv("QUERY_CACHE_MAXSIZE", "1024"))
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "300"))
+
+# 作成されたキャッシュの一覧（一括破棄・統計情報用）
+_caches: List["QueryCache"] = []
+
+
+def _normalize_value(value: Any) -> Hashable:
+    """キーに使う値を正規化（Enumは値に揃える）"""
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def _estimate_size(value: Any) -> int:
+    """キャッシュする値のおおよそのメモリ量（JSONにした場合のバイト数）"""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+class QueryCache:
+    """件数・メモリ量の上限と有効期限つきのLRUキャッシュ"""
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int = QUERY_CACHE_MAXSIZE,
+        max_bytes: int = QUERY_CACHE_MAX_BYTES,
+        ttl: float = QUERY_CACHE_TTL,
+    ):
+        self.name = name
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _caches.append(self)
+
+    @staticmethod
+    def make_key(version: str, **params: Any) -> Tuple:
+        """カタログのバージョンと検索条件からキーを作る（未指定の条件は無視する）"""
+        items = tuple(sorted(
+            (name, _normalize_value(value)) for name, value in params.items() if value is not None
+        ))
+        return (version, items)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """キャッシュされた値を取得（なければNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        値をキャッシュする
+
+        キャッシュした値はそのままレスポンスとして共有されるため、呼び出し側で書き換えないこと。
+        """
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.current_bytes += size
+            while len(self._entries) > self.maxsize or self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """全エントリを破棄"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        """統計情報"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_entries": self.maxsize,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def clear_all(*_: Any) -> None:
+    """全キャッシュを破棄（カタログ更新リスナーとして登録する）"""
+    for cache in _caches:
+        cache.clear()
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """全キャッシュの統計情報"""
+    return {cache.name: cache.stats() for cache in _caches}
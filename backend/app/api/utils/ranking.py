@@ -0,0 +1,98 @@
+"""
+ランキング用の上位k件選択
+
+- top_k_indices: NumPy配列のスコアから部分選択で上位k件を求める
+- TopK: 候補を区間ごとに受け取りながら上位k件だけを保持する（ストリーミング版）
+"""
+import os
+from typing import Iterator, Optional
+
+import numpy as np
+
+# ストリーミング選択で一度に評価する商品の件数（環境変数で上書き可能）
+RANK_CHUNK = int(os.getenv("RANK_CHUNK", "65536"))
+
+
+def top_k_indices(scores: np.ndarray, k: int, tiebreak: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    スコアの上位k件の添字を、スコアの降順で返す
+
+    全件をソートせず、部分選択でk番目のスコアを求めてから候補だけを並べ替える。
+    同点の場合は tiebreak の降順、それも同じ場合は添字の昇順（元の並び順）とする。
+
+    Args:
+        scores: スコアの配列
+        k: 取り出す件数
+        tiebreak: 同点時に比較する第2のスコア（省略可）
+
+    Returns:
+        上位k件の添字の配列
+    """
+    size = len(scores)
+    if k <= 0 or size == 0:
+        return np.empty(0, dtype=np.int64)
+
+    if k < size:
+        # k番目に大きいスコア以上のものだけを候補にする（同点はすべて残す）
+        threshold = np.partition(scores, size - k)[size - k]
+        selected = np.flatnonzero(scores >= threshold)
+    else:
+        selected = np.arange(size)
+
+    # np.lexsort は最後のキーを第1キーとして昇順に並べる
+    keys = [selected]
+    if tiebreak is not None:
+        keys.append(-tiebreak[selected])
+    keys.append(-scores[selected])
+    return selected[np.lexsort(keys)[:k]]
+
+
+def iter_mask_chunks(mask: np.ndarray, chunk: int = RANK_CHUNK) -> Iterator[np.ndarray]:
+    """
+    マスクが真の商品位置を、カタログ順に区間ごとに返す
+
+    絞り込み結果全体の位置の配列は作らず、一度に保持するのは1区間分だけ。
+    """
+    for start in range(0, len(mask), chunk):
+        positions = np.flatnonzero(mask[start:start + chunk])
+        if len(positions):
+            yield positions + start
+
+
+class TopK:
+    """
+    上位k件だけを保持しながら候補を受け取る（ストリーミング版の top_k_indices）
+
+    候補は区間ごとに push し、そのたびに保持中のk件と合わせて部分選択で上位k件に絞る。
+    保持するのはk件分のID・スコアだけのため、候補全体のスコア配列を作らずに
+    O(n) の時間・O(k + 区間の大きさ) のメモリで動く。
+    同点の場合は tiebreak の降順、それも同じ場合は先に渡された候補を優先する（安定）。
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self.ids = np.empty(0, dtype=np.int64)
+        self.scores = np.empty(0, dtype=np.float64)
+        self.tiebreak = np.empty(0, dtype=np.float64)
+
+    def push(self, ids: np.ndarray, scores: np.ndarray, tiebreak: Optional[np.ndarray] = None) -> None:
+        """
+        候補を1区間分渡す
+
+        Args:
+            ids: 候補のID（商品位置など）
+            scores: 候補のスコア
+            tiebreak: 同点時に比較する第2のスコア（省略時は0）
+        """
+        if self.k <= 0 or len(ids) == 0:
+            return
+        if tiebreak is None:
+            tiebreak = np.zeros(len(ids), dtype=np.float64)
+        # 保持中の候補を先に並べることで、同点では先に渡された候補が残る
+        ids = np.concatenate([self.ids, ids])
+        scores = np.concatenate([self.scores, scores])
+        tiebreak = np.concatenate([self.tiebreak, tiebreak])
+        top = top_k_indices(scores, self.k, tiebreak)
+        self.ids = ids[top]
+        self.scores = scores[top]
+        self.tiebreak = tiebreak[top]
@@ -0,0 +1,124 @@
+"""
+関連商品の近傍テーブル
+
+商品ごとの関連商品の候補（優先順位順）をカタログの読み込み時に計算しておき、
+/related はテーブルを引くだけで O(limit) で応答する。
+
+優先順位: 同じカテゴリ（最大2件） > 同じシーン（最大2件） > 補完商品（最大2件） > モテる度が高い商品
+"""
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from app.api.utils.catalog_binary import CompiledReader, CompiledWriter
+from app.api.utils.ranking import TopK
+
+# 関連商品の最大件数（/related の limit の上限）
+MAX_RELATED = 10
+
+# 補完商品として扱うカテゴリ
+COMPLEMENTARY_CATEGORIES = ("時計", "ベルト", "バッグ", "小物")
+
+# モテる度が高いとみなす基準
+HIGH_MOTERU_SCORE = 4.0
+
+# 各候補グループで、先頭から保持しておく件数（自分自身や重複を除いても足りる件数）
+_HEAD_SIZE = 4
+
+
+def _moteru_score(product: dict) -> float:
+    """並び替え・モテる度が高い商品の判定に使うスコア（従来の /related と同じく商品直下の moteru_score）"""
+    return product.get("moteru_score", 0)
+
+
+class RelatedProductsTable:
+    """商品ごとの関連商品の候補（優先順位順の商品位置）"""
+
+    def __init__(self, products: Sequence[dict]):
+        size = len(products)
+        self.neighbors = np.full((size, MAX_RELATED), -1, dtype=np.int32)
+        # 同じカテゴリの商品の件数（limitに関係なく必ず候補に入る）
+        self.guaranteed = np.zeros(size, dtype=np.int8)
+        self.moteru_scores = np.array([_moteru_score(p) for p in products], dtype=np.float64)
+
+        # カテゴリ・シーンごとに、カタログ順で先頭の数件だけを集める
+        category_heads: Dict[object, List[int]] = {}
+        scene_heads: Dict[object, List[int]] = {}
+        high_moteru: List[int] = []
+        for position, product in enumerate(products):
+            head = category_heads.setdefault(product.get("category"), [])
+            if len(head) < _HEAD_SIZE:
+                head.append(position)
+            for scene in product.get("attributes", {}).get("scene", []):
+                head = scene_heads.setdefault(scene, [])
+                if len(head) < _HEAD_SIZE:
+                    head.append(position)
+            if len(high_moteru) < MAX_RELATED * 2 and self.moteru_scores[position] >= HIGH_MOTERU_SCORE:
+                high_moteru.append(position)
+
+        complementary_heads = {category: category_heads.get(category, []) for category in COMPLEMENTARY_CATEGORIES}
+
+        for position, product in enumerate(products):
+            product_id = product.get("product_id")
+            category = product.get("category")
+
+            def others(candidates):
+                """現在の商品を除いた候補（カタログ順）"""
+                return [p for p in sorted(set(candidates)) if products[p].get("product_id") != product_id]
+
+            # 1. 同じカテゴリの商品
+            same_category = others(category_heads.get(category, []))[:2]
+
+            # 2. 同じシーンの商品
+            scenes = product.get("attributes", {}).get("scene", [])
+            same_scene = others(p for scene in scenes for p in scene_heads.get(scene, []))[:2]
+
+            # 3. 補完商品（カテゴリが異なる小物など）
+            complementary = others(
+                p for other, head in complementary_heads.items() if other != category for p in head
+            )[:2]
+
+            # 4. モテる度が高い商品（残りを埋める）
+            related: List[int] = []
+            related_ids = set()
+            for group in (same_category, same_scene, complementary, others(high_moteru)):
+                for candidate in group:
+                    if len(related) >= MAX_RELATED:
+                        break
+                    candidate_id = products[candidate].get("product_id")
+                    if candidate_id not in related_ids:
+                        related.append(candidate)
+                        related_ids.add(candidate_id)
+
+            self.neighbors[position, :len(related)] = related
+            self.guaranteed[position] = len(same_category)
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに配列として書き出す"""
+        writer.add_array(f"{name}.neighbors", self.neighbors)
+        writer.add_array(f"{name}.guaranteed", self.guaranteed)
+        writer.add_array(f"{name}.moteru_scores", self.moteru_scores)
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str, size: int) -> "RelatedProductsTable":
+        """コンパイル済みカタログの配列を参照する近傍テーブルを作成"""
+        table = cls.__new__(cls)
+        table.neighbors = reader.array(f"{name}.neighbors", np.int32, (size, MAX_RELATED))
+        table.guaranteed = reader.array(f"{name}.guaranteed", np.int8, (size,))
+        table.moteru_scores = reader.array(f"{name}.moteru_scores", np.float64, (size,))
+        return table
+
+    def related(self, position: int, limit: int) -> List[int]:
+        """
+        関連商品の位置をモテる度の高い順に最大limit件返す
+
+        候補は優先順位順に並んでいるため、limit件（同じカテゴリの商品は必ず含める）の
+        先頭部分がそのまま limit を指定した場合の候補になる。
+        """
+        count = max(limit, int(self.guaranteed[position]))
+        candidates = self.neighbors[position, :count]
+        candidates = candidates[candidates >= 0]
+        # モテる度の高い順（同点は優先順位順）
+        top = TopK(limit)
+        top.push(candidates, self.moteru_scores[candidates])
+        return top.ids.tolist()
@@ -0,0 +1,193 @@
+"""
+テンプレートのアイテム条件から商品候補を解決する
+
+テンプレートの各アイテム（item_type と conditions）を、転置インデックス・N-gramインデックス・
+列データへの問い合わせに変換して評価する。
+アイテムの種類（item_type）に一致する在庫ありの商品を候補とし、conditions のうち満たした条件の数
+（同数ならモテる度スコア）の順に上位の候補を残す。
+解決結果はスナップショットの構築時に全テンプレート分を作成するため、
+テンプレートの商品候補APIはリクエストごとの照合を行わない。
+"""
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.api.utils.catalog_binary import CompiledCatalogError, CompiledReader, CompiledWriter
+from app.api.utils.catalog_columns import CatalogColumns, bitmap_to_mask
+from app.api.utils.catalog_index import AttributeIndex
+from app.api.utils.catalog_ngram import NgramIndex
+from app.api.utils.ranking import top_k_indices
+
+# アイテムごとに保持する候補の件数（環境変数で上書き可能）
+TEMPLATE_MAX_CANDIDATES = int(os.getenv("TEMPLATE_MAX_CANDIDATES", "20"))
+
+# 条件値の補足（「ポリエステル（通気性の良いもの）」の括弧内など）
+_NOTE_PATTERN = re.compile(r"[（(].*?[）)]")
+
+
+@dataclass(frozen=True)
+class TemplateSlot:
+    """テンプレートのアイテム1件分の解決結果"""
+    item_type: str
+    required: bool
+    conditions: Tuple[str, ...]
+    positions: np.ndarray
+    matched: np.ndarray
+
+
+def _terms(value: Any) -> List[str]:
+    """条件値を照合用の語のリストにする（補足の括弧書きは取り除く）"""
+    values = value if isinstance(value, list) else [value]
+    terms = []
+    for item in values:
+        if not isinstance(item, str):
+            continue
+        term = _NOTE_PATTERN.sub("", item).strip()
+        if term:
+            terms.append(term)
+    return terms
+
+
+def item_type_bitmap(attributes: AttributeIndex, ngrams: NgramIndex, item_type: str) -> int:
+    """アイテムの種類に該当する商品のビットマップ（カテゴリ・サブカテゴリ、なければ商品名で探す）"""
+    bitmap = attributes.lookup("category", item_type) | attributes.lookup("subcategory", item_type)
+    if not bitmap:
+        bitmap = ngrams.search(item_type, ("name",))
+    return bitmap
+
+
+class _Query:
+    """アイテム条件をインデックスへの問い合わせとして評価する"""
+
+    def __init__(self, attributes: AttributeIndex, ngrams: NgramIndex, columns: CatalogColumns):
+        self.attributes = attributes
+        self.ngrams = ngrams
+        self.columns = columns
+
+    def any_of(self, field: str, value: Any) -> int:
+        """属性値のいずれかに一致する商品のビットマップ"""
+        bitmap = 0
+        for term in _terms(value):
+            bitmap |= self.attributes.lookup(field, term)
+        return bitmap
+
+    def kind(self, value: Any) -> int:
+        """アイテムの種類に一致する商品のビットマップ（カテゴリ・サブカテゴリ・フィット・商品名）"""
+        bitmap = 0
+        for term in _terms(value):
+            bitmap |= self.attributes.lookup("category", term)
+            bitmap |= self.attributes.lookup("subcategory", term)
+            bitmap |= self.ngrams.search(term, ("name",))
+        return bitmap | self.any_of("fit", value)
+
+    def mask(self, bitmap: int) -> np.ndarray:
+        return bitmap_to_mask(bitmap, self.columns.size)
+
+
+# 条件名 → 条件を満たす商品のマスクの求め方（ここにない条件は照合に使わない）
+_CONDITIONS: Dict[str, Callable[[_Query, Any], np.ndarray]] = {
+    "type": lambda q, value: q.mask(q.kind(value)),
+    "specific_types": lambda q, value: q.mask(q.kind(value)),
+    "colors": lambda q, value: q.mask(q.any_of("colors", value)),
+    "design": lambda q, value: q.mask(q.any_of("design", value)),
+    "materials": lambda q, value: q.mask(q.any_of("materials", value)),
+    "fit": lambda q, value: q.mask(q.any_of("fit", value)),
+    "cleanliness": lambda q, value: q.mask(q.any_of("cleanliness", value)),
+    "trendiness": lambda q, value: q.mask(q.any_of("trendiness", value)),
+    "price_range": lambda q, value: q.columns.price_between(q.columns.all(), value.get("min"), value.get("max")),
+    "oversize_required": lambda q, value: q.columns.flag_is("oversize_lower_body", bool(value)),
+    "quality_focus": lambda q, value: q.columns.flag_is("quality_focus", bool(value)),
+}
+
+
+def _resolve_item(query: _Query, item: dict, limit: int) -> TemplateSlot:
+    """アイテム1件の候補を解決"""
+    item_type = item.get("item_type", "")
+    # 在庫切れの商品は候補にしない（在庫情報がない商品は在庫ありとみなす）
+    mask = query.mask(item_type_bitmap(query.attributes, query.ngrams, item_type))
+    mask &= query.columns.flag_truthy_or_missing("in_stock")
+    candidates = np.flatnonzero(mask)
+
+    conditions = []
+    matched = np.zeros(query.columns.size, dtype=np.int16)
+    for name, value in (item.get("conditions") or {}).items():
+        evaluate = _CONDITIONS.get(name)
+        if evaluate is None or (name == "price_range" and not isinstance(value, dict)):
+            continue
+        matched += evaluate(query, value)
+        conditions.append(name)
+
+    # 満たした条件の数の降順、同数ならモテる度スコアの降順
+    top = top_k_indices(matched[candidates], limit, query.columns.moteru_score[candidates])
+    positions = candidates[top].astype(np.int32)
+    return TemplateSlot(
+        item_type=item_type,
+        required=bool(item.get("required", False)),
+        conditions=tuple(conditions),
+        positions=positions,
+        matched=matched[positions],
+    )
+
+
+class TemplateProducts:
+    """テンプレートID → アイテムごとの商品候補（カタログのバージョンごとに構築）"""
+
+    def __init__(
+        self,
+        templates: Sequence[dict],
+        attributes: AttributeIndex,
+        ngrams: NgramIndex,
+        columns: CatalogColumns,
+        limit: int = TEMPLATE_MAX_CANDIDATES,
+    ):
+        query = _Query(attributes, ngrams, columns)
+        self._slots: Dict[str, Tuple[TemplateSlot, ...]] = {}
+        for template in templates:
+            template_id = template.get("template_id")
+            if template_id in self._slots:
+                continue
+            self._slots[template_id] = tuple(
+                _resolve_item(query, item, limit) for item in template.get("items", [])
+            )
+
+    def to_compiled(self, writer: CompiledWriter, name: str) -> None:
+        """コンパイル済みカタログに書き出す（候補は全アイテム分を連結した配列、アイテムの情報は表）"""
+        slots = [slot for template_slots in self._slots.values() for slot in template_slots]
+        writer.add_table(name, [
+            [template_id, [[slot.item_type, slot.required, list(slot.conditions), len(slot.positions)] for slot in template_slots]]
+            for template_id, template_slots in self._slots.items()
+        ])
+        writer.add_array(f"{name}.positions", np.concatenate([slot.positions for slot in slots] or [np.empty(0, dtype=np.int32)]))
+        writer.add_array(f"{name}.matched", np.concatenate([slot.matched for slot in slots] or [np.empty(0, dtype=np.int16)]))
+
+    @classmethod
+    def from_compiled(cls, reader: CompiledReader, name: str, size: int) -> "TemplateProducts":
+        """コンパイル済みカタログの配列を参照する商品候補を作成"""
+        positions = reader.array(f"{name}.positions", np.int32, (None,), limit=size)
+        matched = reader.array(f"{name}.matched", np.int16, (len(positions),))
+        products = cls.__new__(cls)
+        products._slots = {}
+        start = 0
+        for template_id, items in reader.table(name):
+            slots = []
+            for item_type, required, conditions, count in items:
+                end = start + int(count)
+                slots.append(TemplateSlot(
+                    item_type=item_type,
+                    required=bool(required),
+                    conditions=tuple(conditions),
+                    positions=positions[start:end],
+                    matched=matched[start:end],
+                ))
+                start = end
+            products._slots[template_id] = tuple(slots)
+        if start != len(positions):
+            raise CompiledCatalogError(f"商品候補の件数が一致しません: {name}")
+        return products
+
+    def slots(self, template_id: str) -> Optional[Tuple[TemplateSlot, ...]]:
+        """テンプレートのアイテムごとの候補（テンプレートがなければNone）"""
+        return self._slots.get(template_id)
@@ -1,24 +1,180 @@
 """
 Utage APIクライアント
+
+HTTPクライアントはアプリケーション全体で1つを共有し（起動時に作成、終了時に閉じる）、
+Utage APIへの接続をキープアライブで使い回す。
+呼び出しはサーキットブレーカーを通し、失敗や遅延が続いた場合は一定時間すぐに失敗を返す。
+読み込みのタイムアウトは直近の応答時間のパーセンタイルに合わせて調整する。
 """
 import os
+import time
 import httpx
 from typing import Optional, Dict, Any
 import logging
+from app.api.utils.circuit_breaker import CircuitBreaker, CircuitOpenError, LatencyTracker
 
 logger = logging.getLogger(__name__)
 
+# 接続プールの設定（環境変数で上書き可能）
+UTAGE_MAX_CONNECTIONS = int(os.getenv("UTAGE_MAX_CONNECTIONS", "20"))
+UTAGE_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UTAGE_MAX_KEEPALIVE_CONNECTIONS", "10"))
+UTAGE_KEEPALIVE_EXPIRY = float(os.getenv("UTAGE_KEEPALIVE_EXPIRY", "30"))
+UTAGE_HTTP2 = os.getenv("UTAGE_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# 段階ごとのタイムアウト（秒）
+UTAGE_CONNECT_TIMEOUT = float(os.getenv("UTAGE_CONNECT_TIMEOUT", "3"))
+UTAGE_READ_TIMEOUT = float(os.getenv("UTAGE_READ_TIMEOUT", "10"))
+UTAGE_WRITE_TIMEOUT = float(os.getenv("UTAGE_WRITE_TIMEOUT", "10"))
+UTAGE_POOL_TIMEOUT = float(os.getenv("UTAGE_POOL_TIMEOUT", "5"))
+
+# サーキットブレーカーの設定（連続失敗回数・回路を開いておく秒数・応答時間の予算）
+UTAGE_BREAKER_FAILURE_THRESHOLD = int(os.getenv("UTAGE_BREAKER_FAILURE_THRESHOLD", "5"))
+UTAGE_BREAKER_OPEN_SECONDS = float(os.getenv("UTAGE_BREAKER_OPEN_SECONDS", "30"))
+UTAGE_LATENCY_BUDGET = float(os.getenv("UTAGE_LATENCY_BUDGET", "3"))
+
+# 適応タイムアウトの設定（直近の応答時間のパーセンタイル × 倍率。UTAGE_READ_TIMEOUT が上限）
+# 下限は UTAGE_LATENCY_BUDGET より短くしない（予算内の応答までタイムアウトさせないため）
+UTAGE_TIMEOUT_PERCENTILE = float(os.getenv("UTAGE_TIMEOUT_PERCENTILE", "99"))
+UTAGE_TIMEOUT_MULTIPLIER = float(os.getenv("UTAGE_TIMEOUT_MULTIPLIER", "2"))
+UTAGE_MIN_TIMEOUT = float(os.getenv("UTAGE_MIN_TIMEOUT", "1"))
+
+utage_breaker = CircuitBreaker(
+    "utage",
+    failure_threshold=UTAGE_BREAKER_FAILURE_THRESHOLD,
+    open_seconds=UTAGE_BREAKER_OPEN_SECONDS,
+    latency_budget=UTAGE_LATENCY_BUDGET,
+)
+utage_latency = LatencyTracker(
+    percentile=UTAGE_TIMEOUT_PERCENTILE,
+    multiplier=UTAGE_TIMEOUT_MULTIPLIER,
+    min_timeout=min(max(UTAGE_MIN_TIMEOUT, UTAGE_LATENCY_BUDGET), UTAGE_READ_TIMEOUT),
+    max_timeout=UTAGE_READ_TIMEOUT,
+)
+
+# 再試行すれば成功しうるステータスコード（これ以外の4xxはリクエスト内容の問題として再試行しない）
+RETRYABLE_STATUS_CODES = frozenset({408, 429})
+
+
+def is_retryable_status(status_code: int) -> bool:
+    """再試行すれば成功しうる応答か（408・429・5xx）"""
+    return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+
+
+# アプリケーション全体で共有するHTTPクライアント（接続を使い回す）
+_http_client: Optional[httpx.AsyncClient] = None
+_utage_client: Optional["UtageClient"] = None
+
+
+def _http2_available() -> bool:
+    """HTTP/2を使えるか（httpxのHTTP/2対応には h2 パッケージが必要）"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """共有のHTTPクライアントを取得（未作成の場合は作成する）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        http2 = UTAGE_HTTP2
+        if http2 and not _http2_available():
+            logger.warning("h2 がインストールされていないため、HTTP/1.1で接続します")
+            http2 = False
+        _http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=UTAGE_MAX_CONNECTIONS,
+                max_keepalive_connections=UTAGE_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=UTAGE_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                connect=UTAGE_CONNECT_TIMEOUT,
+                read=UTAGE_READ_TIMEOUT,
+                write=UTAGE_WRITE_TIMEOUT,
+                pool=UTAGE_POOL_TIMEOUT,
+            ),
+        )
+    return _http_client
+
+
+async def open_http_client() -> None:
+    """共有のHTTPクライアントを作成（アプリケーションの起動時に呼ぶ）"""
+    get_http_client()
+
+
+async def close_http_client() -> None:
+    """共有のHTTPクライアントを閉じる（アプリケーションの終了時に呼ぶ）"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def get_utage_client() -> "UtageClient":
+    """共有のUtageクライアントを取得"""
+    global _utage_client
+    if _utage_client is None:
+        _utage_client = UtageClient()
+    return _utage_client
+
 
 class UtageClient:
     """Utage APIクライアント"""
     
-    def __init__(self):
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
+        self._http_client = http_client
         self.api_key = os.getenv("UTAGE_API_KEY")
         self.api_url = os.getenv("UTAGE_API_URL", "https://api.utage-system.com")
         self.scenario_id_prospect = os.getenv("UTAGE_SCENARIO_ID_PROSPECT")
         self.scenario_id_customer = os.getenv("UTAGE_SCENARIO_ID_CUSTOMER")
         self.scenario_id_dormant = os.getenv("UTAGE_SCENARIO_ID_DORMANT")
+    
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """リクエストに使うHTTPクライアント（指定がなければ共有のクライアント）"""
+        return self._http_client or get_http_client()
+    
+    async def _request(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """
+        サーキットブレーカーを通してリクエストを送る
         
+        回路が開いている場合は CircuitOpenError を送出する。
+        接続エラー・タイムアウト・5xxは失敗として記録する。
+        読み込みがタイムアウトした場合は、タイムアウトまでの時間を応答時間として記録する
+        （記録しないと、遅くなった応答がタイムアウトの計算に入らず、短いタイムアウトのままになる）。
+        """
+        utage_breaker.check()
+        read_timeout = utage_latency.timeout()
+        timeout = httpx.Timeout(
+            connect=UTAGE_CONNECT_TIMEOUT,
+            read=read_timeout,
+            write=UTAGE_WRITE_TIMEOUT,
+            pool=UTAGE_POOL_TIMEOUT,
+        )
+        started = time.monotonic()
+        try:
+            response = await self.http_client.request(method, url, timeout=timeout, **kwargs)
+        except httpx.ReadTimeout:
+            utage_latency.observe(read_timeout)
+            utage_breaker.record_failure()
+            raise
+        except Exception:
+            utage_breaker.record_failure()
+            raise
+        except BaseException:
+            # キャンセルされた場合は結果を記録せず、半開状態の試しの呼び出しだけ解放する
+            utage_breaker.release()
+            raise
+        latency = time.monotonic() - started
+        if response.status_code >= 500:
+            utage_breaker.record_failure()
+        else:
+            utage_latency.observe(latency)
+            utage_breaker.record_success(latency)
+        return response
+    
     async def register_email(
         self,
         email: str,
@@ -36,11 +192,12 @@ class UtageClient:
             scenario_id: シナリオID（指定がない場合は見込み客シナリオを使用）
         
         Returns:
-            登録結果
+            登録結果（回路が開いていて送信しなかった場合は retry_after に再開までの秒数が入る。
+            失敗した場合、retryable は再試行すれば成功しうるか（設定の不足・408/429以外の4xxはFalse））
         """
         if not self.api_key:
             logger.warning("UTAGE_API_KEYが設定されていません。Utageへの登録をスキップします。")
-            return {"success": False, "message": "APIキーが設定されていません"}
+            return {"success": False, "message": "APIキーが設定されていません", "retryable": False}
         
         # シナリオIDが指定されていない場合は、見込み客シナリオを使用
         if not scenario_id:
@@ -48,7 +205,7 @@ class UtageClient:
         
         if not scenario_id:
             logger.warning("UTAGE_SCENARIO_ID_PROSPECTが設定されていません。Utageへの登録をスキップします。")
-            return {"success": False, "message": "シナリオIDが設定されていません"}
+            return {"success": False, "message": "シナリオIDが設定されていません", "retryable": False}
         
         try:
             # TODO: Utage APIの実際のエンドポイントとリクエスト形式を確認
@@ -56,35 +213,41 @@ class UtageClient:
             # 「UTAGEのAPI公開について」のページを参照
             
             # 仮の実装（実際のAPI仕様に合わせて修正が必要）
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.api_url}/api/v1/members",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "email": email,
-                        "name": name,
-                        "scenario_id": scenario_id,
-                        "custom_fields": {
-                            "source": source,
-                            "registered_at": None,  # Utage側で自動設定される可能性
-                        }
-                    },
-                    timeout=10.0
-                )
+            response = await self._request(
+                "POST",
+                f"{self.api_url}/api/v1/members",
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "email": email,
+                    "name": name,
+                    "scenario_id": scenario_id,
+                    "custom_fields": {
+                        "source": source,
+                        "registered_at": None,  # Utage側で自動設定される可能性
+                    }
+                },
+            )
+            
+            if response.status_code == 200 or response.status_code == 201:
+                logger.info(f"Utageへのメール登録成功: {email}")
+                return {"success": True, "message": "Utageへの登録が完了しました"}
+            else:
+                logger.error(f"Utageへのメール登録失敗: {response.status_code} - {response.text}")
+                return {
+                    "success": False,
+                    "message": f"Utageへの登録に失敗しました: {response.status_code}",
+                    "retryable": is_retryable_status(response.status_code),
+                }
                 
-                if response.status_code == 200 or response.status_code == 201:
-                    logger.info(f"Utageへのメール登録成功: {email}")
-                    return {"success": True, "message": "Utageへの登録が完了しました"}
-                else:
-                    logger.error(f"Utageへのメール登録失敗: {response.status_code} - {response.text}")
-                    return {"success": False, "message": f"Utageへの登録に失敗しました: {response.status_code}"}
-                    
+        except CircuitOpenError as e:
+            logger.warning(f"Utageへのメール登録を見送りました: {str(e)}")
+            return {"success": False, "message": str(e), "retry_after": e.retry_after}
         except Exception as e:
             logger.error(f"Utageへのメール登録でエラーが発生しました: {str(e)}")
-            return {"success": False, "message": f"エラーが発生しました: {str(e)}"}
+            return {"success": False, "message": f"エラーが発生しました: {str(e)}", "retryable": True}
     
     async def update_custom_fields(
         self,
@@ -99,34 +262,41 @@ class UtageClient:
             custom_fields: 更新するカスタムフィールド
         
         Returns:
-            更新結果
+            更新結果（回路が開いていて送信しなかった場合は retry_after に再開までの秒数が入る。
+            失敗した場合、retryable は再試行すれば成功しうるか（設定の不足・408/429以外の4xxはFalse））
         """
         if not self.api_key:
             logger.warning("UTAGE_API_KEYが設定されていません。Utageへの更新をスキップします。")
-            return {"success": False, "message": "APIキーが設定されていません"}
+            return {"success": False, "message": "APIキーが設定されていません", "retryable": False}
         
         try:
             # TODO: Utage APIの実際のエンドポイントとリクエスト形式を確認
-            async with httpx.AsyncClient() as client:
-                response = await client.patch(
-                    f"{self.api_url}/api/v1/members/{email}",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "custom_fields": custom_fields
-                    },
-                    timeout=10.0
-                )
+            response = await self._request(
+                "PATCH",
+                f"{self.api_url}/api/v1/members/{email}",
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                json={
+                    "custom_fields": custom_fields
+                },
+            )
+            
+            if response.status_code == 200:
+                logger.info(f"Utageのカスタムフィールド更新成功: {email}")
+                return {"success": True, "message": "カスタムフィールドの更新が完了しました"}
+            else:
+                logger.error(f"Utageのカスタムフィールド更新失敗: {response.status_code} - {response.text}")
+                return {
+                    "success": False,
+                    "message": f"カスタムフィールドの更新に失敗しました: {response.status_code}",
+                    "retryable": is_retryable_status(response.status_code),
+                }
                 
-                if response.status_code == 200:
-                    logger.info(f"Utageのカスタムフィールド更新成功: {email}")
-                    return {"success": True, "message": "カスタムフィールドの更新が完了しました"}
-                else:
-                    logger.error(f"Utageのカスタムフィールド更新失敗: {response.status_code} - {response.text}")
-                    return {"success": False, "message": f"カスタムフィールドの更新に失敗しました: {response.status_code}"}
-                    
+        except CircuitOpenError as e:
+            logger.warning(f"Utageのカスタムフィールド更新を見送りました: {str(e)}")
+            return {"success": False, "message": str(e), "retry_after": e.retry_after}
         except Exception as e:
             logger.error(f"Utageのカスタムフィールド更新でエラーが発生しました: {str(e)}")
-            return {"success": False, "message": f"エラーが発生しました: {str(e)}"}
+            return {"success": False, "message": f"エラーが発生しました: {str(e)}", "retryable": True}
@@ -0,0 +1,167 @@
+"""
+Utageのカスタムフィールド更新のまとめ送信（ライトビハインド）
+
+同じメールアドレスへの更新を一定時間（ウィンドウ）だけ溜めて項目ごとにマージし、
+メールアドレスごとに1回の更新リクエストとして送信する。同じ項目は後から来た値で上書きする。
+送信の同時実行数は上限を設け、同じメールアドレスへの送信は重ならないようにする
+（送信中に来た更新は、送信が終わってから次のウィンドウで送る）。
+一時的な失敗で送信できなかった更新はアウトボックスに書き込み、再試行はアウトボックスのワーカーに任せる
+（設定の不足や4xxなど、再試行しても成功しない失敗は書き込まない）。
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Optional, Set
+
+from app.api.utils.outbox import PermanentFailure, RetryLater, outbox_worker
+from app.api.utils.utage_client import get_utage_client
+
+logger = logging.getLogger(__name__)
+
+# 更新を溜める時間（秒）と送信の同時実行数（環境変数で上書き可能）
+UTAGE_FIELD_FLUSH_WINDOW = float(os.getenv("UTAGE_FIELD_FLUSH_WINDOW", "2"))
+UTAGE_FIELD_MAX_CONCURRENCY = int(os.getenv("UTAGE_FIELD_MAX_CONCURRENCY", "4"))
+
+# アウトボックスに書き込むカスタムフィールド更新の種類
+UTAGE_UPDATE_CUSTOM_FIELDS = "utage.update_custom_fields"
+
+
+async def _send_custom_fields(payload: Dict[str, Any]) -> None:
+    """カスタムフィールドの更新を送信（失敗した場合は例外を送出する）"""
+    result = await get_utage_client().update_custom_fields(payload["email"], payload["custom_fields"])
+    if result.get("retry_after") is not None:
+        # Utage APIの回路が開いている間は、試行回数を消費せずに再開後に送る
+        raise RetryLater(max(1.0, result["retry_after"]), result.get("message", ""))
+    if not result.get("success"):
+        message = result.get("message") or "カスタムフィールドの更新に失敗しました"
+        if not result.get("retryable", True):
+            # 設定の不足や4xxは再試行しても成功しないため、すぐに送信失敗として扱う
+            raise PermanentFailure(message)
+        raise RuntimeError(message)
+
+
+outbox_worker.register_handler(UTAGE_UPDATE_CUSTOM_FIELDS, _send_custom_fields)
+
+
+class CustomFieldUpdater:
+    """カスタムフィールド更新をメールアドレスごとにまとめて送信する"""
+
+    def __init__(self, window: float = UTAGE_FIELD_FLUSH_WINDOW, max_concurrency: int = UTAGE_FIELD_MAX_CONCURRENCY):
+        self.window = window
+        self.max_concurrency = max_concurrency
+        # メールアドレス → マージ済みの更新内容 / 送信予定時刻
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._due_at: Dict[str, float] = {}
+        self._in_flight: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._sending: Set[asyncio.Task] = set()
+        self.updates = 0
+        self.requests = 0
+        self.failures = 0
+
+    def update(self, email: str, custom_fields: Dict[str, Any]) -> None:
+        """更新を登録（ウィンドウの終わりにまとめて送信される）"""
+        self.updates += 1
+        pending = self._pending.setdefault(email, {})
+        pending.update(custom_fields)
+        if email not in self._due_at:
+            self._due_at[email] = time.monotonic() + self.window
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    async def start(self) -> None:
+        """送信タスクを開始"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """送信タスクを停止（溜まっている更新はすべて送信する）"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """溜まっている更新をすぐに送信する"""
+        emails = [email for email in self._pending if email not in self._in_flight]
+        await asyncio.gather(*(self._send(email) for email in emails))
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            for email in [email for email, due_at in self._due_at.items() if due_at <= now]:
+                if email in self._in_flight:
+                    continue
+                task = asyncio.create_task(self._send(email))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+
+            # 次の送信予定時刻まで（新しい更新が来たら起きて予定を確認する）
+            waiting = [due_at for email, due_at in self._due_at.items() if email not in self._in_flight]
+            timeout = max(0.0, min(waiting) - time.monotonic()) if waiting else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, email: str) -> None:
+        """1件のメールアドレス分の更新を送信"""
+        custom_fields = self._pending.pop(email, None)
+        self._due_at.pop(email, None)
+        if not custom_fields:
+            return
+
+        self._in_flight.add(email)
+        try:
+            if self._semaphore is not None:
+                async with self._semaphore:
+                    await self._deliver(email, custom_fields)
+            else:
+                await self._deliver(email, custom_fields)
+        finally:
+            self._in_flight.discard(email)
+            if email in self._pending and self._wakeup is not None:
+                # 送信中に来た更新を送るため、送信予定を確認し直す
+                self._wakeup.set()
+
+    async def _deliver(self, email: str, custom_fields: Dict[str, Any]) -> None:
+        self.requests += 1
+        payload = {"email": email, "custom_fields": custom_fields}
+        try:
+            await _send_custom_fields(payload)
+        except PermanentFailure as e:
+            # 再試行しても成功しないため、アウトボックスには書き込まない
+            self.failures += 1
+            logger.warning(f"カスタムフィールドの更新に失敗しました（再試行しません）: {email} {str(e)}")
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"カスタムフィールドの更新に失敗したため、アウトボックスから再試行します: {email} {str(e)}")
+            try:
+                await outbox_worker.enqueue(UTAGE_UPDATE_CUSTOM_FIELDS, payload)
+            except Exception as e:
+                logger.error(f"カスタムフィールドの更新をアウトボックスに書き込めませんでした: {email} {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        """統計情報"""
+        return {
+            "pending": len(self._pending),
+            "in_flight": len(self._in_flight),
+            "updates": self.updates,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+utage_field_updater = CustomFieldUpdater()
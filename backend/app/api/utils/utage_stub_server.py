@@ -0,0 +1,82 @@
+"""
+ローカル開発・動作確認用のUtage API代替サーバー
+
+UtageClient が使うエンドポイント（会員登録・カスタムフィールド更新）を同じ形式で受け付け、
+登録内容をメモリ上に保持する。遅延や失敗を環境変数で再現できる。
+
+使い方（backend/ で実行）:
+    uvicorn app.api.utils.utage_stub_server:app --port 8100
+    # APIサーバー側で UTAGE_API_URL=http://localhost:8100 と UTAGE_API_KEY（任意の値）を設定する
+
+環境変数:
+    UTAGE_STUB_LATENCY: 応答までの遅延（秒）
+    UTAGE_STUB_FAILURE_RATE: 500を返す割合（0〜1）
+"""
+import asyncio
+import os
+import random
+from typing import Any, Dict
+
+from fastapi import FastAPI, Header, HTTPException, Request
+
+UTAGE_STUB_LATENCY = float(os.getenv("UTAGE_STUB_LATENCY", "0"))
+UTAGE_STUB_FAILURE_RATE = float(os.getenv("UTAGE_STUB_FAILURE_RATE", "0"))
+
+app = FastAPI(title="Utage API 代替サーバー")
+
+# メールアドレス → 会員情報
+members: Dict[str, Dict[str, Any]] = {}
+
+# エンドポイントごとのリクエスト数
+request_counts: Dict[str, int] = {"register": 0, "update_custom_fields": 0}
+
+
+async def _simulate(authorization: str) -> None:
+    """認証の確認と、遅延・失敗の再現"""
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if UTAGE_STUB_LATENCY > 0:
+        await asyncio.sleep(UTAGE_STUB_LATENCY)
+    if random.random() < UTAGE_STUB_FAILURE_RATE:
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
+@app.post("/api/v1/members", status_code=201)
+async def register_member(request: Request, authorization: str = Header("")):
+    """会員登録"""
+    await _simulate(authorization)
+    request_counts["register"] += 1
+    body = await request.json()
+    email = body.get("email")
+    if not email:
+        raise HTTPException(status_code=400, detail="email is required")
+    member = members.setdefault(email, {"email": email, "custom_fields": {}})
+    member.update(name=body.get("name"), scenario_id=body.get("scenario_id"))
+    member["custom_fields"].update(body.get("custom_fields") or {})
+    return member
+
+
+@app.patch("/api/v1/members/{email}")
+async def update_member(email: str, request: Request, authorization: str = Header("")):
+    """カスタムフィールド更新"""
+    await _simulate(authorization)
+    request_counts["update_custom_fields"] += 1
+    body = await request.json()
+    member = members.setdefault(email, {"email": email, "custom_fields": {}})
+    member["custom_fields"].update(body.get("custom_fields") or {})
+    return member
+
+
+@app.get("/api/v1/members/{email}")
+async def get_member(email: str):
+    """会員情報の確認"""
+    member = members.get(email)
+    if member is None:
+        raise HTTPException(status_code=404, detail="Member not found")
+    return member
+
+
+@app.get("/stats")
+async def stats():
+    """受け付けたリクエスト数と会員数"""
+    return {"requests": request_counts, "members": len(members)}
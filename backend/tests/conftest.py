@@ -0,0 +1,9 @@
+"""
+テストの共通設定
+
+backend/ をインポートパスに加え、app パッケージをどこから実行しても読み込めるようにする。
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,240 @@
+"""
+カタログのスナップショット
+
+- コンパイル済みカタログから読み込んだスナップショットが、JSONから構築したものと同じ内容になること
+- 検索APIのカーソルページネーションが、ページ番号による取得と同じ商品を重複なく返すこと
+"""
+import json
+import random
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from app.api.main import app
+from app.api.utils import catalog_store as catalog_store_module
+from app.api.utils.catalog_compiler import compile_catalog
+from app.api.utils.catalog_index import INDEXED_FIELDS, MISSING
+from app.api.utils.catalog_ngram import PURPOSE_FIELDS
+from app.api.utils.catalog_order import SORT_KEYS
+from app.api.utils.catalog_records import ProductRecords
+from app.api.utils.catalog_store import CatalogStore, build_snapshot
+
+CATEGORIES = ["パンツ", "トップス", "靴", "時計", "バッグ"]
+COLORS = ["黒", "白", "ネイビー", "Black"]
+SCENES = ["デート", "仕事", "休日"]
+STYLES = ["カジュアル", "きれいめ", "ストリート"]
+
+TEMPLATES = [
+    {
+        "template_id": "TEMPLATE_TEST",
+        "items": [
+            {"item_type": "パンツ", "required": True, "conditions": {"colors": ["黒"], "price_range": {"max": 8000}}},
+            {"item_type": "靴", "conditions": {"type": "スニーカー", "fit": "オーバーサイズ（ゆったり）"}},
+        ],
+    },
+]
+
+
+def _products(count: int = 120, seed: int = 3) -> list:
+    """価格・登録日時が重複し、欠損のある項目も含む商品データ"""
+    rnd = random.Random(seed)
+    products = []
+    for number in range(count):
+        product = {
+            "product_id": f"P{number:04d}",
+            "name": f"{rnd.choice(['オーバーサイズ', 'スリム', 'シンプル'])}{rnd.choice(['デニム', 'スニーカー', 'シャツ'])} {number}",
+            "description": rnd.choice(["高級感のある一着", "street luxury", "ＬＵＸＵＲＹ な雰囲気", ""]),
+            "category": rnd.choice(CATEGORIES),
+            "brand": rnd.choice(["ブランドA", "ブランドB", "brand c"]),
+            "price": rnd.choice([3000, 4980, 8000, 12000, 5500.5]),
+            "original_price": rnd.choice([9000, 15000]),
+            "colors": rnd.sample(COLORS, rnd.randint(0, 2)),
+            "sizes": rnd.sample(["S", "M", "L", "XL"], rnd.randint(0, 3)),
+            "materials": rnd.sample(["コットン", "ポリエステル", "レザー"], rnd.randint(0, 2)),
+            "created_at": f"2024-0{rnd.randint(1, 3)}-0{rnd.randint(1, 4)}T00:00:00",
+            "evaluation": {
+                "moteru_score": rnd.choice([3.0, 3.5, 4.2, 4.8]),
+                "luxury_atmosphere": rnd.uniform(2, 5),
+                "uniqueness": rnd.uniform(2, 5),
+                "street_luxury_fusion": rnd.uniform(2, 5),
+                "oversize_lower_body": rnd.random() < 0.5,
+            },
+            "attributes": {
+                "scene": rnd.sample(SCENES, rnd.randint(0, 2)),
+                "style": rnd.sample(STYLES, rnd.randint(1, 2)),
+                "fit": rnd.choice(["スリム", "オーバーサイズ", "レギュラー"]),
+            },
+            "moteru_score": rnd.choice([3.5, 4.5]),
+        }
+        if number % 7:
+            product["in_stock"] = number % 5 != 0
+        if number % 11 == 0:
+            del product["category"]
+        products.append(product)
+    return products
+
+
+def _write_catalog(directory, products: list, templates: list = TEMPLATES):
+    products_file = directory / "products.json"
+    templates_file = directory / "templates.json"
+    products_file.write_text(json.dumps({"products": products}, ensure_ascii=False), encoding="utf-8")
+    templates_file.write_text(json.dumps({"テンプレート": templates}, ensure_ascii=False), encoding="utf-8")
+    return products_file, templates_file
+
+
+@pytest.fixture
+def catalog_files(tmp_path):
+    products = _products()
+    products_file, templates_file = _write_catalog(tmp_path, products)
+    compiled_file = tmp_path / "catalog.bin"
+    compile_catalog(products_file, templates_file, compiled_file)
+    return products, products_file, templates_file, compiled_file
+
+
+def _assert_same_snapshot(compiled, expected) -> None:
+    assert compiled.version == expected.version
+    assert list(compiled.products) == list(expected.products)
+    assert compiled.templates == expected.templates
+
+    for position, product in enumerate(expected.products):
+        assert compiled.product_positions.get(product["product_id"]) == expected.product_positions.get(product["product_id"])
+        assert compiled.summaries.fragment(position) == expected.summaries.fragment(position)
+        assert compiled.related.related(position, 5) == expected.related.related(position, 5)
+    assert compiled.product_positions.get("UNKNOWN") is None
+
+    candidates = expected.attributes.match({"in_stock": True})
+    for field in INDEXED_FIELDS:
+        assert compiled.attributes.values(field) == expected.attributes.values(field)
+        assert compiled.attributes.counts(field) == expected.attributes.counts(field)
+        assert compiled.attributes.counts(field, candidates) == expected.attributes.counts(field, candidates)
+        for value in expected.attributes.values(field) + [MISSING]:
+            assert compiled.attributes.lookup(field, value) == expected.attributes.lookup(field, value)
+
+    for name in SORT_KEYS:
+        compiled_order, expected_order = compiled.orders[name], expected.orders[name]
+        np.testing.assert_array_equal(compiled_order.positions, expected_order.positions)
+        np.testing.assert_array_equal(compiled_order.ranks, expected_order.ranks)
+        assert [compiled_order.key(rank) for rank in range(len(expected.products))] == [
+            expected_order.key(rank) for rank in range(len(expected.products))
+        ]
+
+    for query in ["デニム", "luxury", "ＬＵＸ", "ド", "デート", "存在しない"]:
+        assert compiled.ngrams.search(query, PURPOSE_FIELDS) == expected.ngrams.search(query, PURPOSE_FIELDS)
+
+    for name in ("price", "original_price", "sizes_empty"):
+        np.testing.assert_array_equal(getattr(compiled.columns, name), getattr(expected.columns, name))
+    for attribute in ("scores", "flags", "codes"):
+        for field, column in getattr(expected.columns, attribute).items():
+            np.testing.assert_array_equal(getattr(compiled.columns, attribute)[field], column)
+    assert compiled.columns.vocabularies == expected.columns.vocabularies
+
+    np.testing.assert_array_equal(compiled.style_scores.scores, expected.style_scores.scores)
+    np.testing.assert_array_equal(compiled.style_scores.fingerprints, expected.style_scores.fingerprints)
+    np.testing.assert_array_equal(compiled.related.neighbors, expected.related.neighbors)
+
+    compiled_slots = compiled.template_products.slots("TEMPLATE_TEST")
+    expected_slots = expected.template_products.slots("TEMPLATE_TEST")
+    assert len(compiled_slots) == len(expected_slots)
+    for compiled_slot, expected_slot in zip(compiled_slots, expected_slots):
+        assert (compiled_slot.item_type, compiled_slot.required, compiled_slot.conditions) == (
+            expected_slot.item_type, expected_slot.required, expected_slot.conditions,
+        )
+        np.testing.assert_array_equal(compiled_slot.positions, expected_slot.positions)
+        np.testing.assert_array_equal(compiled_slot.matched, expected_slot.matched)
+
+
+def test_compiled_snapshot_matches_json(catalog_files):
+    products, products_file, templates_file, compiled_file = catalog_files
+    store = CatalogStore(products_file, templates_file, reload_interval=0, compiled_file=compiled_file)
+    compiled = store.snapshot()
+    assert isinstance(compiled.products, ProductRecords)
+
+    expected = build_snapshot(
+        products,
+        TEMPLATES,
+        products_version=compiled.products_version,
+        templates_version=compiled.templates_version,
+    )
+    _assert_same_snapshot(compiled, expected)
+
+
+def test_compiled_catalog_requires_matching_sources(catalog_files):
+    products, products_file, templates_file, compiled_file = catalog_files
+
+    # 元データが変わった場合はJSONから読み込む
+    _write_catalog(products_file.parent, products[:-1])
+    store = CatalogStore(products_file, templates_file, reload_interval=0, compiled_file=compiled_file)
+    assert not isinstance(store.snapshot().products, ProductRecords)
+    assert len(store.snapshot().products) == len(products) - 1
+
+    # 元データがない場合は一致を確認できないため使わない
+    products_file.unlink()
+    store = CatalogStore(products_file, templates_file, reload_interval=0, compiled_file=compiled_file)
+    assert len(store.snapshot().products) == 0
+
+
+def test_corrupted_compiled_catalog_falls_back_to_json(catalog_files):
+    products, products_file, templates_file, compiled_file = catalog_files
+    raw = compiled_file.read_bytes()
+    compiled_file.write_bytes(raw[:len(raw) // 2])
+
+    store = CatalogStore(products_file, templates_file, reload_interval=0, compiled_file=compiled_file)
+    assert not isinstance(store.snapshot().products, ProductRecords)
+    assert list(store.snapshot().products) == products
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    products = _products()
+    products_file, templates_file = _write_catalog(tmp_path, products)
+    store = CatalogStore(products_file, templates_file, reload_interval=0)
+    monkeypatch.setattr(catalog_store_module, "catalog_store", store)
+    return TestClient(app), store, products
+
+
+def _search_ids(client: TestClient, query: str):
+    """カーソルをたどって全件の商品IDを取得"""
+    ids = []
+    response = client.get(f"/api/products/search?{query}").json()
+    while True:
+        ids += [product["product_id"] for product in response["products"]]
+        if not response["next_cursor"]:
+            return ids, response["count"]
+        response = client.get(f"/api/products/search?{query}&cursor={response['next_cursor']}").json()
+
+
+@pytest.mark.parametrize("sort", list(SORT_KEYS))
+@pytest.mark.parametrize("filters", ["", "&in_stock=true", "&color=黒"])
+def test_cursor_pages_match_numbered_pages(api, sort, filters):
+    client, _, _ = api
+    query = f"sort={sort}&limit=7{filters}"
+
+    by_cursor, count = _search_ids(client, query)
+
+    by_page = []
+    for page in range(1, count // 7 + 2):
+        by_page += [product["product_id"] for product in client.get(f"/api/products/search?{query}&page={page}").json()["products"]]
+    assert by_cursor == by_page
+    assert len(by_cursor) == len(set(by_cursor)) == count
+
+
+def test_cursor_survives_catalog_reload(api, tmp_path):
+    client, store, products = api
+    query = "sort=price_asc&limit=9"
+    first = client.get(f"/api/products/search?{query}").json()
+    seen = [product["product_id"] for product in first["products"]]
+
+    # カタログの再読み込み後は、ソートキーと商品IDから位置を探し直す
+    added = dict(products[0], product_id="P_NEW", price=1)
+    _write_catalog(tmp_path, [added] + products)
+    assert store.reload_if_changed()
+
+    rest, _ = _search_ids(client, f"{query}&cursor={first['next_cursor']}")
+    assert not set(seen) & set(rest)
+    assert sorted(seen + rest) == sorted(product["product_id"] for product in products)
+
+
+def test_invalid_cursor_is_rejected(api):
+    client, _, _ = api
+    assert client.get("/api/products/search?cursor=garbage").status_code == 400
@@ -0,0 +1,140 @@
+"""
+サーキットブレーカーの状態遷移
+
+時刻は差し替えた時計で進め、Utage APIの代替サーバーへの呼び出しでも回路が開くことを確かめる。
+"""
+import asyncio
+
+import httpx
+import pytest
+
+from app.api.utils import circuit_breaker
+from app.api.utils import utage_client as utage_client_module
+from app.api.utils import utage_stub_server as stub
+from app.api.utils.circuit_breaker import (
+    STATE_CLOSED,
+    STATE_HALF_OPEN,
+    STATE_OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    LatencyTracker,
+)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    return clock
+
+
+def _open(breaker: CircuitBreaker) -> None:
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow()
+        breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, open_seconds=10)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == STATE_CLOSED
+
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == STATE_OPEN
+    assert not breaker.allow()
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.check()
+    assert error.value.retry_after == pytest.approx(10)
+    assert breaker.rejected == 2
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, open_seconds=10)
+    for _ in range(2):
+        breaker.allow()
+        breaker.record_failure()
+    breaker.allow()
+    breaker.record_success(0.1)
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == STATE_CLOSED
+    assert breaker.consecutive_failures == 1
+
+
+def test_half_open_lets_one_trial_through(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, open_seconds=10)
+    _open(breaker)
+
+    clock.now += 10
+    assert breaker.allow()
+    assert breaker.state == STATE_HALF_OPEN
+    # 試しの呼び出しが終わるまで、他の呼び出しは通さない
+    assert not breaker.allow()
+
+    breaker.record_success(0.1)
+    assert breaker.state == STATE_CLOSED
+    assert breaker.allow()
+
+
+def test_failed_trial_reopens(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, open_seconds=10)
+    _open(breaker)
+
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == STATE_OPEN
+    assert breaker.retry_after() == pytest.approx(10)
+    assert breaker.times_opened == 2
+
+
+def test_released_trial_allows_next_trial(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, open_seconds=10)
+    _open(breaker)
+
+    clock.now += 10
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.allow()
+
+
+def test_slow_success_counts_as_failure(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, open_seconds=10, latency_budget=1.0)
+    for _ in range(2):
+        breaker.allow()
+        breaker.record_success(1.5)
+    assert breaker.state == STATE_OPEN
+    assert (breaker.slow_calls, breaker.successes) == (2, 0)
+
+
+def test_client_stops_calling_stub_while_open(monkeypatch):
+    monkeypatch.setenv("UTAGE_API_KEY", "test-key")
+    monkeypatch.setenv("UTAGE_API_URL", "http://utage-stub")
+    monkeypatch.setattr(stub, "UTAGE_STUB_FAILURE_RATE", 1.0)
+    breaker = CircuitBreaker("utage-test", failure_threshold=2, open_seconds=60)
+    monkeypatch.setattr(utage_client_module, "utage_breaker", breaker)
+    monkeypatch.setattr(utage_client_module, "utage_latency", LatencyTracker(max_timeout=5))
+    client = utage_client_module.UtageClient(httpx.AsyncClient(transport=httpx.ASGITransport(app=stub.app)))
+
+    async def update_three_times():
+        return [await client.update_custom_fields("user@example.com", {"score": 1}) for _ in range(3)]
+
+    first, second, third = asyncio.run(update_three_times())
+
+    assert first["retryable"] and second["retryable"]
+    assert breaker.state == STATE_OPEN
+    # 回路が開いている間は送信せず、再開までの秒数を返す
+    assert third["retry_after"] > 0
+    assert (breaker.calls, breaker.failures, breaker.rejected) == (2, 2, 1)
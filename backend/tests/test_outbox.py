@@ -0,0 +1,144 @@
+"""
+アウトボックスの再試行・dead（送信失敗）の扱い
+
+Utage APIの代替サーバー（utage_stub_server）をASGIのまま呼び出し、メール登録の送信処理を
+アウトボックスのワーカー経由で実行する。
+"""
+import asyncio
+import json
+import sqlite3
+
+import httpx
+import pytest
+
+from app.api.routes import email
+from app.api.utils import outbox as outbox_module
+from app.api.utils import utage_client as utage_client_module
+from app.api.utils import utage_stub_server as stub
+from app.api.utils.circuit_breaker import CircuitBreaker, LatencyTracker
+from app.api.utils.outbox import STATUS_DEAD, STATUS_PENDING, Outbox, OutboxWorker
+
+PAYLOAD = {"email": "user@example.com", "name": "テスト", "source": "test"}
+
+
+@pytest.fixture
+def utage(monkeypatch):
+    """代替サーバーに送るUtageクライアント（サーキットブレーカーはテストごとに作り直す）"""
+    monkeypatch.setenv("UTAGE_API_KEY", "test-key")
+    monkeypatch.setenv("UTAGE_API_URL", "http://utage-stub")
+    monkeypatch.setenv("UTAGE_SCENARIO_ID_PROSPECT", "scenario-1")
+    monkeypatch.setattr(stub, "UTAGE_STUB_FAILURE_RATE", 0.0)
+    monkeypatch.setattr(stub, "members", {})
+    monkeypatch.setattr(stub, "request_counts", {"register": 0, "update_custom_fields": 0})
+    breaker = CircuitBreaker("utage-test", failure_threshold=3, open_seconds=60)
+    monkeypatch.setattr(utage_client_module, "utage_breaker", breaker)
+    monkeypatch.setattr(utage_client_module, "utage_latency", LatencyTracker(max_timeout=5))
+
+    client = utage_client_module.UtageClient(httpx.AsyncClient(transport=httpx.ASGITransport(app=stub.app)))
+    monkeypatch.setattr(email, "get_utage_client", lambda: client)
+    # 再試行の待ち時間をなくし、すぐに取り出し直せるようにする
+    monkeypatch.setattr(outbox_module, "backoff_delay", lambda attempts: 0.0)
+    return breaker
+
+
+@pytest.fixture
+def worker(tmp_path):
+    worker = OutboxWorker(Outbox(tmp_path / "outbox.sqlite3"), max_attempts=3)
+    worker.register_handler(email.UTAGE_REGISTER_EMAIL, email._send_registration)
+    yield worker
+    worker.outbox.close()
+
+
+def _row(worker: OutboxWorker, entry_id: int):
+    connection = sqlite3.connect(str(worker.outbox.path))
+    try:
+        return connection.execute(
+            "SELECT status, attempts, payload, last_error FROM outbox WHERE id = ?", (entry_id,)
+        ).fetchone()
+    finally:
+        connection.close()
+
+
+async def _deliver_due(worker: OutboxWorker) -> int:
+    """送信時刻になったものを1回ずつ送信し、送信した件数を返す"""
+    entries = worker.outbox.claim_due()
+    for entry in entries:
+        await worker._deliver(entry)
+    return len(entries)
+
+
+def test_delivers_to_stub(utage, worker):
+    entry_id = worker.outbox.enqueue(email.UTAGE_REGISTER_EMAIL, PAYLOAD)
+
+    assert asyncio.run(_deliver_due(worker)) == 1
+
+    assert _row(worker, entry_id) is None
+    assert worker.delivered == 1
+    assert stub.members[PAYLOAD["email"]]["scenario_id"] == "scenario-1"
+
+
+def test_retries_then_succeeds(utage, worker, monkeypatch):
+    entry_id = worker.outbox.enqueue(email.UTAGE_REGISTER_EMAIL, PAYLOAD)
+
+    monkeypatch.setattr(stub, "UTAGE_STUB_FAILURE_RATE", 1.0)
+    asyncio.run(_deliver_due(worker))
+    status, attempts, payload, last_error = _row(worker, entry_id)
+    assert (status, attempts) == (STATUS_PENDING, 1)
+    assert json.loads(payload) == PAYLOAD
+    assert "500" in last_error
+
+    monkeypatch.setattr(stub, "UTAGE_STUB_FAILURE_RATE", 0.0)
+    asyncio.run(_deliver_due(worker))
+    assert _row(worker, entry_id) is None
+    assert (worker.failed, worker.delivered) == (1, 1)
+    assert PAYLOAD["email"] in stub.members
+
+
+def test_dead_letters_after_max_attempts(utage, worker, monkeypatch):
+    monkeypatch.setattr(stub, "UTAGE_STUB_FAILURE_RATE", 1.0)
+    entry_id = worker.outbox.enqueue(email.UTAGE_REGISTER_EMAIL, PAYLOAD)
+
+    for _ in range(worker.max_attempts):
+        assert asyncio.run(_deliver_due(worker)) == 1
+    # dead になったものは取り出されない
+    assert asyncio.run(_deliver_due(worker)) == 0
+
+    status, attempts, payload, _ = _row(worker, entry_id)
+    assert (status, attempts) == (STATUS_DEAD, worker.max_attempts)
+    # 個人情報を含む送信内容は消す
+    assert json.loads(payload) == {}
+    assert worker.dead_lettered == 1
+    assert worker.outbox.stats() == {STATUS_PENDING: 0, STATUS_DEAD: 1}
+
+
+def test_rejected_request_is_dead_lettered_without_retry(utage, worker):
+    # メールアドレスがない登録は代替サーバーが400を返す（再試行しても成功しない）
+    entry_id = worker.outbox.enqueue(email.UTAGE_REGISTER_EMAIL, dict(PAYLOAD, email=""))
+
+    asyncio.run(_deliver_due(worker))
+
+    status, attempts, _, last_error = _row(worker, entry_id)
+    assert (status, attempts) == (STATUS_DEAD, 1)
+    assert "400" in last_error
+
+
+def test_open_circuit_defers_without_consuming_attempts(utage, worker):
+    for _ in range(utage.failure_threshold):
+        utage.record_failure()
+    entry_id = worker.outbox.enqueue(email.UTAGE_REGISTER_EMAIL, PAYLOAD)
+
+    asyncio.run(_deliver_due(worker))
+
+    status, attempts, _, _ = _row(worker, entry_id)
+    assert (status, attempts) == (STATUS_PENDING, 0)
+    assert worker.deferred == 1
+    assert stub.request_counts["register"] == 0
+
+
+def test_purge_dead_removes_expired_rows(worker):
+    entry_id = worker.outbox.enqueue(email.UTAGE_REGISTER_EMAIL, PAYLOAD)
+    worker.outbox.mark_dead(entry_id, "test")
+
+    assert worker.outbox.purge_dead(retention=3600) == 0
+    assert worker.outbox.purge_dead(retention=-1) == 1
+    assert _row(worker, entry_id) is None